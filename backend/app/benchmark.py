@@ -0,0 +1,364 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from collections import Counter, defaultdict
+
+import numpy as np
+from PIL import Image
+
+import torch
+import torchvision
+
+from utils import AppPath
+
+STUB_MODEL_NAME = 'benchmark_stub'
+STUB_MODEL_ALIAS = 'Benchmark'
+STUB_MODEL_VERSION = '1'
+STUB_RUN_ID = 'local'
+STUB_ARCHS = {
+    'resnet_18': torchvision.models.resnet18,
+    'resnet_34': torchvision.models.resnet34,
+    'mobilenet_v2': torchvision.models.mobilenet_v2,
+    'mobilenet_v3_small': torchvision.models.mobilenet_v3_small,
+}
+ENDPOINTS = {
+    'predict': '/v1/catdog_classification/predict',
+    'predict_batch': '/v1/catdog_classification/predict_batch',
+}
+# Stages timed once per batch, all others are per image/request
+BATCH_STAGES = ('inference', 'persistence_flush')
+
+class StageRecorder:
+    """Wall time of every call to the wrapped Predictor/writer functions, grouped by stage."""
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start_time)
+        return wrapper
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def reset(self):
+        self.samples = defaultdict(list)
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(1000 * sum(ordered) / len(ordered), 4),
+        'p50_ms': round(1000 * pick(0.50), 4),
+        'p95_ms': round(1000 * pick(0.95), 4),
+        'p99_ms': round(1000 * pick(0.99), 4),
+        'max_ms': round(1000 * ordered[-1], 4),
+    }
+
+def parse_mix(mix: str):
+    weights = {}
+    for item in filter(None, (item.strip() for item in mix.split(','))):
+        endpoint, _, weight = item.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f'Invalid endpoint in request mix: {endpoint}. {list(ENDPOINTS)}')
+        weights[endpoint] = float(weight) if weight else 1.0
+    return weights
+
+def make_images(sizes, per_size: int, seed: int, image_dir=None):
+    """JPEG payloads for each size. Upscaled noise compresses like a photo, raw noise would inflate the file size."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for size in sizes:
+        for i in range(per_size):
+            pixels = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).resize((size, size), Image.BICUBIC).save(buffer, format='JPEG', quality=90)
+            images.append((f'bench_{size}_{i}.jpg', buffer.getvalue()))
+    if image_dir is not None:
+        images.extend((path.name, path.read_bytes()) for path in sorted(Path(image_dir).iterdir()) if path.is_file())
+    return images
+
+def register_stub_model(arch: str, root, model_file=None, img_size: int = 224):
+    """Put a local model into the artifact cache at `root` under the stub name, the predictor then never needs MLflow."""
+    from controllers.artifact_cache import ArtifactCache
+
+    if model_file is not None:
+        model = torch.load(model_file, map_location='cpu', weights_only=False)
+    else:
+        model = STUB_ARCHS[arch](num_classes=2)
+    metadata = {
+        'model_name': STUB_MODEL_NAME,
+        'model_version': STUB_MODEL_VERSION,
+        'run_id': STUB_RUN_ID,
+        'id2label': {0: 'cat', 1: 'dog'},
+        'label2id': {'cat': 0, 'dog': 1},
+        'image_mean': [0.485, 0.456, 0.406],
+        'image_std': [0.229, 0.224, 0.225],
+        'image_size': img_size,
+    }
+    artifact_cache = ArtifactCache(root=root)
+    artifact_cache.put(STUB_MODEL_NAME, STUB_MODEL_VERSION, STUB_RUN_ID, model.eval(), metadata)
+    artifact_cache.save_alias(STUB_MODEL_NAME, STUB_MODEL_ALIAS, STUB_MODEL_VERSION, STUB_RUN_ID)
+
+def configure_env(args, tmp_dir):
+    # Set before the app is imported, the router reads its config from the environment at import time
+    os.environ.update({
+        'MODEL_NAME': STUB_MODEL_NAME,
+        'MODEL_ALIAS': STUB_MODEL_ALIAS,
+        'DEVICE': 'cpu',
+        'SERVING_MODELS': '',
+        'SHADOW_MODELS': '',
+        # An empty local tracking store fails fast, so the predictor loads the stub from the artifact cache
+        'MLFLOW_TRACKING_URI': (Path(tmp_dir) / 'mlruns').as_uri(),
+        # The stub model lives next to the other benchmark files, never in the real artifact cache
+        'MODEL_CACHE_DIR': str(Path(tmp_dir) / 'models'),
+        'MODEL_POLL_INTERVAL': '3600',
+        'PREPROCESS_DECODER': args.decoder,
+        'EXECUTOR_BACKEND': args.executor,
+        'EXECUTOR_WORKERS': str(args.executor_workers),
+        'TORCH_NUM_THREADS': str(args.torch_threads),
+        'MAX_BATCH_SIZE': str(args.max_batch_size),
+        'MAX_BATCH_WAIT_MS': str(args.max_wait_ms),
+        'MAX_INFLIGHT': str(args.max_inflight),
+        'PREDICTION_CACHE_SIZE': str(args.prediction_cache_size),
+        'PREDICTION_DB_PATH': str(Path(tmp_dir) / 'predicted_cache.db'),
+        'CAPTURE_DIR': str(Path(tmp_dir) / 'captured_data'),
+    })
+    (Path(tmp_dir) / 'captured_data').mkdir()
+
+def instrument(predictor, writer, recorder):
+    """Wrap the stages of the served predictor. Wrapping only works in-process, hence no process executor."""
+    preprocessor = predictor.preprocessor
+    preprocessor.load = recorder.wrap('decode', preprocessor.load)
+    preprocessor.resize = recorder.wrap('transform', preprocessor.resize)
+    predictor.forward = recorder.wrap('inference', predictor.forward)
+    predictor.output2pred = recorder.wrap('softmax', predictor.output2pred)
+    # Request-path logging and prediction row enqueue
+    predictor.record = recorder.wrap('persistence', predictor.record)
+    writer.capture = recorder.wrap('capture', writer.capture)
+    writer._flush = recorder.wrap('persistence_flush', writer._flush)
+
+async def run_level(client, concurrency: int, num_requests: int, mix, images, batch_images: int, seed: int):
+    latencies = defaultdict(list)
+    errors = Counter()
+    num_images = 0
+    requests_left = iter(range(num_requests))
+
+    async def worker(worker_id):
+        nonlocal num_images
+        rng = random.Random(seed + worker_id)
+        for _ in requests_left:
+            endpoint = rng.choices(list(mix), weights=list(mix.values()))[0]
+            if endpoint == 'predict':
+                image_name, image = rng.choice(images)
+                request = dict(files={'file_upload': (image_name, image, 'image/jpeg')})
+                count = 1
+            else:
+                picked = rng.choices(images, k=batch_images)
+                request = dict(files=[('files', (image_name, image, 'image/jpeg')) for image_name, image in picked],
+                               params={'stream': 'false'})
+                count = batch_images
+
+            start_time = time.perf_counter()
+            try:
+                response = await client.post(ENDPOINTS[endpoint], **request)
+            except Exception as e:
+                errors[f'{endpoint}:{e.__class__.__name__}'] += 1
+                continue
+            elapsed = time.perf_counter() - start_time
+            if response.status_code != 200:
+                errors[f'{endpoint}:{response.status_code}'] += 1
+                continue
+            latencies[endpoint].append(elapsed)
+            num_images += count
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker(i) for i in range(concurrency)])
+    wall_time = time.perf_counter() - start_time
+
+    num_ok = sum(len(samples) for samples in latencies.values())
+    return {
+        'concurrency': concurrency,
+        'requests': num_requests,
+        'wall_sec': round(wall_time, 4),
+        'requests_per_sec': round(num_ok / wall_time, 4),
+        'images_per_sec': round(num_images / wall_time, 4),
+        'errors': dict(errors),
+        'latency': {
+            'all': percentiles([sample for samples in latencies.values() for sample in samples]),
+            **{endpoint: percentiles(samples) for endpoint, samples in latencies.items()},
+        },
+    }
+
+async def benchmark(args, images, mix):
+    import httpx
+    from main import app
+    from v1.routes import catdog_cls_router
+
+    pool = catdog_cls_router.pool
+    predictor = pool.managers[pool.default_key].get()
+    recorder = StageRecorder()
+    instrument(predictor, catdog_cls_router.writer, recorder)
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=args.timeout) as client:
+        if args.warmup > 0:
+            await run_level(client, 1, args.warmup, mix, images, args.batch_images, args.seed)
+
+        for concurrency in args.concurrency:
+            recorder.reset()
+            predictor.batcher.stats = type(predictor.batcher.stats)()
+            result = await run_level(client, concurrency, args.requests, mix, images, args.batch_images, args.seed)
+            # Give the background writer one flush interval so persistence_flush reflects this level
+            await asyncio.sleep(catdog_cls_router.WRITER_FLUSH_INTERVAL)
+            result['stages'] = {
+                stage: {'unit': 'batch' if stage in BATCH_STAGES else 'image', **percentiles(samples)}
+                for stage, samples in recorder.samples.items()
+            }
+            result['batch_stats'] = predictor.batch_stats()
+            result['writer_stats'] = catdog_cls_router.writer.stats()
+            results.append(result)
+            print_level(result)
+    catdog_cls_router.writer.close()
+    return results
+
+def print_level(result):
+    latency = result['latency']['all']
+    print(f"concurrency {result['concurrency']:>4} | {result['requests_per_sec']:>9.2f} req/s | {result['images_per_sec']:>9.2f} img/s | "
+          f"p50 {latency.get('p50_ms', 0):>8.2f} ms | p95 {latency.get('p95_ms', 0):>8.2f} ms | p99 {latency.get('p99_ms', 0):>8.2f} ms | "
+          f"errors {sum(result['errors'].values())}")
+    for stage, stats in result['stages'].items():
+        print(f"    {stage:<18} per {stats['unit']:<5} p50 {stats.get('p50_ms', 0):>8.3f} ms | p95 {stats.get('p95_ms', 0):>8.3f} ms | "
+              f"p99 {stats.get('p99_ms', 0):>8.3f} ms | n {stats['count']}")
+
+def compare(baseline_path, results, tolerance: float):
+    """Print the change against an earlier report, return False when a level got slower than the tolerance."""
+    with open(baseline_path) as f:
+        baseline = {result['concurrency']: result for result in json.load(f)['results']}
+
+    ok = True
+    for result in results:
+        old = baseline.get(result['concurrency'])
+        if old is None:
+            continue
+        checks = [(f'{q}_ms', old['latency']['all'].get(f'{q}_ms'), result['latency']['all'].get(f'{q}_ms'), 1)
+                  for q in ('p50', 'p95', 'p99')]
+        # Lower throughput is the regression, flip its sign so every check is "higher is worse"
+        checks.append(('requests_per_sec', old['requests_per_sec'], result['requests_per_sec'], -1))
+        for name, before, after, sign in checks:
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = sign * change > tolerance
+            ok = ok and not regressed
+            print(f"concurrency {result['concurrency']:>4} {name:<17} {before:>10.3f} -> {after:>10.3f} ({change:+.1%})"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return ok
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=AppPath.ROOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive the serving app in-process with a local stub model and report latency per stage')
+    parser.add_argument('--arch', type=str, default='resnet_18', choices=list(STUB_ARCHS),
+                        help='Randomly initialized torchvision model used as the stub')
+    parser.add_argument('--model_file', type=str, default=None,
+                        help='Full model saved with torch.save, used instead of --arch')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help='Concurrent clients, one benchmark level per value')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests per concurrency level')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='Untimed requests sent before the first level')
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[224, 512, 1024],
+                        help='Side lengths of the generated JPEG payloads')
+    parser.add_argument('--images_per_size', type=int, default=8,
+                        help='Distinct generated images per size')
+    parser.add_argument('--image_dir', type=str, default=None,
+                        help='Directory of real images added to the payloads')
+    parser.add_argument('--mix', type=str, default='predict=0.9,predict_batch=0.1',
+                        help='Request mix as endpoint=weight, e.g. predict=0.9,predict_batch=0.1')
+    parser.add_argument('--batch_images', type=int, default=8,
+                        help='Images per predict_batch request')
+    parser.add_argument('--decoder', type=str, default='pil', choices=['reference', 'pil', 'torchvision'],
+                        help='PREPROCESS_DECODER of the app')
+    parser.add_argument('--executor', type=str, default='thread', choices=['inline', 'thread'],
+                        help='EXECUTOR_BACKEND of the app, the process backend runs stages out of reach of the timers')
+    parser.add_argument('--executor_workers', type=int, default=2,
+                        help='EXECUTOR_WORKERS of the app')
+    parser.add_argument('--torch_threads', type=int, default=0,
+                        help='TORCH_NUM_THREADS of the app, 0 keeps the torch default')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='MAX_BATCH_SIZE of the app')
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='MAX_BATCH_WAIT_MS of the app')
+    parser.add_argument('--max_inflight', type=int, default=1024,
+                        help='MAX_INFLIGHT of the app, high by default so the benchmark measures queueing instead of 503s')
+    parser.add_argument('--prediction_cache_size', type=int, default=0,
+                        help='PREDICTION_CACHE_SIZE of the app, off by default so repeated payloads still hit the model')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Client timeout per request in seconds')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for payloads and request mix')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON report path, defaults to benchmarks/<timestamp>.json')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Earlier JSON report to compare against, exits non-zero on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slowdown tolerated by --compare')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    images = make_images(args.image_sizes, args.images_per_size, args.seed, args.image_dir)
+
+    with tempfile.TemporaryDirectory(prefix='catdog_benchmark_') as tmp_dir:
+        configure_env(args, tmp_dir)
+        sys.path.append(str(AppPath.ROOT_DIR / 'v1'))
+        register_stub_model(args.arch, Path(tmp_dir) / 'models', args.model_file)
+        results = asyncio.run(benchmark(args, images, mix))
+
+    report = {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+        },
+        'config': vars(args),
+        'results': results,
+    }
+    output = Path(args.output) if args.output else AppPath.ROOT_DIR / 'benchmarks' / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f'Report saved to {output}')
+
+    if args.compare and not compare(args.compare, results, args.tolerance):
+        sys.exit(1)
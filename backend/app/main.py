@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 from middleware import CORSMiddleware, origins, LogProcessAndTime
-from v1.routes import v1_router, redirect_router
+from v1.routes import v1_router, redirect_router, metrics_router
 
 app = FastAPI()
 
@@ -12,4 +12,5 @@ app.add_middleware(CORSMiddleware,
 app.add_middleware(LogProcessAndTime)
 
 app.include_router(v1_router, prefix='/v1', tags=['v1_router'])
-app.include_router(redirect_router, tags=['redirect_router'])
\ No newline at end of file
+app.include_router(redirect_router, tags=['redirect_router'])
+app.include_router(metrics_router, tags=['metrics_router'])
\ No newline at end of file
@@ -3,18 +3,44 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent))
 
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
 from utils.logger import Logger
+from utils.metrics import REQUEST_LATENCY
 
 LOGGER = Logger(__file__, log_file='http.log')
 
-class LogProcessAndTime(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        LOGGER.log.info(
-            f"{request.client.host} - \"{request.method} {request.url.path} {request.scope['http_version']}\" {response.status_code} {process_time:.2f}"
-        )
-        return response
\ No newline at end of file
+class LogProcessAndTime:
+    """Pure ASGI timing middleware.
+
+    Unlike BaseHTTPMiddleware it doesn't wrap the app in an extra task and stream
+    buffer, it only watches the response start message for the status code. The
+    timing covers the whole response, streamed bodies included.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            process_time = time.perf_counter() - start_time
+            # Label by route template instead of the raw path, so path parameters and 404 probes don't explode cardinality
+            route = scope.get('route')
+            REQUEST_LATENCY.labels(scope['method'], route.path if route is not None else 'unmatched', status_code).observe(process_time)
+            client = scope.get('client')
+            LOGGER.log.info(
+                f"{client[0] if client else '-'} - \"{scope['method']} {scope['path']} HTTP/{scope['http_version']}\" {status_code} {1000 * process_time:.3f}ms",
+                extra={'method': scope['method'], 'path': scope['path'], 'status': status_code, 'duration_ms': round(1000 * process_time, 3)}
+            )
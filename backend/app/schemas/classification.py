@@ -6,4 +6,9 @@ class PredictionResponse(BaseModel):
     predicted_id: int = -1
     predicted_class: str = ""
     predicted_name: str = ""
-    predicted_alias: str = ""
\ No newline at end of file
+    predicted_alias: str = ""
+    predicted_version: str = ""
+
+class PredictionError(BaseModel):
+    image_name: str = ""
+    error: str = ""
\ No newline at end of file
@@ -1,4 +1,194 @@
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import tempfile
+
 import uvicorn
 
+from utils import Logger
+
+from dotenv import load_dotenv
+load_dotenv()
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 5000))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 1))
+SERVER_RELOAD = os.getenv("SERVER_RELOAD", "false").lower() == "true"
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 0))
+WORKER_CPU_PINNING = os.getenv("WORKER_CPU_PINNING", "true").lower() == "true"
+SHARE_WEIGHTS = os.getenv("SHARE_WEIGHTS", "false").lower() == "true"
+
+LOGGER = Logger(__file__, log_file='server.log')
+
+def cpu_slices(num_workers: int, threads_per_worker: int = 0):
+    """Split the CPUs this process may run on into one contiguous slice per worker."""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    size = threads_per_worker or max(1, len(cpus) // num_workers)
+    slices = []
+    for i in range(num_workers):
+        # More workers than CPUs wraps around and shares CPUs
+        start = (i * size) % len(cpus)
+        slices.append(cpus[start:start + size])
+    return slices
+
+def memory_report(pids):
+    """RSS, PSS (shared pages split between sharers) and shared/private MB per process, from /proc."""
+    report = {}
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                fields = {line.split(':')[0]: int(line.split()[1]) for line in f if line.split()[-1] == 'kB'}
+        except OSError:
+            continue
+        report[pid] = {
+            'rss_mb': round(fields.get('Rss', 0) / 1024, 1),
+            'pss_mb': round(fields.get('Pss', 0) / 1024, 1),
+            'shared_mb': round((fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)) / 1024, 1),
+            'private_mb': round((fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)) / 1024, 1),
+        }
+    return report
+
+class PreforkServer:
+    """Load the app (and its models) once in a master process, then fork workers that share them copy-on-write.
+
+    The master binds the socket, imports the app with torch limited to one thread (so no
+    OpenMP pool exists at fork time), freezes the GC so collections don't touch the shared
+    pages, and forks `num_workers` uvicorn servers on the inherited socket. Each worker is
+    pinned to its own slice of CPUs and sizes its torch thread pool to it. Dead workers
+    are replaced, SIGINT/SIGTERM shut every worker down.
+
+    Only the versions loaded at startup are shared. Every worker polls the registry (every
+    MODEL_POLL_INTERVAL seconds) and loads a new version on its own: the new weights are
+    private to each worker, and until all of them have polled, workers answer with different
+    versions. Restart the server to share a new version again, or set MODEL_POLL_INTERVAL=0
+    to keep the startup versions.
+    """
+    def __init__(self, host: str, port: int, num_workers: int, threads_per_worker: int = 0,
+                 cpu_pinning: bool = True, share_weights: bool = False):
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers
+        self.cpu_slices = cpu_slices(num_workers, threads_per_worker)
+        self.cpu_pinning = cpu_pinning and hasattr(os, 'sched_setaffinity')
+        self.share_weights = share_weights
+        self.workers = {}
+        self.stopping = False
+
+    def load_app(self):
+        if os.getenv("EXECUTOR_BACKEND", "thread") == "process":
+            raise RuntimeError('EXECUTOR_BACKEND=process is not supported by the pre-fork server, use thread or inline')
+        # The master builds the ONNX Runtime sessions, their thread pools don't survive fork
+        if os.getenv("INFERENCE_BACKEND", "eager") == "onnx":
+            raise RuntimeError('INFERENCE_BACKEND=onnx is not supported by the pre-fork server, use eager or a TorchScript export')
+        # Workers size torch to their CPU slice after fork, executor threads must not override it
+        os.environ["TORCH_NUM_THREADS"] = "0"
+        # Metrics of all workers are aggregated through files in this directory
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix='catdog_metrics_'))
+
+        import torch
+        torch.set_num_threads(1)
+        from main import app
+        from v1.routes.catdog_cls_router import pool
+
+        if self.share_weights:
+            for manager in pool.managers.values():
+                manager.get().loaded_model.share_memory()
+        if pool.poll_interval > 0:
+            LOGGER.log.info(f'Workers poll for new model versions every {pool.poll_interval}s, '
+                            f'a new version is loaded by every worker and not shared')
+        self.app = app
+
+    def bind(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(2048)
+        self.socket.set_inheritable(True)
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            return
+        # Worker process
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        import torch
+        cpus = self.cpu_slices[index]
+        if self.cpu_pinning:
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+
+        config = uvicorn.Config(self.app, lifespan='on', access_log=False)
+        server = uvicorn.Server(config)
+        exit_code = 0
+        try:
+            server.run(sockets=[self.socket])
+        except BaseException as e:
+            LOGGER.log.error(f'Worker {os.getpid()} failed: {e}')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def reap(self):
+        from prometheus_client import multiprocess
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index = self.workers.pop(pid, None)
+            multiprocess.mark_process_dead(pid)
+            if index is not None and not self.stopping:
+                LOGGER.log.error(f'Worker {pid} exited with status {status}, restarting')
+                self.spawn(index)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def report(self):
+        report = memory_report([os.getpid()] + list(self.workers))
+        for pid, memory in report.items():
+            role = 'master' if pid == os.getpid() else f'worker {self.workers[pid]} cpus {self.cpu_slices[self.workers[pid]]}'
+            LOGGER.log.info(f'{role} pid {pid}: ' + ' - '.join(f'{key}: {value}' for key, value in memory.items()),
+                            extra={'pid': pid, **memory})
+
+    def run(self):
+        self.load_app()
+        self.bind()
+        # Objects allocated so far are never collected, so GC passes don't write to the pages workers share
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(self.num_workers):
+            self.spawn(index)
+        LOGGER.log.info(f'Serving on {self.host}:{self.port} with {self.num_workers} workers')
+
+        reported = False
+        started_at = time.monotonic()
+        while self.workers:
+            time.sleep(0.5)
+            self.reap()
+            if not reported and time.monotonic() - started_at > 5:
+                self.report()
+                reported = True
+        self.socket.close()
+
 if __name__ == '__main__':
-    uvicorn.run('main:app', host='0.0.0.0', port=5000, reload=True)
\ No newline at end of file
+    if SERVER_WORKERS > 1 and not SERVER_RELOAD:
+        PreforkServer(SERVER_HOST, SERVER_PORT, SERVER_WORKERS, threads_per_worker=WORKER_THREADS,
+                      cpu_pinning=WORKER_CPU_PINNING, share_weights=SHARE_WEIGHTS).run()
+        sys.exit(0)
+    uvicorn.run('main:app', host=SERVER_HOST, port=SERVER_PORT, reload=SERVER_RELOAD)
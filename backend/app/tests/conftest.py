@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+# App root for `utils`/`benchmark`, v1 for `controllers`/`routes`/`main`
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'v1'))
+
+import os
+import pytest
+
+TEST_DIR = Path(__file__).parent
+MAX_UPLOAD_BYTES = 64 * 1024
+
+@pytest.fixture(scope='session')
+def dog_image():
+    return (TEST_DIR / 'dog_1.jpg').read_bytes()
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """The app serving a small stub model from a temporary artifact cache, MLflow is never reached."""
+    from benchmark import STUB_MODEL_NAME, STUB_MODEL_ALIAS, register_stub_model
+
+    tmp_dir = tmp_path_factory.mktemp('app')
+    # Set before the app is imported, the router reads its config from the environment at import time
+    os.environ.update({
+        'MODEL_NAME': STUB_MODEL_NAME,
+        'MODEL_ALIAS': STUB_MODEL_ALIAS,
+        'DEVICE': 'cpu',
+        'SERVING_MODELS': '',
+        'SHADOW_MODELS': '',
+        'CASCADE_MODELS': '',
+        'MLFLOW_TRACKING_URI': (tmp_dir / 'mlruns').as_uri(),
+        'MODEL_CACHE_DIR': str(tmp_dir / 'models'),
+        'MODEL_POLL_INTERVAL': '3600',
+        'MAX_UPLOAD_BYTES': str(MAX_UPLOAD_BYTES),
+        'PREDICTION_DB_PATH': str(tmp_dir / 'predicted_cache.db'),
+        'CAPTURE_DIR': str(tmp_dir / 'captured_data'),
+    })
+    (tmp_dir / 'captured_data').mkdir()
+    register_stub_model('mobilenet_v3_small', tmp_dir / 'models')
+
+    from main import app
+    return app
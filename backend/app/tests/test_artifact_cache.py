@@ -0,0 +1,51 @@
+import torch
+import pytest
+
+from controllers.artifact_cache import ArtifactCache
+
+METADATA = {'id2label': {'0': 'cat', '1': 'dog'}, 'image_size': 224}
+
+@pytest.fixture
+def cache(tmp_path):
+    return ArtifactCache(root=tmp_path)
+
+def test_put_get(cache):
+    model = torch.nn.Linear(4, 2).eval()
+    cache.put('resnet_18', '3', 'abc', model, METADATA)
+
+    metadata = cache.get_metadata('resnet_18', '3', 'abc')
+    assert metadata['id2label'] == METADATA['id2label']
+    assert metadata['weights_sha256'] == ArtifactCache._sha256(cache.entry_dir('resnet_18', '3', 'abc') / 'model.pt')
+
+    loaded = cache.load_model('resnet_18', '3', 'abc')
+    inputs = torch.randn(3, 4)
+    assert torch.equal(loaded(inputs), model(inputs))
+
+def test_put_leaves_no_temp_files(cache):
+    cache.put('resnet_18', '3', 'abc', torch.nn.Linear(4, 2), METADATA)
+    cache.put('resnet_18', '3', 'abc', torch.nn.Linear(4, 2), METADATA)
+    assert sorted(path.name for path in cache.entry_dir('resnet_18', '3', 'abc').iterdir()) == ['metadata.json', 'model.pt']
+
+def test_failed_put_cleans_up(cache, monkeypatch):
+    def broken_save(model, path):
+        open(path, 'wb').close()
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(torch, 'save', broken_save)
+    with pytest.raises(RuntimeError):
+        cache.put('resnet_18', '3', 'abc', torch.nn.Linear(4, 2), METADATA)
+    assert list(cache.entry_dir('resnet_18', '3', 'abc').iterdir()) == []
+
+def test_missing_entry(cache):
+    assert cache.get_metadata('resnet_18', '3', 'abc') is None
+
+def test_metadata_without_model_is_a_miss(cache):
+    cache.put('resnet_18', '3', 'abc', torch.nn.Linear(4, 2), METADATA)
+    (cache.entry_dir('resnet_18', '3', 'abc') / 'model.pt').unlink()
+    assert cache.get_metadata('resnet_18', '3', 'abc') is None
+
+def test_alias(cache):
+    assert cache.resolve_alias('resnet_18', 'Production') is None
+    cache.save_alias('resnet_18', 'Production', 3, 'abc')
+    assert cache.resolve_alias('resnet_18', 'Production') == {'version': '3', 'run_id': 'abc'}
+    cache.save_alias('resnet_18', 'Production', 4, 'def')
+    assert cache.resolve_alias('resnet_18', 'Production') == {'version': '4', 'run_id': 'def'}
@@ -0,0 +1,101 @@
+import asyncio
+import types
+import pytest
+
+from controllers import prediction_cache
+from controllers.prediction_cache import PredictionCache
+
+def get(cache, key, namespace=None):
+    return asyncio.run(cache.get(key, namespace))
+
+def flush(cache):
+    # The single writer thread runs jobs in submission order
+    cache.disk_writer.submit(lambda: None).result()
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+@pytest.fixture
+def disk_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(prediction_cache.AppPath, 'CACHE_DIR', tmp_path)
+    cache = PredictionCache(max_size=4, ttl=3600, use_disk=True)
+    yield cache
+    cache.disk_writer.shutdown()
+
+def test_lru_eviction():
+    cache = PredictionCache(max_size=2)
+    cache.set_namespace('resnet_18', 'Production', 1)
+    cache.put('a', {'id': 'a'})
+    cache.put('b', {'id': 'b'})
+    # Touching `a` makes `b` the least recently used entry
+    assert get(cache, 'a') == {'id': 'a'}
+    cache.put('c', {'id': 'c'})
+    assert get(cache, 'b') is None
+    assert get(cache, 'a') == {'id': 'a'}
+    assert get(cache, 'c') == {'id': 'c'}
+    assert cache.stats()['size'] == 2
+
+def test_ttl_expiry(clock):
+    cache = PredictionCache(max_size=4, ttl=10)
+    cache.set_namespace('resnet_18', 'Production', 1)
+    cache.put('a', {'id': 'a'})
+    clock[0] += 10
+    assert get(cache, 'a') == {'id': 'a'}
+    clock[0] += 1
+    assert get(cache, 'a') is None
+    assert 'a' not in cache.entries
+
+def test_disabled_cache():
+    cache = PredictionCache(max_size=0)
+    cache.set_namespace('resnet_18', 'Production', 1)
+    cache.put('a', {'id': 'a'})
+    assert get(cache, 'a') is None
+
+def test_namespace_switch_drops_entries():
+    cache = PredictionCache(max_size=4)
+    cache.set_namespace('resnet_18', 'Production', 1)
+    cache.put('a', {'id': 'a'})
+    # Setting the same namespace again keeps the entries
+    cache.set_namespace('resnet_18', 'Production', 1)
+    assert get(cache, 'a') == {'id': 'a'}
+    cache.set_namespace('resnet_18', 'Production', 2)
+    assert get(cache, 'a') is None
+
+def test_other_namespace_is_ignored():
+    cache = PredictionCache(max_size=4)
+    cache.set_namespace('resnet_18', 'Production', 2)
+    old = PredictionCache.namespace_of('resnet_18', 'Production', 1)
+    current = PredictionCache.namespace_of('resnet_18', 'Production', 2)
+    # A predictor still draining on the old version neither reads nor writes the new entries
+    cache.put('a', {'version': 1}, namespace=old)
+    assert get(cache, 'a', namespace=current) is None
+    cache.put('a', {'version': 2}, namespace=current)
+    assert get(cache, 'a', namespace=old) is None
+    assert get(cache, 'a', namespace=current) == {'version': 2}
+
+def test_disk_hit_after_memory_eviction(disk_cache):
+    disk_cache.set_namespace('resnet_18', 'Production', 1)
+    disk_cache.put('a', {'id': 'a'})
+    flush(disk_cache)
+    disk_cache.entries.clear()
+    assert get(disk_cache, 'a') == {'id': 'a'}
+    assert disk_cache.disk_hits == 1
+    # Read back into memory, the next lookup does not touch the disk
+    assert get(disk_cache, 'a') == {'id': 'a'}
+    assert disk_cache.hits == 1
+
+def test_disk_namespace_switch_removes_old_version(disk_cache, tmp_path):
+    disk_cache.set_namespace('resnet_18', 'Production', 1)
+    disk_cache.put('a', {'id': 'a'})
+    flush(disk_cache)
+    old_dir = disk_cache.disk_dir
+    assert (old_dir / 'a.json').exists()
+
+    disk_cache.set_namespace('resnet_18', 'Production', 2)
+    flush(disk_cache)
+    assert not old_dir.exists()
+    assert disk_cache.disk_dir.exists()
+    assert get(disk_cache, 'a') is None
@@ -0,0 +1,111 @@
+import io
+import json
+import zipfile
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import MAX_UPLOAD_BYTES
+
+PREFIX = '/v1/catdog_classification'
+
+@pytest.fixture(scope='module')
+def client(app):
+    # Entering the client runs the lifespan, which loads the stub model
+    with TestClient(app) as client:
+        yield client
+
+def test_predict(client, dog_image):
+    response = client.post(f'{PREFIX}/predict', files={'file_upload': ('dog_1.jpg', dog_image, 'image/jpeg')})
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body['probs']) == 2
+    assert body['predicted_class'] in ('cat', 'dog')
+    assert body['predicted_version'] == '1'
+
+def test_predict_invalid_image(client):
+    response = client.post(f'{PREFIX}/predict', files={'file_upload': ('broken.jpg', b'not an image', 'image/jpeg')})
+    assert response.status_code == 400
+
+def test_predict_unknown_model(client, dog_image):
+    response = client.post(f'{PREFIX}/predict', params={'model': 'missing:Production'},
+                           files={'file_upload': ('dog_1.jpg', dog_image, 'image/jpeg')})
+    assert response.status_code == 404
+
+def test_predict_raw(client, dog_image):
+    response = client.post(f'{PREFIX}/predict_raw', content=dog_image,
+                           headers={'content-type': 'application/octet-stream', 'x-image-name': '../../dog_1.jpg'})
+    assert response.status_code == 200
+    assert len(response.json()['probs']) == 2
+
+def test_predict_raw_top_k(client, dog_image):
+    response = client.post(f'{PREFIX}/predict_raw', params={'top_k': 1}, content=dog_image,
+                           headers={'content-type': 'application/octet-stream'})
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body['ids']) == len(body['probs']) == 1
+    assert body['version'] == '1'
+
+def test_predict_raw_wrong_content_type(client, dog_image):
+    response = client.post(f'{PREFIX}/predict_raw', content=dog_image, headers={'content-type': 'image/jpeg'})
+    assert response.status_code == 415
+
+def test_predict_raw_empty_body(client):
+    response = client.post(f'{PREFIX}/predict_raw', content=b'', headers={'content-type': 'application/octet-stream'})
+    assert response.status_code == 400
+
+def test_predict_raw_invalid_image(client):
+    response = client.post(f'{PREFIX}/predict_raw', content=b'not an image',
+                           headers={'content-type': 'application/octet-stream'})
+    assert response.status_code == 400
+
+def test_predict_raw_too_large(client):
+    response = client.post(f'{PREFIX}/predict_raw', content=b'\0' * (MAX_UPLOAD_BYTES + 1),
+                           headers={'content-type': 'application/octet-stream'})
+    assert response.status_code == 413
+
+def test_predict_raw_too_large_chunked(client):
+    # No content-length, the limit is enforced while the body is read
+    chunks = iter([b'\0' * MAX_UPLOAD_BYTES, b'\0'])
+    response = client.post(f'{PREFIX}/predict_raw', content=chunks, headers={'content-type': 'application/octet-stream'})
+    assert response.status_code == 413
+
+def test_predict_batch(client, dog_image):
+    files = [('files', ('dog_1.jpg', dog_image, 'image/jpeg')), ('files', ('broken.jpg', b'not an image', 'image/jpeg'))]
+    response = client.post(f'{PREFIX}/predict_batch', params={'stream': False}, files=files)
+    assert response.status_code == 200
+    good, bad = response.json()
+    assert len(good['probs']) == 2
+    assert bad['image_name'] == 'broken.jpg' and bad['error']
+
+def test_predict_batch_stream_archive(client, dog_image):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as f:
+        for i in range(3):
+            f.writestr(f'images/dog_{i}.jpg', dog_image)
+        f.writestr('notes.txt', 'skipped')
+    response = client.post(f'{PREFIX}/predict_batch', files={'archive': ('images.zip', archive.getvalue(), 'application/zip')})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert len(records) == 3
+    assert all(len(record['probs']) == 2 for record in records)
+
+def test_predict_batch_empty(client):
+    response = client.post(f'{PREFIX}/predict_batch')
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('name, expected', [
+    ('dog_1.jpg', 'dog_1.jpg'),
+    ('../../etc/passwd', 'passwd'),
+    ('..\\..\\evil.jpg', 'evil.jpg'),
+    ('/abs/path/cat.png', 'cat.png'),
+])
+def test_image_name_of(app, name, expected):
+    from v1.routes.catdog_cls_router import image_name_of
+    assert image_name_of(name) == expected
+
+@pytest.mark.parametrize('name', [None, '', '..', 'images/..'])
+def test_image_name_of_fallback(app, name):
+    from v1.routes.catdog_cls_router import image_name_of
+    image_name = image_name_of(name)
+    assert image_name.endswith('.jpg') and '/' not in image_name and image_name != '..'
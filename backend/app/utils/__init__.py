@@ -1,3 +1,5 @@
 from .utils import *
 from .app_path import AppPath
-from .logger import Logger
\ No newline at end of file
+from .logger import Logger
+from .writer import BackgroundWriter
+from .tracing import TRACER, Tracer
\ No newline at end of file
@@ -5,7 +5,9 @@ class AppPath:
     LOG_DIR = ROOT_DIR / 'logs'
     CACHE_DIR = ROOT_DIR / 'cache'
     CAPTURED_DATA_DIR = CACHE_DIR / 'captured_data'
+    MODEL_CACHE_DIR = CACHE_DIR / 'models'
     
 AppPath.LOG_DIR.mkdir(parents=True, exist_ok=True)
 AppPath.CACHE_DIR.mkdir(parents=True, exist_ok=True)
-AppPath.CAPTURED_DATA_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+AppPath.CAPTURED_DATA_DIR.mkdir(parents=True, exist_ok=True)
+AppPath.MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
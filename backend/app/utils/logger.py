@@ -2,46 +2,128 @@ import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).parent))
 
+import os
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import threading
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from .app_path import AppPath
 
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+# Attributes every LogRecord has, anything else was passed with `extra=` and goes into the JSON line
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class _DroppingQueueHandler(QueueHandler):
+    """Never block the caller, a full queue drops the record instead."""
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
 class Logger:
+    """Loggers write through a bounded queue, file/stdout I/O happens on one listener thread per destination.
+
+    A log call on the request path only formats the record and puts it on the queue.
+    Each destination (a file under logs/ or stdout) has a single handler shared by all
+    loggers writing to it, so creating a Logger twice does not duplicate lines.
+    """
+    _listeners = {}
+    _lock = threading.Lock()
+
     def __init__(self, log_name="", log_level=logging.INFO, log_file=None) -> None:
         self.log = logging.getLogger(log_name)
         self.get_logger(log_level, log_file)
-    
+
     def get_logger(self, log_level, log_file):
         self.log.setLevel(log_level)
         self._init_formatter()
+        if any(getattr(handler, 'log_destination', None) == log_file for handler in self.log.handlers):
+            return
         if log_file is None:
             self._add_stream_handler()
         else:
             self._add_file_handler(AppPath.LOG_DIR / log_file)
-            
+
     def _init_formatter(self):
-        self.formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-        
+        if LOG_FORMAT == 'json':
+            self.formatter = JsonFormatter()
+        else:
+            self.formatter = logging.Formatter(
+                "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+            )
+
     def _add_stream_handler(self):
         stream_handler = logging.StreamHandler(sys.stdout)
-        stream_handler.setFormatter(self.formatter)
-        self.log.addHandler(stream_handler)
-    
+        self._add_queue_handler(None, stream_handler)
+
     def _add_file_handler(self, log_file):
-        find_handler = RotatingFileHandler(log_file, maxBytes=10000, backupCount=10)
-        find_handler.setFormatter(self.formatter)
-        self.log.addHandler(find_handler)
-    
-    def save_requests(self, image, image_name):
-        path_save = f'{AppPath.CAPTURED_DATA_DIR}/{image_name}'
-        self.log.info(f'Save image to {path_save}')
-        image.save(path_save)
-        
+        find_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+        self._add_queue_handler(log_file.name, find_handler)
+
+    def _add_queue_handler(self, log_file, handler):
+        with Logger._lock:
+            if log_file not in Logger._listeners:
+                handler.setFormatter(self.formatter)
+                log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+                listener = QueueListener(log_queue, handler)
+                listener.start()
+                Logger._listeners[log_file] = (log_queue, listener, [])
+            log_queue, _, queue_handlers = Logger._listeners[log_file]
+            queue_handler = _DroppingQueueHandler(log_queue)
+            queue_handler.log_destination = log_file
+            queue_handlers.append(queue_handler)
+        self.log.addHandler(queue_handler)
+
+    @staticmethod
+    def stop():
+        """Flush and stop every listener thread, registered with atexit."""
+        with Logger._lock:
+            for _, listener, _ in Logger._listeners.values():
+                listener.stop()
+            Logger._listeners.clear()
+
+    @staticmethod
+    def _after_fork():
+        # Listener threads don't survive fork, and the parent may have held a queue lock while forking
+        Logger._lock = threading.Lock()
+        for log_file, (_, listener, queue_handlers) in Logger._listeners.items():
+            log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+            for queue_handler in queue_handlers:
+                queue_handler.queue = log_queue
+            listener.queue = log_queue
+            listener._thread = None
+            listener.start()
+            Logger._listeners[log_file] = (log_queue, listener, queue_handlers)
+
     def log_model(self, predictor_name, predictor_alias):
-        self.log.info(f'Predictor name: {predictor_name} - Predictor alias: {predictor_alias}')
-    
+        self.log.info(f'Predictor name: {predictor_name} - Predictor alias: {predictor_alias}',
+                      extra={'predicted_name': predictor_name, 'predicted_alias': predictor_alias})
+
     def log_response(self, pred_prob, pred_id, pred_class):
-        self.log.info(f'Predicted prob: {pred_prob} - Predicted ID: {pred_id} - Predicted class: {pred_class}')
-        
\ No newline at end of file
+        self.log.info(f'Predicted prob: {pred_prob} - Predicted ID: {pred_id} - Predicted class: {pred_class}',
+                      extra={'best_prob': pred_prob, 'predicted_id': pred_id, 'predicted_class': pred_class})
+
+atexit.register(Logger.stop)
+os.register_at_fork(after_in_child=Logger._after_fork)
@@ -0,0 +1,39 @@
+import os
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+from .tracing import TRACER
+
+MODEL_LABELS = ['model', 'alias', 'version']
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram('catdog_http_request_duration_seconds', 'HTTP request latency',
+                            ['method', 'path', 'status'], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('catdog_predictor_stage_duration_seconds', 'Latency of a Predictor stage (decode, transform, inference, softmax, persistence)',
+                          ['stage'] + MODEL_LABELS, buckets=LATENCY_BUCKETS)
+BATCH_SIZE = Histogram('catdog_predictor_batch_size', 'Images per forward pass',
+                       MODEL_LABELS, buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+# Gauges are summed over live workers when served by the pre-fork server
+QUEUE_DEPTH = Gauge('catdog_predictor_queue_depth', 'Images waiting for the batching engine', MODEL_LABELS,
+                    multiprocess_mode='livesum')
+INFLIGHT = Gauge('catdog_predictor_inflight', 'Requests being served by a predictor', MODEL_LABELS,
+                 multiprocess_mode='livesum')
+CACHE_REQUESTS = Counter('catdog_prediction_cache_requests', 'Prediction cache lookups', MODEL_LABELS + ['result'])
+PREDICTIONS = Counter('catdog_predictions', 'Predictions by predicted class', MODEL_LABELS + ['predicted_class'])
+CASCADE_DECISIONS = Counter('catdog_cascade_decisions', 'Cascade stage outcomes: accepted, escalated, or skipped because the next stage was busy',
+                            ['stage'] + MODEL_LABELS + ['result'])
+MODEL_INFO = Gauge('catdog_model_info', 'Loaded predictors per model version', MODEL_LABELS,
+                   multiprocess_mode='livesum')
+
+def observe_span(name, seconds, attributes):
+    STAGE_LATENCY.labels(name, attributes.get('model', ''), attributes.get('alias', ''), attributes.get('version', '')).observe(seconds)
+
+TRACER.add_hook(observe_span)
+
+def render_metrics():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # Pre-fork workers each write their samples to PROMETHEUS_MULTIPROC_DIR, any worker can aggregate them
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,36 @@
+import time
+from contextlib import contextmanager
+
+class Tracer:
+    """Lightweight span tracing around serving stages.
+
+    `with TRACER.span('decode', model=..., version=...)` times the block and passes
+    (name, seconds, attributes) to every registered hook, e.g. the Prometheus stage
+    histograms or an exporter to a tracing backend. Without hooks a span costs a
+    context manager entry and nothing else.
+    """
+    def __init__(self):
+        self.hooks = []
+
+    def add_hook(self, hook):
+        if hook not in self.hooks:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        if not self.hooks:
+            yield
+            return
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            for hook in self.hooks:
+                hook(name, duration, attributes)
+
+TRACER = Tracer()
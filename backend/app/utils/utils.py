@@ -1,10 +1,21 @@
 import os
-from .app_path import AppPath
+import tarfile
+import zipfile
 
-def save_cache(image_name, image_path, predicted_name, predicted_alias, probs, best_prob, pred_id, pred_class):
-    cache_path = f'{AppPath.CACHE_DIR}/predicted_cache.csv'
-    cache_exists = os.path.isfile(cache_path)
-    with open(cache_path, 'a') as f:
-        if not cache_exists:
-            f.write('Image_name, Image_path, Predicted_name, Predicted_alias, Probs, Best_prob, Predicted_id, Predicted_class\n')
-        f.write(f'{image_name},{image_path},{predicted_name},{predicted_alias},{probs},{best_prob},{pred_id},{pred_class}\n')
\ No newline at end of file
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+def read_archive(fileobj, archive_name):
+    """Read all images of a zip or tar(.gz/.bz2/.xz) archive as a list of (image_bytes, image_name)."""
+    images = []
+    if archive_name.lower().endswith('.zip'):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    images.append((archive.read(info), os.path.basename(info.filename)))
+    else:
+        # Stream mode reads members sequentially, no seeking over the upload
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    images.append((archive.extractfile(member).read(), os.path.basename(member.name)))
+    return images
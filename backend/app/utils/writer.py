@@ -0,0 +1,128 @@
+import os
+import time
+import queue
+import random
+import sqlite3
+import threading
+
+from .app_path import AppPath
+from .logger import Logger
+
+LOGGER = Logger(__file__, log_file='writer.log')
+
+class BackgroundWriter:
+    """Persist captured uploads and prediction rows from a background thread.
+
+    Captured images are written as the original uploaded bytes. Prediction rows are
+    buffered and flushed in batches to a SQLite table. Both queues are bounded and
+    full queues drop new items instead of blocking the request path.
+    """
+    COLUMNS = ['image_name', 'image_path', 'predicted_name', 'predicted_alias', 'probs', 'best_prob', 'predicted_id', 'predicted_class']
+
+    def __init__(self, db_path=AppPath.CACHE_DIR / 'predicted_cache.db', capture_dir=AppPath.CAPTURED_DATA_DIR,
+                 sample_rate: float = 1.0, max_queue_size: int = 1024, flush_rows: int = 256, flush_interval: float = 1.0):
+        self.db_path = db_path
+        self.capture_dir = capture_dir
+        self.sample_rate = sample_rate
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.captures = queue.Queue(maxsize=max_queue_size)
+        self.rows = queue.Queue(maxsize=max_queue_size * 4)
+        self.dropped_captures = 0
+        self.dropped_rows = 0
+        self.written_captures = 0
+        self.written_rows = 0
+        self.start()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def start(self):
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='background_writer', daemon=True)
+        self.thread.start()
+
+    def _after_fork(self):
+        # A forked worker gets fresh queues (the parent may have held their locks) and its own writer thread
+        self.captures = queue.Queue(maxsize=self.captures.maxsize)
+        self.rows = queue.Queue(maxsize=self.rows.maxsize)
+        self.start()
+
+    def capture(self, image, image_name):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        try:
+            self.captures.put_nowait((image, image_name))
+        except queue.Full:
+            self.dropped_captures += 1
+
+    def log_prediction(self, **row):
+        try:
+            self.rows.put_nowait(tuple(str(row[column]) for column in self.COLUMNS))
+        except queue.Full:
+            self.dropped_rows += 1
+
+    def close(self, timeout: float = 5.0):
+        self.stopped.set()
+        self.thread.join(timeout=timeout)
+
+    def stats(self):
+        return {
+            'capture_queue': self.captures.qsize(),
+            'row_queue': self.rows.qsize(),
+            'written_captures': self.written_captures,
+            'written_rows': self.written_rows,
+            'dropped_captures': self.dropped_captures,
+            'dropped_rows': self.dropped_rows,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'CREATE TABLE IF NOT EXISTS predictions (created_at REAL, {", ".join(self.COLUMNS)})')
+        return conn
+
+    def _write_captures(self, max_items):
+        for _ in range(max_items):
+            try:
+                image, image_name = self.captures.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with open(self.capture_dir / image_name, 'wb') as f:
+                    f.write(image)
+                self.written_captures += 1
+            except OSError as e:
+                LOGGER.log.error(f'Save capture {image_name} failed: {e}')
+
+    def _flush(self, conn, rows):
+        now = time.time()
+        placeholders = ', '.join(['?'] * (len(self.COLUMNS) + 1))
+        try:
+            with conn:
+                conn.executemany(f'INSERT INTO predictions VALUES ({placeholders})', [(now, *row) for row in rows])
+            self.written_rows += len(rows)
+        except sqlite3.Error as e:
+            LOGGER.log.error(f'Flush {len(rows)} rows failed: {e}')
+
+    def _run(self):
+        conn = self._connect()
+        rows = []
+        last_flush = time.monotonic()
+        while True:
+            stopping = self.stopped.is_set()
+            try:
+                rows.append(self.rows.get(timeout=0.05))
+                while len(rows) < self.flush_rows:
+                    rows.append(self.rows.get_nowait())
+            except queue.Empty:
+                pass
+
+            self._write_captures(max_items=self.captures.qsize() if stopping else 32)
+
+            if rows and (len(rows) >= self.flush_rows or time.monotonic() - last_flush >= self.flush_interval or stopping):
+                self._flush(conn, rows)
+                rows = []
+                last_flush = time.monotonic()
+
+            if stopping and self.rows.empty() and self.captures.empty() and not rows:
+                break
+        conn.close()
@@ -1 +1,5 @@
-from .catdog_predictor import Predictor
\ No newline at end of file
+from .catdog_predictor import Predictor
+from .executor import InferenceExecutor, ServerBusyError, ModelClosedError
+from .prediction_cache import PredictionCache
+from .model_manager import ModelManager
+from .model_pool import ModelPool, parse_model_specs
\ No newline at end of file
@@ -0,0 +1,95 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import os
+import json
+import hashlib
+import tempfile
+
+import torch
+
+from utils import AppPath, Logger
+
+LOGGER = Logger(__file__, log_file='artifact_cache.log')
+
+class ArtifactCache:
+    """Local copy of registered models so the server can start without the tracking server.
+
+    Layout under `cache/models`:
+        <model_name>/<version>-<run_id>/model.pt       full pickled module, loaded with mmap
+        <model_name>/<version>-<run_id>/metadata.json  id2label/label2id/mean/std/image_size + weights sha256
+        <model_name>/aliases/<alias>.json              last resolved version/run_id of an alias
+    """
+    def __init__(self, root=None):
+        # MODEL_CACHE_DIR moves the cache, e.g. benchmarks keep their stub models out of the real one
+        self.root = Path(root or os.getenv('MODEL_CACHE_DIR') or AppPath.MODEL_CACHE_DIR)
+
+    def entry_dir(self, model_name, version, run_id):
+        return self.root / model_name / f'{version}-{run_id}'
+
+    def resolve_alias(self, model_name, alias):
+        path = self.root / model_name / 'aliases' / f'{alias}.json'
+        if not path.exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_alias(self, model_name, alias, version, run_id):
+        path = self.root / model_name / 'aliases' / f'{alias}.json'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._atomic_write(path, json.dumps({'version': str(version), 'run_id': run_id}).encode())
+
+    def get_metadata(self, model_name, version, run_id):
+        path = self.entry_dir(model_name, version, run_id) / 'metadata.json'
+        if not path.exists() or not (path.parent / 'model.pt').exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def load_model(self, model_name, version, run_id, device: str = 'cpu'):
+        path = self.entry_dir(model_name, version, run_id) / 'model.pt'
+        # mmap keeps weights in the page cache instead of copying them onto the heap
+        return torch.load(path, map_location=device, mmap=True, weights_only=False)
+
+    def put(self, model_name, version, run_id, model, metadata):
+        entry_dir = self.entry_dir(model_name, version, run_id)
+        entry_dir.mkdir(parents=True, exist_ok=True)
+
+        # Pre-fork workers can cache the same version at once, each writes its own temp file
+        tmp_path = self._tmp_path(entry_dir / 'model.pt')
+        try:
+            torch.save(model, tmp_path)
+            metadata = {**metadata, 'weights_sha256': self._sha256(tmp_path)}
+            os.replace(tmp_path, entry_dir / 'model.pt')
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self._atomic_write(entry_dir / 'metadata.json', json.dumps(metadata, indent=4).encode())
+        LOGGER.log.info(f'Cached {model_name} version {version} to {entry_dir}')
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _tmp_path(path):
+        """Unique temp file next to `path`, so the final os.replace stays on one filesystem."""
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'{path.name}.', suffix='.tmp')
+        os.close(fd)
+        return Path(tmp_path)
+
+    @classmethod
+    def _atomic_write(cls, path, data):
+        tmp_path = cls._tmp_path(path)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
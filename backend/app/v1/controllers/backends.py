@@ -0,0 +1,134 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import os
+import copy
+import contextlib
+
+import torch
+import mlflow
+
+from utils import AppPath, Logger
+
+LOGGER = Logger(__file__, log_file='backends.log')
+
+# Must match src/model/export.py, which logs these artifacts at registration time
+EXPORT_ARTIFACT_DIR = 'export'
+EXPORT_FILES = {
+    'torchscript': 'model.torchscript.pt',
+    'onnx': 'model.onnx',
+    'quantized_dynamic': 'model.quantized_dynamic.pt',
+    'quantized_static': 'model.quantized_static.pt',
+}
+
+def enable_compile_cache():
+    # Inductor reuses compiled graphs from this directory across restarts (cache/ is a mounted volume)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(AppPath.CACHE_DIR / 'torch_compile'))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+class EagerBackend:
+    name = 'eager'
+
+    def __init__(self, model, device: str = 'cpu', autocast_bf16: bool = False, channels_last: bool = False,
+                 compile: bool = False, inference_mode: bool = True):
+        self.model = model.eval()
+        self.device = device
+        self.autocast_bf16 = autocast_bf16
+        self.channels_last = channels_last
+        self.inference_mode = inference_mode
+        if channels_last and isinstance(self.model, torch.nn.Module):
+            # Module.to converts in place, the eager reference and other backends share `model`
+            self.model = copy.deepcopy(self.model).to(memory_format=torch.channels_last)
+        if compile:
+            enable_compile_cache()
+            self.model = torch.compile(self.model)
+
+    def options(self):
+        return {'autocast_bf16': self.autocast_bf16, 'channels_last': self.channels_last, 'inference_mode': self.inference_mode}
+
+    def __call__(self, input):
+        input = input.to(self.device)
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+        grad_mode = torch.inference_mode() if self.inference_mode else torch.no_grad()
+        autocast = torch.autocast(device_type=self.device.split(':')[0], dtype=torch.bfloat16) if self.autocast_bf16 else contextlib.nullcontext()
+        with grad_mode, autocast:
+            return self.model(input).float().cpu()
+
+class TorchScriptBackend(EagerBackend):
+    def __init__(self, path, name: str = 'torchscript', device: str = 'cpu', **options):
+        self.name = name
+        # torch.compile doesn't apply to scripted modules
+        options.pop('compile', None)
+        super().__init__(torch.jit.load(path, map_location=device), device=device, **options)
+
+class OnnxBackend:
+    name = 'onnx'
+
+    def __init__(self, path, device: str = 'cpu'):
+        import onnxruntime as ort
+
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if device == 'cuda' else ['CPUExecutionProvider']
+        self.session = ort.InferenceSession(path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input):
+        output = self.session.run(None, {self.input_name: input.cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+def download_export(run_id, backend_name):
+    return mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=f'{EXPORT_ARTIFACT_DIR}/{EXPORT_FILES[backend_name]}')
+
+def check_parity(backend, reference, img_size: int, batch_size: int = 4, atol: float = 1e-3, prob_atol: float = 0.05):
+    """Compare backend outputs against the eager reference on random inputs.
+
+    Quantized and bfloat16 backends can't match fp32 logits closely, their class probabilities
+    only need to be within `prob_atol`. Random inputs give near-tied logits, so the predicted
+    class itself may flip and is only logged.
+    """
+    input = torch.randn(batch_size, 3, img_size, img_size)
+    expected = reference(input)
+    actual = backend(input)
+
+    max_diff = (expected - actual).abs().max().item()
+    max_prob_diff = (expected.softmax(dim=1) - actual.softmax(dim=1)).abs().max().item()
+    agreement = (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean().item()
+    LOGGER.log.info(f'Parity {backend.name}: max abs diff {max_diff:.6f} - max prob diff {max_prob_diff:.6f} - '
+                    f'argmax agreement {agreement:.4f}')
+    if backend.name.startswith('quantized') or getattr(backend, 'autocast_bf16', False):
+        return max_prob_diff <= prob_atol
+    return max_diff <= atol
+
+def create_backend(backend_name, eager_model, run_id, img_size: int, device: str = 'cpu', options: dict = None):
+    """Build the requested backend, falling back to eager if it can't be loaded or fails the parity check.
+
+    `options` are the autocast_bf16/channels_last/compile/inference_mode flags of EagerBackend.
+    """
+    options = options or {}
+    eager = EagerBackend(eager_model, device=device)
+    if backend_name == 'eager' and not any(options.get(flag) for flag in ('autocast_bf16', 'channels_last', 'compile')):
+        return EagerBackend(eager_model, device=device, inference_mode=options.get('inference_mode', True))
+
+    try:
+        if backend_name == 'eager':
+            backend = EagerBackend(eager_model, device=device, **options)
+        elif backend_name not in EXPORT_FILES:
+            raise ValueError(f'Invalid inference backend: {backend_name}. [eager, {", ".join(EXPORT_FILES)}]')
+        elif backend_name == 'onnx':
+            backend = OnnxBackend(download_export(run_id, backend_name), device=device)
+        else:
+            # Quantized kernels only run on CPU
+            backend_device = 'cpu' if backend_name.startswith('quantized') else device
+            backend = TorchScriptBackend(download_export(run_id, backend_name), name=backend_name, device=backend_device, **options)
+
+        if not check_parity(backend, eager, img_size):
+            raise ValueError(f'{backend_name} outputs do not match eager model')
+    except Exception as e:
+        LOGGER.log.error(f'Load backend {backend_name} failed, fall back to eager')
+        LOGGER.log.error(f'ERROR: {e}')
+        return eager
+
+    LOGGER.log.info(f'Inference backend: {backend_name} - options: {options}')
+    return backend
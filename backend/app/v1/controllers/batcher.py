@@ -0,0 +1,143 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import time
+import asyncio
+
+import torch
+
+from utils import Logger
+from .executor import ModelClosedError
+
+LOGGER = Logger(__file__, log_file='batcher.log')
+
+class BatchStats:
+    def __init__(self):
+        self.num_batches = 0
+        self.num_items = 0
+        self.max_batch_size = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.batch_size_hist = {}
+
+    def update(self, batch_size, queue_waits):
+        self.num_batches += 1
+        self.num_items += batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.batch_size_hist[batch_size] = self.batch_size_hist.get(batch_size, 0) + 1
+        self.total_queue_wait += sum(queue_waits)
+        self.max_queue_wait = max(self.max_queue_wait, max(queue_waits))
+
+    def to_dict(self):
+        return {
+            'num_batches': self.num_batches,
+            'num_items': self.num_items,
+            'avg_batch_size': round(self.num_items / self.num_batches, 4) if self.num_batches else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'batch_size_hist': dict(sorted(self.batch_size_hist.items())),
+            'avg_queue_wait_ms': round(1000 * self.total_queue_wait / self.num_items, 4) if self.num_items else 0.0,
+            'max_queue_wait_ms': round(1000 * self.max_queue_wait, 4),
+        }
+
+class BatchingEngine:
+    """Collect single-image requests into micro-batches for one forward pass.
+
+    A batch is run as soon as `max_batch_size` tensors are queued or the oldest
+    queued tensor has waited `max_wait_ms`, whichever comes first. `depth_gauge` follows
+    the number of queued tensors. Once stopped, queued requests fail with ModelClosedError
+    and so does every later `submit`.
+    """
+    def __init__(self, infer_fn, max_batch_size: int = 8, max_wait_ms: float = 5.0, depth_gauge=None):
+        self.infer_fn = infer_fn
+        self.depth_gauge = depth_gauge
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.stats = BatchStats()
+        self.queue = None
+        self.worker = None
+        # Items taken off the queue and not answered yet
+        self.batch = []
+        self.stopped = False
+
+    def start(self):
+        if self.stopped:
+            raise ModelClosedError('Batching engine is stopped')
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self._run())
+            LOGGER.log.info(f'Batching engine started - max_batch_size: {self.max_batch_size} - max_wait_ms: {self.max_wait * 1000}')
+
+    async def stop(self):
+        self.stopped = True
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        # Fail whatever is left instead of leaving its requests waiting forever
+        pending = [item[1] for item in self.batch]
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait()[1])
+        self.batch = []
+        for future in pending:
+            if not future.done():
+                future.set_exception(ModelClosedError('Batching engine stopped before the request was served'))
+            # Whatever was still queued is dropped with the worker
+            if self.depth_gauge is not None:
+                self.depth_gauge.set(0)
+
+    async def submit(self, tensor):
+        """Queue a single CHW tensor and wait for its row of the batch output."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tensor, future, time.perf_counter()))
+        if self.depth_gauge is not None:
+            self.depth_gauge.inc()
+        return await future
+
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def _collect(self):
+        self.batch = items = [await self.queue.get()]
+        deadline = items[0][2] + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        # Drain whatever is already waiting without paying for another timeout
+        while len(items) < self.max_batch_size and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    async def _run(self):
+        while True:
+            items = await self._collect()
+            if self.depth_gauge is not None:
+                self.depth_gauge.dec(len(items))
+            start_time = time.perf_counter()
+            tensors = [item[0] for item in items]
+            futures = [item[1] for item in items]
+            self.stats.update(len(items), [start_time - item[2] for item in items])
+
+            try:
+                output = await self.infer_fn(torch.stack(tensors))
+            except Exception as e:
+                LOGGER.log.error(f'Batch inference failed: {e}')
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                self.batch = []
+                continue
+
+            for i, future in enumerate(futures):
+                if not future.done():
+                    future.set_result(output[i:i+1])
+            self.batch = []
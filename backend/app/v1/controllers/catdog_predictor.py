@@ -4,16 +4,23 @@ sys.path.append(str(Path(__file__).parent.parent.parent))
 
 import os
 import ast
-from PIL import Image
+import time
+import asyncio
 
 import torch
 import torch.nn.functional as F
-from torchvision import transforms
 
 import mlflow
 from mlflow.tracking import MlflowClient
 
-from utils import AppPath, Logger, save_cache
+from utils import Logger, BackgroundWriter, TRACER
+from utils.metrics import BATCH_SIZE, CACHE_REQUESTS, PREDICTIONS, MODEL_INFO, QUEUE_DEPTH, INFLIGHT
+from .batcher import BatchingEngine
+from .executor import InferenceExecutor, ServerBusyError, ModelClosedError
+from .prediction_cache import PredictionCache
+from .backends import create_backend
+from .preprocessing import Preprocessor, is_tensor_payload
+from .artifact_cache import ArtifactCache
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -22,85 +29,314 @@ LOGGER = Logger(__file__, log_file='predictor.log')
 LOGGER.log.info('Starting Model Serving')
 
 class Predictor:
-    def __init__(self, model_name: str, model_alias: str, device: str = 'cpu'):
+    def __init__(self, model_name: str, model_alias: str, device: str = 'cpu',
+                 max_batch_size: int = 8, max_wait_ms: float = 5.0,
+                 executor: InferenceExecutor = None, max_inflight: int = 64,
+                 cache: PredictionCache = None, writer: BackgroundWriter = None,
+                 backend: str = 'eager', decoder: str = 'pil', model_version: str = None,
+                 backend_options: dict = None):
         self.model_name = model_name
         self.model_alias = model_alias
         self.device = device
-        self.load_model()
-        self.create_transform()
-        
-    async def predict(self, image, image_name):
-        pil_img = Image.open(image)
-        LOGGER.save_requests(pil_img, image_name)
-        
-        if pil_img.mode == 'RGBA':
-            pil_img = pil_img.convert('RGB')
-        
-        transformed_img = self.transforms_(pil_img).unsqueeze(0)
-        output = await self.model_inference(transformed_img)
-        probs, best_prob, pred_id, pred_class = self.output2pred(output)
-        
-        LOGGER.log_model(self.model_name, self.model_alias)
-        LOGGER.log_response(best_prob, pred_id, pred_class)
-        
-        torch.cuda.empty_cache()
-        save_cache(
-            image_name=image_name,
-            image_path=AppPath.CAPTURED_DATA_DIR,
-            predicted_name=self.model_name,
-            predicted_alias=self.model_alias,
-            probs=probs,
-            best_prob=best_prob,
-            pred_id=pred_id,
-            pred_class=pred_class
-        )
+        self.model_version = model_version
+        self.startup_timings = {}
+        self.executor = executor if executor is not None else InferenceExecutor(backend='inline')
+        # With the process executor the replicas live in the worker processes, the parent only needs the metadata
+        self.load_model(load_weights=self.executor.backend != 'process')
+        # Attached to every span and metric of this predictor
+        self.labels = {'model': self.model_name, 'alias': self.model_alias, 'version': str(self.model_version)}
+        MODEL_INFO.labels(**self.labels).inc()
+        self.backend_name = backend
+        self.backend_options = backend_options or {}
+        self.backend = None
+        if self.loaded_model is not None:
+            self.backend = create_backend(backend, self.loaded_model, self.run_id, self.img_size, device=self.device,
+                                          options=self.backend_options)
+        self.cache = cache if cache is not None else PredictionCache(max_size=0)
+        # The shared cache switches to this version only once it is activated, see activate()
+        self.cache_namespace = PredictionCache.namespace_of(self.model_name, self.model_alias, self.model_version)
+        self.writer = writer
+        self.create_transform(decoder)
+        # Gauges are updated on the request path, with pre-fork workers a scrape only reaches one of them
+        self.batcher = BatchingEngine(self.model_inference, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                                      depth_gauge=QUEUE_DEPTH.labels(**self.labels))
+        self.inflight_gauge = INFLIGHT.labels(**self.labels)
+        self.executor.bind(self)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.closed = False
         
+    def is_busy(self):
+        return self.inflight >= self.max_inflight
+    
+    def activate(self):
+        """Point the shared prediction cache at this version, called on the event loop when it starts serving."""
+        self.cache.set_namespace(self.model_name, self.model_alias, self.model_version)
+    
+    def acquire(self):
+        """Take an in-flight slot, raises ServerBusyError when none is left and ModelClosedError once closed."""
+        if self.closed:
+            raise ModelClosedError(f'{self.model_name} version {self.model_version} is closed')
+        if self.is_busy():
+            raise ServerBusyError(f'Too many in-flight requests: {self.inflight}')
+        self.inflight += 1
+        self.inflight_gauge.inc()
+    
+    def release(self):
+        self.inflight -= 1
+        self.inflight_gauge.dec()
+    
+    async def predict(self, image, image_name, capture: bool = True, reserved: bool = False, persist: bool = True):
+        """Predict one image, with `reserved` the caller already holds the in-flight slot and releases it.
+        
+        With `persist=False` the prediction row is not written, the caller decides with `record`.
+        """
+        if reserved:
+            return await self._predict(image, image_name, capture=capture, persist=persist)
+        self.acquire()
+        try:
+            return await self._predict(image, image_name, capture=capture, persist=persist)
+        finally:
+            self.release()
+    
+    async def _predict(self, image, image_name, capture: bool = True, persist: bool = True):
+        key = self.cache.key(image)
+        response = await self.cache.get(key, self.cache_namespace)
+        CACHE_REQUESTS.labels(**self.labels, result='miss' if response is None else 'hit').inc()
+        if response is not None:
+            return response
+        
+        # Pre-decoded tensor payloads are not images, they are left out of the captured data
+        if capture and self.writer is not None and not is_tensor_payload(image):
+            with TRACER.span('capture', **self.labels):
+                self.writer.capture(image, image_name)
+        transformed_img = await self.executor.submit('preprocess', image, image_name)
+        output = await self.batcher.submit(transformed_img)
+        response = self.build_response(output, image_name)
+        if persist:
+            self.record(response, image_name)
+        self.cache.put(key, response, self.cache_namespace)
+        return response
+    
+    async def predict_batch(self, images, chunk_size: int = 32, reserved: bool = False,
+                            capture: bool = True, persist: bool = True):
+        """Predict a list of (image_bytes, image_name), yielding one chunk of responses at a time.
+        
+        An image that fails to decode gets an {'image_name', 'error'} record instead of failing
+        its chunk. With `reserved` the caller already holds the in-flight slot and releases it,
+        `capture` and `persist` are the same as in `predict`.
+        """
+        if not reserved:
+            self.acquire()
+        try:
+            for i in range(0, len(images), chunk_size):
+                chunk = images[i:i+chunk_size]
+                keys = [self.cache.key(image) for image, _ in chunk]
+                responses = list(await asyncio.gather(*[self.cache.get(key, self.cache_namespace) for key in keys]))
+                missed = [j for j, response in enumerate(responses) if response is None]
+                CACHE_REQUESTS.labels(**self.labels, result='hit').inc(len(chunk) - len(missed))
+                CACHE_REQUESTS.labels(**self.labels, result='miss').inc(len(missed))
+                
+                if missed:
+                    if capture and self.writer is not None:
+                        with TRACER.span('capture', **self.labels):
+                            for j in missed:
+                                if not is_tensor_payload(chunk[j][0]):
+                                    self.writer.capture(*chunk[j])
+                    transformed_imgs = await asyncio.gather(*[
+                        self.executor.submit('preprocess', *chunk[j]) for j in missed
+                    ], return_exceptions=True)
+                    decoded = []
+                    for j, transformed_img in zip(missed, transformed_imgs):
+                        if isinstance(transformed_img, (ValueError, OSError)):
+                            responses[j] = {'image_name': chunk[j][1], 'error': f'Invalid image payload: {transformed_img}'}
+                        elif isinstance(transformed_img, BaseException):
+                            raise transformed_img
+                        else:
+                            decoded.append((j, transformed_img))
+                    if decoded:
+                        output = await self.model_inference(torch.stack([transformed_img for _, transformed_img in decoded]))
+                        for k, (j, _) in enumerate(decoded):
+                            responses[j] = self.build_response(output[k:k+1], chunk[j][1])
+                            if persist:
+                                self.record(responses[j], chunk[j][1])
+                            self.cache.put(keys[j], responses[j], self.cache_namespace)
+                yield responses
+        finally:
+            if not reserved:
+                self.release()
+    
+    def build_response(self, output, image_name):
+        with TRACER.span('softmax', **self.labels):
+            probs, best_prob, pred_id, pred_class = self.output2pred(output)
+        PREDICTIONS.labels(**self.labels, predicted_class=pred_class).inc()
         return {
             'probs': probs,
             'best_prob': best_prob,
             'predicted_id': pred_id,
             'predicted_class': pred_class,
-            'predictor_name': self.model_name,
-            'predictor_alias': self.model_alias
+            'predicted_name': self.model_name,
+            'predicted_alias': self.model_alias,
+            'predicted_version': str(self.model_version)
         }
         
-    def create_transform(self):
-        self.transforms_ = transforms.Compose([
-            transforms.Resize((self.img_size, self.img_size)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=self.mean, std=self.std)
-        ])
+    def record(self, response, image_name):
+        """Log a response and write its prediction row."""
+        with TRACER.span('persistence', **self.labels):
+            LOGGER.log_model(self.model_name, self.model_alias)
+            LOGGER.log_response(response['best_prob'], response['predicted_id'], response['predicted_class'])
+            
+            if self.writer is not None:
+                self.writer.log_prediction(
+                    image_name=image_name,
+                    image_path=self.writer.capture_dir,
+                    predicted_name=self.model_name,
+                    predicted_alias=self.model_alias,
+                    probs=response['probs'],
+                    best_prob=response['best_prob'],
+                    predicted_id=response['predicted_id'],
+                    predicted_class=response['predicted_class']
+                )
+    
+    def preprocess(self, image, image_name):
+        with TRACER.span('decode', **self.labels):
+            pixels = self.preprocessor.load(image)
+        with TRACER.span('transform', **self.labels):
+            return self.preprocessor.resize(pixels)
+        
+    def create_transform(self, decoder: str = 'pil'):
+        self.preprocessor = Preprocessor(self.img_size, self.mean, self.std, decoder=decoder)
+        if not self.preprocessor.validate():
+            LOGGER.log.error(f'Preprocessing {decoder} does not match reference transform, fall back to reference')
+            self.preprocessor = Preprocessor(self.img_size, self.mean, self.std, decoder='reference')
         
     async def model_inference(self, input):
-        input = input.to(self.device)
-        with torch.no_grad():
-            output = self.loaded_model(input).cpu()
-        return output
+        BATCH_SIZE.labels(**self.labels).observe(input.shape[0])
+        return await self.executor.submit('forward', input)
     
-    def load_model(self):
+    def forward(self, input):
+        with TRACER.span('inference', batch_size=input.shape[0], **self.labels):
+            return self.backend(self.preprocessor.normalize(input))
+    
+    def warmup(self, num_batches: int = 2):
+        start_time = time.perf_counter()
+        if self.loaded_model is None:
+            self.executor.warmup(num_batches)
+        else:
+            batch = torch.zeros(self.batcher.max_batch_size, 3, self.img_size, self.img_size, dtype=torch.uint8)
+            for _ in range(num_batches):
+                self.forward(batch)
+        self.startup_timings['warmup'] = time.perf_counter() - start_time
+        LOGGER.log.info(f'Warmed up {self.model_name} version {self.model_version} with {num_batches} batches')
+        LOGGER.log.info('Startup timings: ' + ' - '.join(f'{phase}: {seconds:.3f}s' for phase, seconds in self.startup_timings.items()))
+    
+    def memory_bytes(self):
+        if self.loaded_model is None:
+            return self.executor.memory_bytes()
+        tensors = list(self.loaded_model.parameters()) + list(self.loaded_model.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    
+    async def close(self):
+        self.closed = True
+        MODEL_INFO.labels(**self.labels).dec()
+        await self.batcher.stop()
+        self.executor.shutdown()
+    
+    def batch_stats(self):
+        return {
+            'max_batch_size': self.batcher.max_batch_size,
+            'max_wait_ms': self.batcher.max_wait * 1000,
+            'queue_depth': self.batcher.queue_depth(),
+            'inflight': self.inflight,
+            'max_inflight': self.max_inflight,
+            **self.batcher.stats.to_dict()
+        }
+    
+    def load_model(self, load_weights: bool = True):
+        artifact_cache = ArtifactCache()
+        
+        start_time = time.perf_counter()
+        model_mv, metadata = self._fetch_metadata(artifact_cache)
+        self.startup_timings['metadata'] = time.perf_counter() - start_time
+        
+        # json stores dict keys as strings
+        self.id2class = {int(k): v for k, v in metadata['id2label'].items()}
+        self.class2id = metadata['label2id']
+        self.mean = metadata['image_mean']
+        self.std = metadata['image_std']
+        self.img_size = metadata['image_size']
+        
+        if artifact_cache.get_metadata(self.model_name, self.model_version, self.run_id) is None:
+            if model_mv is None:
+                raise RuntimeError(f'Model {self.model_name} version {self.model_version} is neither reachable nor cached')
+            start_time = time.perf_counter()
+            model = mlflow.pytorch.load_model(model_mv.source, map_location='cpu')
+            artifact_cache.put(self.model_name, self.model_version, self.run_id, model, metadata)
+            self.startup_timings['download'] = time.perf_counter() - start_time
+        else:
+            self.startup_timings['download'] = 0.0
+        
+        if not load_weights:
+            self.loaded_model = None
+            return
+        start_time = time.perf_counter()
+        self.loaded_model = artifact_cache.load_model(self.model_name, self.model_version, self.run_id, device=self.device)
+        self.startup_timings['deserialize'] = time.perf_counter() - start_time
+        LOGGER.log.info(f'Model loaded: {self.model_name} - {self.model_alias} - version {self.model_version}')
+    
+    def _fetch_metadata(self, artifact_cache):
+        """Resolve the model version and its metadata, from MLflow when reachable, else from the local cache."""
         MLFLOW_TRACKING_URI = os.getenv("MLFLOW_TRACKING_URI")
         LOGGER.log.info(f'MLFLOW_TRACKING_URI: {MLFLOW_TRACKING_URI}')
         
         try:
             mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
             client = MlflowClient()
-            model_mv = client.get_model_version_by_alias(name=self.model_name, alias=self.model_alias)
+            if self.model_version is None:
+                model_mv = client.get_model_version_by_alias(name=self.model_name, alias=self.model_alias)
+                artifact_cache.save_alias(self.model_name, self.model_alias, model_mv.version, model_mv.run_id)
+            else:
+                model_mv = client.get_model_version(name=self.model_name, version=self.model_version)
+            self.model_version = str(model_mv.version)
+            self.run_id = model_mv.run_id
             
-            LOGGER.log.info(f'Model loaded: {self.model_name} - {self.model_alias}')
+            metadata = artifact_cache.get_metadata(self.model_name, self.model_version, self.run_id)
+            if metadata is not None:
+                return model_mv, metadata
             
             run_info = client.get_run(model_mv.run_id)
-            
-            self.id2class = ast.literal_eval(run_info.data.tags['id2label'])
-            self.class2id = ast.literal_eval(run_info.data.tags['label2id'])
-            self.mean = ast.literal_eval(run_info.data.params['image_mean'])
-            self.std = ast.literal_eval(run_info.data.params['image_std'])
-            self.img_size = ast.literal_eval(run_info.data.params['image_size'])
-            self.loaded_model = mlflow.pytorch.load_model(model_mv.source, map_location=self.device)
+            metadata = {
+                'model_name': self.model_name,
+                'model_version': self.model_version,
+                'run_id': self.run_id,
+                'id2label': ast.literal_eval(run_info.data.tags['id2label']),
+                'label2id': ast.literal_eval(run_info.data.tags['label2id']),
+                'image_mean': ast.literal_eval(run_info.data.params['image_mean']),
+                'image_std': ast.literal_eval(run_info.data.params['image_std']),
+                'image_size': ast.literal_eval(run_info.data.params['image_size']),
+            }
+            return model_mv, metadata
         
         except Exception as e:
-            LOGGER.log.error(f'Load model failed')
+            LOGGER.log.error(f'Fetch model from MLflow failed, try local artifact cache')
             LOGGER.log.error(f'ERROR: {e}')
-            return None
+        
+        if self.model_version is None:
+            alias = artifact_cache.resolve_alias(self.model_name, self.model_alias)
+            if alias is None:
+                raise RuntimeError(f'Alias {self.model_alias} of {self.model_name} is not cached')
+            self.model_version, self.run_id = alias['version'], alias['run_id']
+        else:
+            # Pinned versions are looked up by version only, any cached run of it will do
+            matches = sorted((artifact_cache.root / self.model_name).glob(f'{self.model_version}-*'))
+            if not matches:
+                raise RuntimeError(f'Version {self.model_version} of {self.model_name} is not cached')
+            self.run_id = matches[-1].name.split('-', 1)[1]
+        
+        metadata = artifact_cache.get_metadata(self.model_name, self.model_version, self.run_id)
+        if metadata is None:
+            raise RuntimeError(f'Model {self.model_name} version {self.model_version} is not cached')
+        return None, metadata
         
     def output2pred(self, output):
         probabilities = F.softmax(output, dim=1)
@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import torch
+
+from utils import Logger
+
+LOGGER = Logger(__file__, log_file='executor.log')
+
+_WORKER_PREDICTOR = None
+
+class ServerBusyError(Exception):
+    pass
+
+class ModelClosedError(ServerBusyError):
+    """The predictor was retired (swapped or evicted) after it was resolved, resolve the model again."""
+
+def _init_process_worker(model_name, model_alias, model_version, device, backend, backend_options, decoder, num_threads):
+    global _WORKER_PREDICTOR
+    from .catdog_predictor import Predictor
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    _WORKER_PREDICTOR = Predictor(model_name=model_name, model_alias=model_alias, model_version=model_version, device=device,
+                                  backend=backend, backend_options=backend_options, decoder=decoder)
+
+def _init_thread_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def _call_worker(method_name, *args):
+    return getattr(_WORKER_PREDICTOR, method_name)(*args)
+
+def _warmup_worker(num_batches):
+    _WORKER_PREDICTOR.warmup(num_batches)
+    return _WORKER_PREDICTOR.memory_bytes()
+
+class InferenceExecutor:
+    """Run the blocking parts of a Predictor (decode, transform, forward pass) off the event loop.
+
+    backend:
+        inline  - run in the event loop thread (no offloading)
+        thread  - thread pool sharing the predictor's model
+        process - pool of processes, each holding its own pre-loaded model replica, the
+                  parent predictor then only keeps the metadata
+
+    The torch thread count is set by the pool's worker initializer, creating an executor
+    doesn't change it for the rest of the process.
+    """
+    def __init__(self, backend: str = 'thread', num_workers: int = 1, num_threads: int = 0):
+        if backend not in ('inline', 'thread', 'process'):
+            raise ValueError(f'Invalid executor backend: {backend}. [inline, thread, process]')
+        self.backend = backend
+        self.num_workers = max(1, num_workers)
+        self.num_threads = num_threads
+        self.predictor = None
+        self.pool = None
+        self.replica_bytes = 0
+
+    def bind(self, predictor):
+        self.predictor = predictor
+        if self.backend == 'thread':
+            self.pool = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='inference',
+                                           initializer=_init_thread_worker if self.num_threads else None,
+                                           initargs=(self.num_threads,))
+        elif self.backend == 'process':
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_process_worker,
+                initargs=(predictor.model_name, predictor.model_alias, predictor.model_version, predictor.device, predictor.backend_name,
+                          predictor.backend_options, predictor.preprocessor.decoder, self.num_threads)
+            )
+        LOGGER.log.info(f'Executor backend: {self.backend} - workers: {self.num_workers} - torch threads: {self.num_threads or torch.get_num_threads()}')
+
+    def warmup(self, num_batches: int = 2):
+        """Start the worker processes and warm up their replicas, blocks until they are ready."""
+        futures = [self.pool.submit(_warmup_worker, num_batches) for _ in range(self.num_workers)]
+        self.replica_bytes = max(future.result() for future in futures)
+
+    def memory_bytes(self):
+        return self.replica_bytes * self.num_workers
+
+    async def submit(self, method_name, *args):
+        if self.backend == 'inline':
+            return getattr(self.predictor, method_name)(*args)
+
+        loop = asyncio.get_running_loop()
+        if self.backend == 'thread':
+            return await loop.run_in_executor(self.pool, getattr(self.predictor, method_name), *args)
+        return await loop.run_in_executor(self.pool, _call_worker, method_name, *args)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
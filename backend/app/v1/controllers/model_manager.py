@@ -0,0 +1,138 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import os
+import asyncio
+
+import mlflow
+from mlflow.tracking import MlflowClient
+
+from utils import Logger
+
+LOGGER = Logger(__file__, log_file='model_manager.log')
+
+class ModelManager:
+    """Hold the active Predictor and swap it for a new model version without downtime.
+
+    New versions are loaded and warmed up in a background thread, then replace the
+    active predictor atomically. Requests keep the predictor they started with, and the
+    old one is closed once it has no in-flight requests left.
+    """
+    def __init__(self, build_predictor, model_name: str, model_alias: str, poll_interval: float = 30.0):
+        self.build_predictor = build_predictor
+        self.model_name = model_name
+        self.model_alias = model_alias
+        self.poll_interval = poll_interval
+        self.pinned_version = None
+        self.history = []
+        self.lock = asyncio.Lock()
+        self.watcher = None
+        self.active = build_predictor(model_name, model_alias, None)
+        self.active.warmup()
+        self.active.activate()
+
+    def get(self):
+        return self.active
+
+    def start(self):
+        if self.poll_interval > 0 and (self.watcher is None or self.watcher.done()):
+            self.watcher = asyncio.get_running_loop().create_task(self._watch())
+            LOGGER.log.info(f'Watching {self.model_name} alias {self.model_alias} every {self.poll_interval}s')
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            self.watcher = None
+
+    async def close(self):
+        await self.stop()
+        await self._retire(self.active)
+
+    def alias_version(self):
+        mlflow.set_tracking_uri(os.getenv("MLFLOW_TRACKING_URI"))
+        client = MlflowClient()
+        return str(client.get_model_version_by_alias(name=self.model_name, alias=self.model_alias).version)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.pinned_version is not None:
+                continue
+            try:
+                version = await asyncio.to_thread(self.alias_version)
+            except Exception as e:
+                LOGGER.log.error(f'Poll alias {self.model_alias} failed: {e}')
+                continue
+            if version != str(self.active.model_version):
+                LOGGER.log.info(f'Alias {self.model_alias} moved to version {version}')
+                try:
+                    await self.swap(version)
+                except Exception:
+                    continue
+
+    async def swap(self, version):
+        async with self.lock:
+            if str(version) == str(self.active.model_version):
+                return self.active
+
+            LOGGER.log.info(f'Loading {self.model_name} version {version} in background')
+            try:
+                predictor = await asyncio.to_thread(self._load, version)
+            except Exception as e:
+                LOGGER.log.error(f'Load version {version} failed, keep version {self.active.model_version}')
+                LOGGER.log.error(f'ERROR: {e}')
+                raise
+
+            old = self.active
+            self.active = predictor
+            # Back on the event loop, the old version keeps serving from the cache until this point
+            predictor.activate()
+            self.history.append(str(old.model_version))
+            LOGGER.log.info(f'Swapped {self.model_name} version {old.model_version} -> {predictor.model_version}')
+            asyncio.get_running_loop().create_task(self._retire(old))
+            return predictor
+
+    def _load(self, version):
+        predictor = self.build_predictor(self.model_name, self.model_alias, version)
+        predictor.warmup()
+        return predictor
+
+    async def _retire(self, predictor, timeout: float = 60.0):
+        waited = 0.0
+        while predictor.inflight > 0 and waited < timeout:
+            await asyncio.sleep(0.1)
+            waited += 0.1
+        await predictor.close()
+        LOGGER.log.info(f'Retired {self.model_name} version {predictor.model_version}')
+
+    async def pin(self, version):
+        predictor = await self.swap(version)
+        self.pinned_version = str(version)
+        return predictor
+
+    async def unpin(self):
+        self.pinned_version = None
+        version = await asyncio.to_thread(self.alias_version)
+        return await self.swap(version)
+
+    async def rollback(self):
+        if not self.history:
+            raise ValueError('No previous version to roll back to')
+        version = self.history.pop()
+        current_version = str(self.active.model_version)
+        predictor = await self.pin(version)
+        # The swap pushed the version we rolled back from, drop it so repeated rollbacks walk further back
+        if self.history and self.history[-1] == current_version:
+            self.history.pop()
+        return predictor
+
+    def status(self):
+        return {
+            'model_name': self.model_name,
+            'model_alias': self.model_alias,
+            'active_version': str(self.active.model_version),
+            'pinned_version': self.pinned_version,
+            'history': list(self.history),
+            'poll_interval': self.poll_interval,
+        }
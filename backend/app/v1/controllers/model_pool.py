@@ -0,0 +1,339 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import time
+import random
+import asyncio
+from collections import OrderedDict
+
+from utils import Logger, TRACER
+from utils.metrics import CASCADE_DECISIONS
+from .model_manager import ModelManager
+from .executor import ServerBusyError, ModelClosedError
+
+LOGGER = Logger(__file__, log_file='model_pool.log')
+
+def parse_model_specs(specs: str, default_alias: str = 'Production'):
+    """Parse 'resnet_18:Production=0.9,mobilenet_v3_small=0.1' into {(name, alias): weight}."""
+    models = OrderedDict()
+    for spec in filter(None, (spec.strip() for spec in (specs or '').split(','))):
+        key, _, weight = spec.partition('=')
+        name, _, alias = key.partition(':')
+        models[(name, alias or default_alias)] = float(weight) if weight else 1.0
+    return models
+
+class ModelStats:
+    def __init__(self):
+        self.requests = 0
+        self.total_latency = 0.0
+        self.shadow_requests = 0
+        self.shadow_agreements = 0
+        self.shadow_total_latency = 0.0
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'avg_latency_ms': round(1000 * self.total_latency / self.requests, 4) if self.requests else 0.0,
+            'shadow_requests': self.shadow_requests,
+            'shadow_agreement': round(self.shadow_agreements / self.shadow_requests, 4) if self.shadow_requests else 0.0,
+            'shadow_avg_latency_ms': round(1000 * self.shadow_total_latency / self.shadow_requests, 4) if self.shadow_requests else 0.0,
+        }
+
+class CascadeStats:
+    def __init__(self, stages):
+        self.stages = stages
+        self.requests = 0
+        self.total_latency = 0.0
+        self.stage_requests = [0] * len(stages)
+        self.stage_escalations = [0] * len(stages)
+        self.stage_skips = [0] * len(stages)
+        self.stage_total_latency = [0.0] * len(stages)
+
+    def stage_dict(self, stage):
+        (name, alias), threshold = self.stages[stage]
+        requests = self.stage_requests[stage]
+        return {
+            'model': f'{name}:{alias}',
+            # The last stage always answers, its threshold is unused
+            'threshold': threshold if stage < len(self.stages) - 1 else None,
+            'requests': requests,
+            'share_of_requests': round(requests / self.requests, 4) if self.requests else 0.0,
+            'escalation_rate': round(self.stage_escalations[stage] / requests, 4) if requests else 0.0,
+            'skipped': self.stage_skips[stage],
+            'avg_latency_ms': round(1000 * self.stage_total_latency[stage] / requests, 4) if requests else 0.0,
+        }
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'avg_latency_ms': round(1000 * self.total_latency / self.requests, 4) if self.requests else 0.0,
+            'stages': [self.stage_dict(i) for i in range(len(self.stages))],
+        }
+
+class ModelPool:
+    """Serve several registered models/aliases from one process.
+
+    Models are loaded lazily on first use, only the ones listed in `serving_models`,
+    `shadow_models` or `cascade_models`, and the least recently used ones are evicted
+    when the summed weight size goes over `memory_budget_mb`. An evicted model is closed
+    in the background once its in-flight requests have drained. Requests without an explicit
+    model are split across `serving_models` by weight, and every `shadow_models` entry
+    also scores the request in the background so its latency and agreement can be compared.
+    
+    With `cascade_models` ({(name, alias): threshold}, cheapest first) requests without an
+    explicit model go through the cascade instead: a stage answers when its best_prob reaches
+    its threshold, otherwise the request escalates to the next stage. The last stage always
+    answers.
+    """
+    def __init__(self, build_predictor, serving_models, shadow_models=None,
+                 default_alias: str = 'Production', memory_budget_mb: float = 0, poll_interval: float = 30.0,
+                 cascade_models=None):
+        self.build_predictor = build_predictor
+        self.serving_models = serving_models
+        self.shadow_models = list(shadow_models or [])
+        self.default_alias = default_alias
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.poll_interval = poll_interval
+        self.managers = OrderedDict()
+        self.stats = {}
+        self.loading = {}
+        self.started = False
+        self.shadow_tasks = set()
+        self.retire_tasks = set()
+
+        # Load the highest weighted model eagerly so the first request doesn't pay for it
+        self.default_key = max(self.serving_models, key=self.serving_models.get)
+        self.managers[self.default_key] = ModelManager(build_predictor, *self.default_key, poll_interval=poll_interval)
+        
+        self.cascade = list((cascade_models or {}).items())
+        self.allowed = set(self.serving_models) | set(self.shadow_models) | {key for key, _ in self.cascade}
+        self.cascade_stats = CascadeStats(self.cascade)
+        for key, _ in self.cascade:
+            if key not in self.managers:
+                self.managers[key] = ModelManager(build_predictor, *key, poll_interval=poll_interval)
+
+    def start(self):
+        self.started = True
+        for manager in self.managers.values():
+            manager.start()
+
+    async def stop(self):
+        for manager in self.managers.values():
+            await manager.stop()
+
+    def resolve(self, model: str = None, split: bool = True):
+        if not model:
+            if not split:
+                return self.default_key
+            keys = list(self.serving_models)
+            return random.choices(keys, weights=[self.serving_models[key] for key in keys])[0]
+        name, _, alias = model.partition(':')
+        return name, alias or self.default_alias
+
+    async def get_manager(self, key):
+        if key in self.managers:
+            self.managers.move_to_end(key)
+            return self.managers[key]
+        if key not in self.allowed:
+            raise KeyError(f'{key[0]}:{key[1]} is not in SERVING_MODELS, SHADOW_MODELS or CASCADE_MODELS')
+
+        # Concurrent requests for the same cold model share one load
+        if key not in self.loading:
+            self.loading[key] = asyncio.get_running_loop().create_task(self._load(key))
+        return await self.loading[key]
+
+    async def _load(self, key):
+        try:
+            LOGGER.log.info(f'Lazy loading {key[0]}:{key[1]}')
+            manager = await asyncio.to_thread(ModelManager, self.build_predictor, *key, poll_interval=self.poll_interval)
+            self.managers[key] = manager
+            if self.started:
+                manager.start()
+            await self._evict(keep=key)
+            return manager
+        finally:
+            self.loading.pop(key, None)
+
+    async def acquire(self, key, retries: int = 3):
+        """Take an in-flight slot on the active predictor of `key` and return it, the caller releases it.
+
+        The predictor can be retired between resolving it and using it (a swap or an eviction
+        while the model was loading), it is resolved again then.
+        """
+        for attempt in range(retries + 1):
+            predictor = (await self.get_manager(key)).get()
+            try:
+                predictor.acquire()
+                return predictor
+            except ModelClosedError:
+                if attempt == retries:
+                    raise
+
+    def memory_usage(self):
+        return sum(manager.get().memory_bytes() for manager in self.managers.values())
+
+    async def _evict(self, keep):
+        if self.memory_budget <= 0:
+            return
+        for key in list(self.managers):
+            if self.memory_usage() <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            manager = self.managers.pop(key)
+            LOGGER.log.info(f'Evict {key[0]}:{key[1]} to stay under {self.memory_budget / 1024 / 1024:.0f} MB')
+            # Requests already holding its predictor finish first, see ModelManager._retire
+            task = asyncio.get_running_loop().create_task(manager.close())
+            self.retire_tasks.add(task)
+            task.add_done_callback(self.retire_tasks.discard)
+
+    async def predict(self, image, image_name, model: str = None):
+        if not model and self.cascade:
+            return await self._cascade(image, image_name)
+        key = self.resolve(model)
+        predictor = await self.acquire(key)
+
+        start_time = time.perf_counter()
+        try:
+            response = await predictor.predict(image, image_name, reserved=True)
+        finally:
+            predictor.release()
+        stats = self.stats.setdefault(key, ModelStats())
+        stats.requests += 1
+        stats.total_latency += time.perf_counter() - start_time
+
+        for shadow_key in self.shadow_models:
+            if shadow_key != key:
+                task = asyncio.get_running_loop().create_task(self._shadow(shadow_key, image, image_name, response))
+                self.shadow_tasks.add(task)
+                task.add_done_callback(self.shadow_tasks.discard)
+        return response
+
+    async def _cascade(self, image, image_name):
+        stats = self.cascade_stats
+        start_time = time.perf_counter()
+        response, answered_by = None, None
+        for stage, (key, threshold) in enumerate(self.cascade):
+            stage_start = time.perf_counter()
+            try:
+                predictor = await self.acquire(key)
+            except ServerBusyError:
+                if response is None:
+                    raise
+                # Answer with the cheaper stage rather than fail the request
+                stats.stage_skips[stage] += 1
+                CASCADE_DECISIONS.labels(stage=str(stage), **(await self.get_manager(key)).get().labels, result='skipped').inc()
+                break
+            try:
+                with TRACER.span('cascade', **predictor.labels):
+                    # The first stage already captured the image, only the answering stage writes its prediction row
+                    stage_response = await predictor.predict(image, image_name, capture=stage == 0, reserved=True,
+                                                             persist=False)
+            finally:
+                predictor.release()
+            response, answered_by = stage_response, predictor
+            stats.stage_requests[stage] += 1
+            stats.stage_total_latency[stage] += time.perf_counter() - stage_start
+            
+            if stage == len(self.cascade) - 1 or response['best_prob'] >= threshold:
+                CASCADE_DECISIONS.labels(stage=str(stage), **predictor.labels, result='accepted').inc()
+                break
+            stats.stage_escalations[stage] += 1
+            CASCADE_DECISIONS.labels(stage=str(stage), **predictor.labels, result='escalated').inc()
+        answered_by.record(response, image_name)
+        
+        stats.requests += 1
+        stats.total_latency += time.perf_counter() - start_time
+        return response
+
+    async def cascade_batch(self, images, chunk_size: int = 32, first_predictor=None):
+        """Cascade a list of (image_bytes, image_name), only the uncertain residue of a chunk reaches the next stage.
+        
+        `first_predictor` is the first stage predictor the caller already holds the in-flight slot of,
+        every other stage takes its slot per chunk.
+        """
+        stats = self.cascade_stats
+        for i in range(0, len(images), chunk_size):
+            chunk = images[i:i+chunk_size]
+            chunk_start = time.perf_counter()
+            responses = [None] * len(chunk)
+            answered_by = [None] * len(chunk)
+            residue = list(range(len(chunk)))
+            for stage, (key, threshold) in enumerate(self.cascade):
+                last = stage == len(self.cascade) - 1
+                start_time = time.perf_counter()
+                held = stage == 0 and first_predictor is not None
+                try:
+                    predictor = first_predictor if held else await self.acquire(key)
+                except ServerBusyError:
+                    if stage == 0:
+                        raise
+                    stats.stage_skips[stage] += len(residue)
+                    CASCADE_DECISIONS.labels(stage=str(stage), **(await self.get_manager(key)).get().labels,
+                                             result='skipped').inc(len(residue))
+                    break
+                try:
+                    with TRACER.span('cascade', **predictor.labels):
+                        # The first stage already captured the images, only the answering stage writes prediction rows
+                        async for stage_responses in predictor.predict_batch([chunk[j] for j in residue], chunk_size=len(residue),
+                                                                             reserved=True, capture=stage == 0, persist=False):
+                            for j, response in zip(residue, stage_responses):
+                                responses[j], answered_by[j] = response, predictor
+                finally:
+                    if not held:
+                        predictor.release()
+                stats.stage_requests[stage] += len(residue)
+                stats.stage_total_latency[stage] += (time.perf_counter() - start_time) * len(residue)
+                
+                # Undecodable images can't get better on a later stage
+                escalated = [] if last else [j for j in residue if 'error' not in responses[j] and responses[j]['best_prob'] < threshold]
+                stats.stage_escalations[stage] += len(escalated)
+                CASCADE_DECISIONS.labels(stage=str(stage), **predictor.labels, result='accepted').inc(len(residue) - len(escalated))
+                CASCADE_DECISIONS.labels(stage=str(stage), **predictor.labels, result='escalated').inc(len(escalated))
+                residue = escalated
+                if not residue:
+                    break
+            for j, response in enumerate(responses):
+                if 'error' not in response:
+                    answered_by[j].record(response, chunk[j][1])
+            # Latencies are per image, every image of a chunk waits for the whole stage
+            stats.requests += len(chunk)
+            stats.total_latency += (time.perf_counter() - chunk_start) * len(chunk)
+            yield responses
+
+    async def _shadow(self, key, image, image_name, primary_response):
+        try:
+            manager = await self.get_manager(key)
+            predictor = manager.get()
+            if predictor.is_busy():
+                return
+            start_time = time.perf_counter()
+            # The primary model already captured the image and wrote the request's prediction row
+            response = await predictor.predict(image, image_name, capture=False, persist=False)
+        except Exception as e:
+            LOGGER.log.error(f'Shadow {key[0]}:{key[1]} failed: {e}')
+            return
+
+        stats = self.stats.setdefault(key, ModelStats())
+        stats.shadow_requests += 1
+        stats.shadow_total_latency += time.perf_counter() - start_time
+        stats.shadow_agreements += int(response['predicted_id'] == primary_response['predicted_id'])
+
+    def status(self):
+        return {
+            'memory_budget_mb': self.memory_budget / 1024 / 1024,
+            'memory_usage_mb': round(self.memory_usage() / 1024 / 1024, 2),
+            'serving_models': {f'{name}:{alias}': weight for (name, alias), weight in self.serving_models.items()},
+            'shadow_models': [f'{name}:{alias}' for name, alias in self.shadow_models],
+            'cascade': self.cascade_stats.to_dict() if self.cascade else None,
+            'loaded_models': {
+                f'{name}:{alias}': {
+                    **manager.status(),
+                    **self.stats.get((name, alias), ModelStats()).to_dict(),
+                    'inflight': manager.get().inflight,
+                    'max_inflight': manager.get().max_inflight,
+                }
+                for (name, alias), manager in self.managers.items()
+            },
+        }
@@ -0,0 +1,148 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import AppPath, Logger
+
+LOGGER = Logger(__file__, log_file='prediction_cache.log')
+
+class PredictionCache:
+    """LRU + TTL cache of prediction responses keyed by the hash of the raw upload bytes.
+
+    Entries live under a namespace built from model name/alias/version, so switching
+    the served model version drops every entry computed by the previous one. Lookups and
+    puts made for another namespace (a predictor still draining after a swap) are ignored.
+    Like the rest of the cache, the namespace is only changed from the event loop.
+    An optional disk tier keeps entries as json files under `cache/prediction_cache/<model>-<alias>/<version>`,
+    read with `asyncio.to_thread` and written by a single background thread, so the event loop
+    never waits on the disk. Directories of every other version are deleted when the namespace is set.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, use_disk: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_disk = use_disk
+        self.entries = OrderedDict()
+        self.namespace = None
+        self.disk_dir = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # One thread keeps directory changes and writes in submission order
+        self.disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prediction-cache') if use_disk else None
+
+    @staticmethod
+    def namespace_of(model_name, model_alias, model_version):
+        return f'{model_name}-{model_alias}-{model_version}'
+
+    def set_namespace(self, model_name, model_alias, model_version):
+        namespace = self.namespace_of(model_name, model_alias, model_version)
+        if namespace == self.namespace:
+            return
+
+        if self.namespace is not None:
+            LOGGER.log.info(f'Model changed from {self.namespace} to {namespace}, invalidate cache')
+        self.entries.clear()
+        self.namespace = namespace
+        if self.use_disk:
+            self.disk_dir = AppPath.CACHE_DIR / 'prediction_cache' / f'{model_name}-{model_alias}' / str(model_version)
+            # Also drops versions left over from earlier runs of the server
+            self.disk_writer.submit(self._disk_reset, self.disk_dir)
+
+    @staticmethod
+    def _disk_reset(disk_dir):
+        disk_dir.mkdir(parents=True, exist_ok=True)
+        for path in disk_dir.parent.iterdir():
+            if path != disk_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def key(image):
+        return hashlib.blake2b(image, digest_size=16).hexdigest()
+
+    async def get(self, key, namespace: str = None):
+        if self.max_size <= 0:
+            return None
+        if namespace is not None and namespace != self.namespace:
+            self.misses += 1
+            return None
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            created, response = entry
+            if time.time() - created <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self.entries[key]
+
+        if self.use_disk:
+            cached = await asyncio.to_thread(self._disk_get, self.disk_dir / f'{key}.json', self.ttl)
+            # The namespace may have changed while the file was read
+            if cached is not None and cached[0] == self.disk_dir:
+                created, response = cached[1:]
+                self._memory_put(key, created, response)
+                self.disk_hits += 1
+                return response
+
+        self.misses += 1
+        return None
+
+    def put(self, key, response, namespace: str = None):
+        if self.max_size <= 0 or (namespace is not None and namespace != self.namespace):
+            return
+
+        self._memory_put(key, time.time(), response)
+        if self.use_disk:
+            self.disk_writer.submit(self._disk_put, self.disk_dir / f'{key}.json', response)
+
+    @staticmethod
+    def _disk_put(path, response):
+        tmp_path = path.with_suffix('.json.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(response, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            LOGGER.log.error(f'Write {path} failed: {e}')
+
+    def _memory_put(self, key, created, response):
+        self.entries[key] = (created, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def _disk_get(path, ttl):
+        """(disk_dir, created, response) of a fresh entry file, None if there is none."""
+        try:
+            created = path.stat().st_mtime
+            if time.time() - created > ttl:
+                path.unlink(missing_ok=True)
+                return None
+            with open(path) as f:
+                return path.parent, created, json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'use_disk': self.use_disk,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
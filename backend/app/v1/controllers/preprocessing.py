@@ -0,0 +1,141 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+import io
+import struct
+
+import numpy as np
+from PIL import Image
+
+import torch
+from torchvision import transforms
+import torchvision.transforms.functional as TF
+
+from utils import AppPath, Logger
+
+LOGGER = Logger(__file__, log_file='preprocessing.log')
+
+# Pre-decoded payload: magic, height, width, channels (little endian) followed by HWC uint8 pixels
+TENSOR_MAGIC = b'CDT1'
+TENSOR_HEADER = struct.Struct('<4sHHB')
+
+def is_tensor_payload(payload):
+    return payload[:len(TENSOR_MAGIC)] == TENSOR_MAGIC
+
+def pack_tensor(pixels):
+    """Encode a HWC uint8 array (e.g. an image already resized on the client) as a tensor payload."""
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width, channels = pixels.shape
+    return TENSOR_HEADER.pack(TENSOR_MAGIC, height, width, channels) + pixels.tobytes()
+
+def unpack_tensor(payload):
+    if len(payload) < TENSOR_HEADER.size:
+        raise ValueError('Tensor payload shorter than its header')
+    _, height, width, channels = TENSOR_HEADER.unpack_from(payload)
+    if channels != 3 or len(payload) != TENSOR_HEADER.size + height * width * channels:
+        raise ValueError(f'Tensor payload does not match its header: {height}x{width}x{channels}, {len(payload)} bytes')
+    # frombuffer needs a writable buffer, this is the only copy of the body before resize
+    pixels = torch.frombuffer(bytearray(payload), dtype=torch.uint8, offset=TENSOR_HEADER.size)
+    return pixels.view(height, width, channels).permute(2, 0, 1)
+
+class Preprocessor:
+    """Decode uploads to resized uint8 CHW tensors and normalize whole batches at once.
+
+    decoder:
+        reference   - PIL Resize -> ToTensor -> Normalize per image (the original pipeline)
+        pil         - PIL (or PIL-SIMD when installed) with JPEG draft-mode decoding near the target size
+        torchvision - torchvision.io decoding straight from the upload buffer
+    """
+    def __init__(self, img_size: int, mean, std, decoder: str = 'pil'):
+        if decoder not in ('reference', 'pil', 'torchvision'):
+            raise ValueError(f'Invalid preprocessing decoder: {decoder}. [reference, pil, torchvision]')
+        self.img_size = img_size
+        self.decoder = decoder
+        self.reference_transform = transforms.Compose([
+            transforms.Resize((img_size, img_size)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=mean, std=std)
+        ])
+        # Normalize(ToTensor(x)) == x * scale - shift, folded into one multiply-subtract
+        std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+        mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.scale = 1.0 / (255.0 * std)
+        self.shift = mean / std
+
+    def decode(self, image):
+        return self.resize(self.load(image))
+
+    def load(self, image):
+        """Decode the upload to full-size pixels, a PIL image or a uint8 CHW tensor for the torchvision decoder and tensor payloads."""
+        if is_tensor_payload(image):
+            return unpack_tensor(image)
+        if self.decoder == 'torchvision':
+            return self._load_torchvision(image)
+        # PIL decodes lazily, load() so the decoding cost is paid here and not in resize
+        pil_img = self._open_rgb(image, draft_size=self.img_size if self.decoder == 'pil' else None)
+        pil_img.load()
+        return pil_img
+
+    def resize(self, pixels):
+        """Resize decoded pixels to a uint8 CHW tensor, or a normalized float tensor for the reference decoder."""
+        if isinstance(pixels, torch.Tensor):
+            if pixels.shape[1:] == (self.img_size, self.img_size):
+                resized = pixels.contiguous()
+            else:
+                resized = TF.resize(pixels, [self.img_size, self.img_size], antialias=True)
+            # The reference decoder batches normalized floats, tensor payloads have to match
+            if self.decoder == 'reference':
+                return self.normalize(resized.unsqueeze(0))[0]
+            return resized
+        if self.decoder == 'reference':
+            return self.reference_transform(pixels)
+        pil_img = pixels.resize((self.img_size, self.img_size), Image.BILINEAR)
+        return torch.from_numpy(np.asarray(pil_img).copy()).permute(2, 0, 1)
+
+    def normalize(self, batch):
+        """Normalize a NCHW batch of uint8 images. Float batches are already normalized."""
+        if batch.dtype != torch.uint8:
+            return batch
+        return batch.to(torch.float32).mul_(self.scale).sub_(self.shift)
+
+    @staticmethod
+    def _open_rgb(image, draft_size=None):
+        pil_img = Image.open(io.BytesIO(image))
+        if draft_size is not None and pil_img.format == 'JPEG':
+            # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding, keeping both sides >= draft_size
+            pil_img.draft('RGB', (draft_size, draft_size))
+        if pil_img.mode != 'RGB':
+            pil_img = pil_img.convert('RGB')
+        return pil_img
+
+    def _load_torchvision(self, image):
+        from torchvision.io import decode_image, ImageReadMode
+
+        data = torch.frombuffer(bytearray(image), dtype=torch.uint8)
+        try:
+            return decode_image(data, mode=ImageReadMode.RGB)
+        except RuntimeError:
+            # Formats torchvision can't decode (e.g. webp, bmp) go through PIL
+            pil_img = self._open_rgb(image, draft_size=self.img_size)
+            pil_img.load()
+            return pil_img
+
+    def validate(self, image=None, max_mean_abs_diff: float = 0.05):
+        """Check the fast path against the reference transform on a sample image."""
+        if self.decoder == 'reference':
+            return True
+
+        if image is None:
+            sample_path = AppPath.ROOT_DIR / 'tests' / 'dog_1.jpg'
+            if not sample_path.exists():
+                LOGGER.log.info('No sample image for preprocessing validation, skipped')
+                return True
+            image = sample_path.read_bytes()
+
+        expected = self.reference_transform(self._open_rgb(image)).unsqueeze(0)
+        actual = self.normalize(self.decode(image).unsqueeze(0))
+        mean_diff = (expected - actual).abs().mean().item()
+        max_diff = (expected - actual).abs().max().item()
+        LOGGER.log.info(f'Preprocessing {self.decoder}: mean abs diff {mean_diff:.6f} - max abs diff {max_diff:.6f}')
+        return mean_diff <= max_mean_abs_diff
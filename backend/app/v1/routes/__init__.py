@@ -1,2 +1,3 @@
 from .base import router as v1_router
-from .redirect_router import router as redirect_router
\ No newline at end of file
+from .redirect_router import router as redirect_router
+from .metrics_router import router as metrics_router
\ No newline at end of file
@@ -3,11 +3,19 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent))
 
 import os
-from fastapi import APIRouter
+import json
+import uuid
+import atexit
+from typing import List
+from fastapi import APIRouter, HTTPException, Request
 from fastapi import UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 
-from controllers import Predictor
-from schemas.classification import PredictionResponse
+from controllers import Predictor, InferenceExecutor, ServerBusyError, PredictionCache, ModelPool, parse_model_specs
+from schemas.classification import PredictionResponse, PredictionError
+from utils import AppPath, read_archive, BackgroundWriter
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -15,11 +23,251 @@ load_dotenv()
 DEPLOY_MODEL_NAME = os.getenv("MODEL_NAME")
 DEPLOY_MODEL_ALIAS = os.getenv("MODEL_ALIAS")
 DEPLOY_DEVICE = os.getenv("DEVICE")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+PREPROCESS_DECODER = os.getenv("PREPROCESS_DECODER", "pil")
+INFERENCE_OPTIONS = {
+    'autocast_bf16': os.getenv("INFERENCE_AUTOCAST_BF16", "false").lower() == "true",
+    'channels_last': os.getenv("INFERENCE_CHANNELS_LAST", "false").lower() == "true",
+    'compile': os.getenv("INFERENCE_COMPILE", "false").lower() == "true",
+    'inference_mode': os.getenv("INFERENCE_MODE", "true").lower() == "true",
+}
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", 5))
+EXECUTOR_BACKEND = os.getenv("EXECUTOR_BACKEND", "thread")
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", 2))
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", 0))
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", 64))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", 32))
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", 1024))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", 3600))
+PREDICTION_CACHE_DISK = os.getenv("PREDICTION_CACHE_DISK", "false").lower() == "true"
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", 1.0))
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", 1024))
+WRITER_FLUSH_ROWS = int(os.getenv("WRITER_FLUSH_ROWS", 256))
+WRITER_FLUSH_INTERVAL = float(os.getenv("WRITER_FLUSH_INTERVAL", 1.0))
+PREDICTION_DB_PATH = os.getenv("PREDICTION_DB_PATH", AppPath.CACHE_DIR / 'predicted_cache.db')
+CAPTURE_DIR = Path(os.getenv("CAPTURE_DIR", AppPath.CAPTURED_DATA_DIR))
+MODEL_POLL_INTERVAL = float(os.getenv("MODEL_POLL_INTERVAL", 30))
+SERVING_MODELS = parse_model_specs(os.getenv("SERVING_MODELS") or f'{DEPLOY_MODEL_NAME}:{DEPLOY_MODEL_ALIAS}', DEPLOY_MODEL_ALIAS)
+SHADOW_MODELS = list(parse_model_specs(os.getenv("SHADOW_MODELS"), DEPLOY_MODEL_ALIAS))
+MODEL_MAX_INFLIGHT = parse_model_specs(os.getenv("MODEL_MAX_INFLIGHT"), DEPLOY_MODEL_ALIAS)
+# Cheapest first, name:alias=threshold, e.g. mobilenet_v3_small:Production=0.9,resnet_34:Production
+CASCADE_MODELS = parse_model_specs(os.getenv("CASCADE_MODELS"), DEPLOY_MODEL_ALIAS)
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", 0))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+RAW_CONTENT_TYPES = ('application/octet-stream', 'application/x-uint8-tensor')
 
 router = APIRouter()
-predictor = Predictor(model_name=DEPLOY_MODEL_NAME, model_alias=DEPLOY_MODEL_ALIAS, device=DEPLOY_DEVICE)
+caches = {}
+writer = BackgroundWriter(db_path=PREDICTION_DB_PATH, capture_dir=CAPTURE_DIR, sample_rate=CAPTURE_SAMPLE_RATE, max_queue_size=WRITER_QUEUE_SIZE,
+                          flush_rows=WRITER_FLUSH_ROWS, flush_interval=WRITER_FLUSH_INTERVAL)
+atexit.register(writer.close)
+
+def build_predictor(model_name, model_alias, model_version=None):
+    # One cache per model/alias, so a new version of the same model invalidates it
+    cache = caches.setdefault((model_name, model_alias), PredictionCache(
+        max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, use_disk=PREDICTION_CACHE_DISK))
+    executor = InferenceExecutor(backend=EXECUTOR_BACKEND, num_workers=EXECUTOR_WORKERS, num_threads=TORCH_NUM_THREADS)
+    return Predictor(model_name=model_name, model_alias=model_alias, device=DEPLOY_DEVICE,
+                     max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS,
+                     executor=executor, max_inflight=int(MODEL_MAX_INFLIGHT.get((model_name, model_alias), MAX_INFLIGHT)),
+                     cache=cache, writer=writer,
+                     backend=INFERENCE_BACKEND, backend_options=INFERENCE_OPTIONS, decoder=PREPROCESS_DECODER,
+                     model_version=model_version)
+
+pool = ModelPool(build_predictor, SERVING_MODELS, shadow_models=SHADOW_MODELS, default_alias=DEPLOY_MODEL_ALIAS,
+                 memory_budget_mb=MODEL_MEMORY_BUDGET_MB, poll_interval=MODEL_POLL_INTERVAL,
+                 cascade_models=CASCADE_MODELS)
+
+async def get_manager(model, split: bool = False):
+    try:
+        return await pool.get_manager(pool.resolve(model, split=split))
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f'Model {model} not available: {e}')
+
+async def acquire(key, model):
+    """Take an in-flight slot on the predictor serving `key`, the caller releases it."""
+    try:
+        return await pool.acquire(key)
+    except ServerBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f'Model {model} not available: {e}')
+
+@router.on_event('startup')
+async def start_model_watcher():
+    pool.start()
+
+@router.on_event('shutdown')
+async def stop_model_watcher():
+    await pool.stop()
+
+def image_name_of(name):
+    """Client supplied names only end up in the captured data, never trust them as a path."""
+    name = os.path.basename((name or '').replace('\\', '/'))
+    return name if name not in ('', '.', '..') else f'{uuid.uuid4().hex}.jpg'
 
 @router.post('/predict')
-async def predict(file_upload: UploadFile = File(...)):
-    response = await predictor.predict(file_upload.file, file_upload.filename)
+async def predict(file_upload: UploadFile = File(...), model: str = None):
+    image = await file_upload.read()
+    if model:
+        await get_manager(model)
+    try:
+        response = await pool.predict(image, image_name_of(file_upload.filename), model=model)
+    except ServerBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image payload: {e}')
+    return PredictionResponse(**response)
+
+async def read_body(request: Request):
+    """Read the request body, refusing it as soon as it is known to exceed MAX_UPLOAD_BYTES."""
+    content_length = request.headers.get('content-length')
+    if content_length is not None and int(content_length) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f'Payload larger than {MAX_UPLOAD_BYTES} bytes')
+    
+    # Chunked bodies have no content-length, count while reading instead
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f'Payload larger than {MAX_UPLOAD_BYTES} bytes')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def compact_response(response, top_k: int):
+    probs = response['probs']
+    top_ids = sorted(range(len(probs)), key=probs.__getitem__, reverse=True)[:top_k]
+    content = {'ids': top_ids, 'probs': [probs[i] for i in top_ids], 'version': response['predicted_version']}
+    return Response(content=json.dumps(content, separators=(',', ':')), media_type='application/json')
+
+@router.post('/predict_raw')
+async def predict_raw(request: Request, model: str = None, top_k: int = 0):
+    """Predict an image (or a pre-decoded uint8 tensor payload) sent as the raw request body.
+    
+    top_k > 0 answers with only the top-k class ids and probabilities, skipping response model validation.
+    """
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    if content_type not in RAW_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f'Content-Type must be one of {RAW_CONTENT_TYPES}')
+    image = await read_body(request)
+    if len(image) == 0:
+        raise HTTPException(status_code=400, detail='Empty request body')
+    image_name = image_name_of(request.headers.get('x-image-name'))
+    
+    if model:
+        await get_manager(model)
+    try:
+        response = await pool.predict(image, image_name, model=model)
+    except ServerBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image payload: {e}')
+    
+    if top_k > 0:
+        return compact_response(response, top_k)
     return PredictionResponse(**response)
+
+def batch_record(response):
+    return PredictionError(**response) if 'error' in response else PredictionResponse(**response)
+
+def release_once(predictor):
+    released = False
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            predictor.release()
+    return release
+
+@router.post('/predict_batch')
+async def predict_batch(files: List[UploadFile] = File(default=[]), archive: UploadFile = File(None),
+                        stream: bool = True, model: str = None):
+    images = [(await file.read(), image_name_of(file.filename)) for file in files]
+    if archive is not None:
+        images.extend(await run_in_threadpool(read_archive, archive.file, archive.filename))
+    
+    if len(images) == 0:
+        raise HTTPException(status_code=400, detail='No images found in request')
+    # Take the slot before any header is sent, a busy server has to answer 503 and not cut the stream
+    if not model and pool.cascade:
+        # The cheapest stage sees every image, it decides whether the request is accepted
+        predictor = await acquire(pool.cascade[0][0], model)
+        chunks = pool.cascade_batch(images, chunk_size=BATCH_CHUNK_SIZE, first_predictor=predictor)
+    else:
+        predictor = await acquire(pool.resolve(model, split=True), model)
+        chunks = predictor.predict_batch(images, chunk_size=BATCH_CHUNK_SIZE, reserved=True)
+    release = release_once(predictor)
+    
+    if not stream:
+        responses = []
+        try:
+            async for chunk in chunks:
+                responses.extend(batch_record(response) for response in chunk)
+        finally:
+            release()
+        return responses
+    
+    async def ndjson_stream():
+        try:
+            async for chunk in chunks:
+                for response in chunk:
+                    yield batch_record(response).model_dump_json() + '\n'
+        finally:
+            release()
+    
+    # The background task also releases the slot when the client disconnects before the stream starts
+    return StreamingResponse(ndjson_stream(), media_type='application/x-ndjson', background=BackgroundTask(release))
+
+@router.get('/batch_stats')
+async def batch_stats(model: str = None):
+    return (await get_manager(model)).get().batch_stats()
+
+@router.get('/cascade_stats')
+async def cascade_stats():
+    if not pool.cascade:
+        raise HTTPException(status_code=404, detail='No cascade configured, set CASCADE_MODELS')
+    return pool.cascade_stats.to_dict()
+
+@router.get('/cache_stats')
+async def cache_stats():
+    return {f'{name}:{alias}': cache.stats() for (name, alias), cache in caches.items()}
+
+@router.get('/writer_stats')
+async def writer_stats():
+    return writer.stats()
+
+@router.get('/admin/models')
+async def pool_status():
+    return pool.status()
+
+@router.get('/admin/model')
+async def model_status(model: str = None):
+    return (await get_manager(model)).status()
+
+@router.post('/admin/pin')
+async def pin_model(version: str, model: str = None):
+    manager = await get_manager(model)
+    try:
+        await manager.pin(version)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f'Pin version {version} failed: {e}')
+    return manager.status()
+
+@router.post('/admin/unpin')
+async def unpin_model(model: str = None):
+    manager = await get_manager(model)
+    try:
+        await manager.unpin()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f'Unpin failed: {e}')
+    return manager.status()
+
+@router.post('/admin/rollback')
+async def rollback_model(model: str = None):
+    manager = await get_manager(model)
+    try:
+        await manager.rollback()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f'Rollback failed: {e}')
+    return manager.status()
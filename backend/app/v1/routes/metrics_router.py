@@ -0,0 +1,15 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+from utils.metrics import render_metrics
+
+router = APIRouter()
+
+@router.get('/metrics')
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
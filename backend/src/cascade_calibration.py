@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+import torchvision
+import mlflow
+from torch.utils.data import DataLoader
+
+from utils import Logger, AppPath, seed_everything
+from config.data_config import CatDogData
+
+from dotenv import load_dotenv
+load_dotenv()
+
+LOGGER = Logger(__file__)
+LOGGER.log.info('Starting Cascade Calibration')
+
+def collect_predictions(model, loader, warmup_batches: int = 2):
+    """Softmax confidence, correctness and CPU seconds per image of a model over the whole loader."""
+    model = model.to('cpu').eval()
+    confidences, corrects = [], []
+    elapsed, timed = 0.0, 0
+    with torch.inference_mode():
+        for i, (inputs, labels) in enumerate(loader):
+            start_time = time.perf_counter()
+            outputs = model(inputs)
+            if i >= warmup_batches:
+                elapsed += time.perf_counter() - start_time
+                timed += inputs.size(0)
+            best_prob, pred_id = F.softmax(outputs, dim=1).max(dim=1)
+            confidences.append(best_prob)
+            corrects.append(pred_id == labels)
+    # Too few batches to skip the warmup, time everything again
+    if timed == 0:
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            for inputs, _ in loader:
+                model(inputs)
+        elapsed, timed = time.perf_counter() - start_time, len(loader.dataset)
+    return torch.cat(confidences), torch.cat(corrects), elapsed / timed
+
+def sweep_thresholds(cheap_confidences, cheap_corrects, expensive_corrects, cheap_latency, expensive_latency):
+    """Accuracy, escalation rate and expected latency of the cascade for every candidate threshold.
+
+    Only thresholds equal to an observed confidence change the outcome, 0 never escalates
+    and anything above 1 always does.
+    """
+    candidates = torch.cat([torch.tensor([0.0, 1.0 + 1e-6]), cheap_confidences.unique()]).unique()
+    results = []
+    for threshold in candidates.tolist():
+        escalated = cheap_confidences < threshold
+        corrects = torch.where(escalated, expensive_corrects, cheap_corrects)
+        escalation_rate = escalated.float().mean().item()
+        results.append({
+            'threshold': round(threshold, 6),
+            'accuracy': corrects.float().mean().item(),
+            'escalation_rate': escalation_rate,
+            # Every image pays for the cheap model, escalated ones for both
+            'latency_ms': 1000 * (cheap_latency + escalation_rate * expensive_latency),
+        })
+    return results
+
+def pick_threshold(results, target_accuracy: float):
+    """Cheapest threshold reaching the target accuracy, or the most accurate one when none does."""
+    reaching = [result for result in results if result['accuracy'] >= target_accuracy]
+    if not reaching:
+        LOGGER.log.info(f'No threshold reaches accuracy {target_accuracy:.4f}, using the most accurate one')
+        return max(results, key=lambda result: (result['accuracy'], -result['latency_ms']))
+    return min(reaching, key=lambda result: (result['latency_ms'], -result['accuracy']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cheap_model', type=str, default='mobilenet_v3_small:Production',
+                        help='name:alias of the registered model answering first')
+    parser.add_argument('--expensive_model', type=str, default='resnet_34:Production',
+                        help='name:alias of the registered model uncertain images escalate to')
+    parser.add_argument('--data_version', type=str, required=True,
+                        help='Version/directory whose test split is used')
+    parser.add_argument('--target_accuracy', type=float, default=None,
+                        help='Accuracy the cascade must reach, the expensive model accuracy if not set')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Batch size for scoring the test split')
+    parser.add_argument('--config_name', type=str, default='cascade',
+                        help='Name of the config file saved in config/serve_config')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for reproducibility')
+    args = parser.parse_args()
+    seed_everything(args.seed)
+
+    mlflow.set_tracking_uri(os.getenv('MLFLOW_TRACKING_URI'))
+    mlflow.set_experiment(os.getenv('MLFLOW_EXPERIMENT_NAME'))
+
+    test_data = torchvision.datasets.ImageFolder(
+        root=AppPath.TRAIN_DATA_DIR/args.data_version/'test',
+        transform=CatDogData.test_transform
+    )
+    loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=False)
+
+    predictions = {}
+    for role, model_spec in (('cheap', args.cheap_model), ('expensive', args.expensive_model)):
+        model_name, _, model_alias = model_spec.partition(':')
+        model = mlflow.pytorch.load_model(f'models:/{model_name}@{model_alias or "Production"}', map_location='cpu')
+        predictions[role] = collect_predictions(model, loader)
+        LOGGER.log.info(f'{role} {model_spec}: acc {predictions[role][1].float().mean().item():.4f} - '
+                        f'{1000 * predictions[role][2]:.3f} ms/image')
+
+    cheap_confidences, cheap_corrects, cheap_latency = predictions['cheap']
+    _, expensive_corrects, expensive_latency = predictions['expensive']
+    target_accuracy = args.target_accuracy if args.target_accuracy is not None else expensive_corrects.float().mean().item()
+
+    results = sweep_thresholds(cheap_confidences, cheap_corrects, expensive_corrects, cheap_latency, expensive_latency)
+    best = pick_threshold(results, target_accuracy)
+    LOGGER.log.info(f'Threshold {best["threshold"]}: acc {best["accuracy"]:.4f} (target {target_accuracy:.4f}) - '
+                    f'escalation rate {best["escalation_rate"]:.4f} - {best["latency_ms"]:.3f} ms/image '
+                    f'vs {1000 * expensive_latency:.3f} ms/image for {args.expensive_model} alone')
+
+    cheap_name, _, cheap_alias = args.cheap_model.partition(':')
+    expensive_name, _, expensive_alias = args.expensive_model.partition(':')
+    cascade_models = f'{cheap_name}:{cheap_alias or "Production"}={best["threshold"]},{expensive_name}:{expensive_alias or "Production"}'
+    cascade_config = {
+        'config_name': args.config_name,
+        'cascade_models': cascade_models,
+        'data_version': args.data_version,
+        'target_accuracy': target_accuracy,
+        'cheap_accuracy': cheap_corrects.float().mean().item(),
+        'expensive_accuracy': expensive_corrects.float().mean().item(),
+        'cheap_latency_ms': 1000 * cheap_latency,
+        'expensive_latency_ms': 1000 * expensive_latency,
+        **best,
+    }
+
+    path_save_cfg = AppPath.SERVE_CONFIG_DIR / f'{args.config_name}.json'
+    with open(path_save_cfg, 'w+') as f:
+        json.dump(cascade_config, f, indent=4)
+    LOGGER.log.info(f'Config saved to {args.config_name}.json, serve it with CASCADE_MODELS={cascade_models}')
+
+    with mlflow.start_run(run_name=f'cascade_calibration - {args.cheap_model} -> {args.expensive_model}'):
+        mlflow.set_tags({'benchmark': 'cascade', 'data_version': args.data_version})
+        mlflow.log_params({'cheap_model': args.cheap_model, 'expensive_model': args.expensive_model,
+                           'target_accuracy': target_accuracy, 'batch_size': args.batch_size})
+        mlflow.log_metrics({key: value for key, value in cascade_config.items() if isinstance(value, float)})
+        mlflow.log_dict({'thresholds': results}, 'cascade_thresholds.json')
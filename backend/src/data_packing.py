@@ -0,0 +1,49 @@
+import json
+import argparse
+
+from utils import Logger, AppPath
+from config.data_config import CatDogData
+from dataset import pack_split
+from data_processing import split_hash, SPLITS
+
+LOGGER = Logger(__file__)
+LOGGER.log.info("Starting Data Packing")
+
+def packed_data_dir(data_version: str, img_size: int = CatDogData.img_size):
+    return AppPath.TRAIN_DATA_DIR / data_version / f'packed_{img_size}'
+
+def packed_hash(data_version: str, split: str):
+    """Source hash the split was packed from, None when it is not packed."""
+    index_path = packed_data_dir(data_version) / split / 'index.json'
+    if not (index_path.exists() and (index_path.parent / 'images.npy').exists()):
+        return None
+    with open(index_path) as f:
+        return json.load(f).get('source_hash')
+
+def stale_splits(data_version: str):
+    """Splits whose pack is missing or was built from other images than the split now holds."""
+    version_dir = AppPath.TRAIN_DATA_DIR / data_version
+    return [split for split in SPLITS if packed_hash(data_version, split) != split_hash(version_dir, split)]
+
+def packing_training_data(data_version: str, num_workers: int = 8, splits=None):
+    version_dir = AppPath.TRAIN_DATA_DIR / data_version
+    for split in splits if splits is not None else SPLITS:
+        num_samples = pack_split(
+            split_dir=version_dir / split,
+            out_dir=packed_data_dir(data_version) / split,
+            img_size=CatDogData.img_size,
+            label2id=CatDogData.label2id,
+            num_workers=num_workers,
+            source_hash=split_hash(version_dir, split)
+        )
+        LOGGER.log.info(f'Packed {num_samples} images of {split} to {packed_data_dir(data_version) / split}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_version', type=str, required=True,
+                        help='Version/directory to be packed')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='Number of threads for decoding images')
+    args = parser.parse_args()
+
+    packing_training_data(args.data_version, num_workers=args.num_workers)
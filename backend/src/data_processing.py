@@ -1,9 +1,12 @@
 import os
-import glob
+import csv
 import shutil
+import hashlib
 import argparse
-import numpy as np
+from pathlib import Path
 from typing import List
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import Logger, AppPath
 from config.data_config import CatDogData
@@ -11,51 +14,203 @@ from config.data_config import CatDogData
 LOGGER = Logger(__file__)
 LOGGER.log.info("Starting Data Preprocessing")
 
-def creating_training_data(version: str, source_dir: List[str], dest_dir: str, ratio: List[float]):
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+MANIFEST_NAME = 'manifest.csv'
+MANIFEST_FIELDS = ['path', 'class', 'split', 'sha256', 'size', 'mtime']
+SPLITS = ['train', 'val', 'test']
+
+def hash_file(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def assign_splits(rows, ratio: List[float]):
+    """Fill in the missing 'split' of the rows of one class, so the class is cut at the exact ratio.
+
+    Rows that already have a split keep it, the new ones are sorted by content hash and fill
+    whatever train/val/test is short of, so the cut is stable and the same image set always
+    gets the same splits.
+    """
+    num_train = int(len(rows) * ratio[0])
+    num_val = int(len(rows) * ratio[1])
+    missing = {
+        'train': num_train - sum(1 for row in rows if row['split'] == 'train'),
+        'val': num_val - sum(1 for row in rows if row['split'] == 'val'),
+    }
+    for row in sorted((row for row in rows if not row['split']), key=lambda row: row['sha256']):
+        split = next((split for split in ('train', 'val') if missing[split] > 0), 'test')
+        if split != 'test':
+            missing[split] -= 1
+        row['split'] = split
+
+def read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, newline='') as f:
+        return {row['path']: row for row in csv.DictReader(f)}
+
+def split_hash(version_dir, split: str):
+    """Content hash of one split of a data version, changes whenever an image is added, removed or modified.
+
+    Taken from the manifest sha256 of each image, or from the file names, sizes and mtimes for
+    versions built before manifests existed.
+    """
+    manifest = read_manifest(f'{version_dir}/{MANIFEST_NAME}')
+    if manifest:
+        entries = sorted(f'{row["class"]}/{os.path.basename(row["path"])}:{row["sha256"]}'
+                         for row in manifest.values() if row['split'] == split)
+    else:
+        entries = []
+        for cls in CatDogData.classes:
+            split_cls_dir = Path(version_dir) / split / cls
+            if split_cls_dir.exists():
+                entries.extend(f'{cls}/{path.name}:{path.stat().st_size}:{path.stat().st_mtime}'
+                               for path in sorted(split_cls_dir.iterdir()) if path.is_file())
+    return hashlib.sha256('\n'.join(entries).encode()).hexdigest()[:16]
+
+def version_hash(version_dir):
+    """Content hash of all the splits of a data version, see `split_hash`."""
+    digest = '|'.join(f'{split}:{split_hash(version_dir, split)}' for split in SPLITS)
+    return hashlib.sha256(digest.encode()).hexdigest()[:16]
+
+def write_manifest(manifest_path, rows):
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, manifest_path)
+
+def scan_sources(source_dir: List[str]):
+    files = []
+    for source in source_dir:
+        for cls in CatDogData.classes:
+            source_cls = Path(source) / cls
+            if source_cls.exists():
+                files.extend((str(path), cls) for path in sorted(source_cls.iterdir())
+                             if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS)
+    return files
+
+def link_file(src: str, dst: str, mode: str):
+    if os.path.exists(dst):
+        os.remove(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif mode == 'reflink':
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (OSError, ImportError):
+            pass
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return
+    # Copy is the fallback when links are not supported across devices/filesystems
+    shutil.copy(src, dst)
+
+def materialized_paths(rows, version_dir: str):
+    """Destination of every row under `version_dir`, {source path: split/class/name}.
+
+    Files keep their name, unless several sources of one split/class share it (e.g. raw and
+    collected data), those get a suffix from their source path so they never land on one file.
+    """
+    dsts = {row['path']: f'{version_dir}/{row["split"]}/{row["class"]}/{os.path.basename(row["path"])}' for row in rows}
+    counts = Counter(dsts.values())
+    for path, dst in dsts.items():
+        if counts[dst] > 1:
+            stem, ext = os.path.splitext(dst)
+            dsts[path] = f'{stem}-{hashlib.sha256(path.encode()).hexdigest()[:8]}{ext}'
+    return dsts
+
+def materialize(rows, version_dir: str, mode: str, num_workers: int, changed=()):
+    """Lay the rows out as split/class folders, `changed` are source paths whose content changed since the last run."""
+    dsts = materialized_paths(rows, version_dir)
+    expected = set(dsts.values())
+    # A changed file is linked (or copied) again even if it stays in the same split
+    jobs = [(path, dst) for path, dst in dsts.items() if path in changed or not os.path.exists(dst)]
+
+    for split in SPLITS:
+        for cls in CatDogData.classes:
+            split_cls_dir = f'{version_dir}/{split}/{cls}'
+            os.makedirs(split_cls_dir, exist_ok=True)
+            for name in os.listdir(split_cls_dir):
+                path = f'{split_cls_dir}/{name}'
+                if path not in expected:
+                    os.remove(path)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(lambda job: link_file(*job, mode), jobs))
+    LOGGER.log.info(f'Materialized {len(jobs)} new or changed files with {mode}')
+
+def creating_training_data(version: str, source_dir: List[str], dest_dir: str, ratio: List[float],
+                           materialize_mode: str = 'hardlink', num_workers: int = 8, base_version: str = None):
     LOGGER.log.info(f'Begin create train/val/test data')
     LOGGER.log.info(f'Version: {version}')
     LOGGER.log.info(f'Source dir: {source_dir}')
     LOGGER.log.info(f'Destination dir: {dest_dir}')
     LOGGER.log.info(f'Ratio [train, val]: {ratio}')
-    
+
+    version_dir = f'{dest_dir}/{version}'
+    os.makedirs(version_dir, exist_ok=True)
+    manifest_path = f'{version_dir}/{MANIFEST_NAME}'
+    current = read_manifest(manifest_path)
+    previous = current
+    if base_version is not None:
+        # Reuse hashes and split assignments of an earlier version, the current manifest wins on conflicts
+        previous = {**read_manifest(f'{dest_dir}/{base_version}/{MANIFEST_NAME}'), **current}
+
+    files = scan_sources(source_dir)
+    stats = {path: os.stat(path) for path, _ in files}
+
+    # Only files that are new or changed since the last manifest get hashed
+    to_hash = [path for path, _ in files
+               if path not in previous
+               or int(previous[path]['size']) != stats[path].st_size
+               or float(previous[path]['mtime']) != stats[path].st_mtime]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        hashes = dict(zip(to_hash, pool.map(hash_file, to_hash)))
+    LOGGER.log.info(f'Scanned {len(files)} files, hashed {len(to_hash)} new or changed files')
+
+    rows = []
+    for path, cls in files:
+        sha256 = hashes.get(path) or previous[path]['sha256']
+        old = previous.get(path)
+        split = old['split'] if old is not None and old['sha256'] == sha256 else ''
+        rows.append({
+            'path': path,
+            'class': cls,
+            'split': split,
+            'sha256': sha256,
+            'size': stats[path].st_size,
+            'mtime': stats[path].st_mtime,
+        })
     for cls in CatDogData.classes:
-        os.makedirs(f'{dest_dir}/{version}/train/{cls}', exist_ok=True)   
-        os.makedirs(f'{dest_dir}/{version}/val/{cls}', exist_ok=True)   
-        os.makedirs(f'{dest_dir}/{version}/test/{cls}', exist_ok=True)   
-    
+        assign_splits([row for row in rows if row['class'] == cls], ratio)
+    write_manifest(manifest_path, rows)
+
     for cls in CatDogData.classes:
-        LOGGER.log.info(f'Processing {cls} ...')
-        
-        all_cls_files = []
-        for source in source_dir:
-            source_cls = f'{source}/{cls}'
-            all_cls_files.extend(glob.glob(f'{source_cls}/*.jpg'))
-            
-        num_files = len(all_cls_files)
-        LOGGER.log.info(f'Number of files of {cls}: {num_files}')
-        
-        all_cls_files = np.array(all_cls_files)
-        shuffle_indices = np.random.permutation(num_files)
-        
-        num_train = int(num_files * ratio[0])
-        num_val = int(num_files * ratio[1])
-        
-        train_files = all_cls_files[shuffle_indices][:num_train]
-        val_files = all_cls_files[shuffle_indices][num_train:num_train+num_val]
-        test_files = all_cls_files[shuffle_indices][num_train+num_val:]
-        
-        for file in train_files:
-            shutil.copy(file, f'{dest_dir}/{version}/train/{cls}/{os.path.basename(file)}')
-        for file in val_files:
-            shutil.copy(file, f'{dest_dir}/{version}/val/{cls}/{os.path.basename(file)}')
-        for file in test_files:
-            shutil.copy(file, f'{dest_dir}/{version}/test/{cls}/{os.path.basename(file)}')
-    
-    LOGGER.log.info(f'Finish create train/val/test data')
-        
+        counts = {split: sum(1 for row in rows if row['class'] == cls and row['split'] == split) for split in SPLITS}
+        LOGGER.log.info(f'Number of files of {cls}: {counts}')
+
+    # Files of this version folder whose source changed since its last manifest
+    changed = {row['path'] for row in rows if row['path'] in current and current[row['path']]['sha256'] != row['sha256']}
+    materialize(rows, version_dir, materialize_mode, num_workers, changed=changed)
+
+    LOGGER.log.info(f'Finish create train/val/test data, manifest saved to {manifest_path}')
+    return rows
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--version', type=str, required=True, 
+    parser.add_argument('--version', type=str, required=True,
                         help='Version of the data, e.g. v1, as the name of the folder')
     parser.add_argument('--merge_collected', action='store_true',
                         help='Merge collected data to raw data')
@@ -63,13 +218,19 @@ if __name__ == '__main__':
                         help='Destination of directory to save the train/val/test data')
     parser.add_argument('--ratio', type=float, nargs='+', default=[0.6, 0.2],
                         help='Ratio of train/val/test data')
+    parser.add_argument('--materialize', type=str, default='hardlink',
+                        choices=['hardlink', 'reflink', 'symlink', 'copy'],
+                        help='How to lay out train/val/test folders next to the manifest')
+    parser.add_argument('--base_version', type=str, default=None,
+                        help='Earlier data version whose manifest seeds hashes and split assignments')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='Number of threads for hashing and linking files')
     args = parser.parse_args()
-    
-    if os.path.exists(AppPath.TRAIN_DATA_DIR / args.version):
-        shutil.rmtree(AppPath.TRAIN_DATA_DIR / args.version)
-        
+
     source_dir = [AppPath.CATDOG_RAW_DIR]
     if args.merge_collected:
         source_dir += [AppPath.COLLECTED_DATA_DIR]
-    
-    creating_training_data(args.version, source_dir, args.dest_dir, args.ratio)
\ No newline at end of file
+
+    creating_training_data(args.version, source_dir, args.dest_dir, args.ratio,
+                           materialize_mode=args.materialize, num_workers=args.num_workers,
+                           base_version=args.base_version)
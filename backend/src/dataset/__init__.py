@@ -0,0 +1 @@
+from .packed_dataset import PackedDataset, BatchTransform, pack_split
@@ -0,0 +1,100 @@
+import os
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import torch
+from torch.utils.data import Dataset
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+def _decode(path: str, img_size: int):
+    # Same PIL bilinear resize as transforms.Resize, so packed pixels match the ImageFolder pipeline
+    with Image.open(path) as img:
+        img = img.convert('RGB').resize((img_size, img_size), Image.BILINEAR)
+        return np.asarray(img).transpose(2, 0, 1)
+
+def pack_split(split_dir, out_dir, img_size: int, label2id: dict, num_workers: int = 8, source_hash: str = None):
+    """Decode every image of `split_dir/<class>/*` once into `out_dir/images.npy` (N, 3, H, W uint8).
+
+    `source_hash` identifies the split content the pack was built from, it is kept in `index.json`.
+    """
+    split_dir, out_dir = Path(split_dir), Path(out_dir)
+    samples = []
+    for cls, label in label2id.items():
+        cls_dir = split_dir / cls
+        if cls_dir.exists():
+            samples.extend((str(path), label) for path in sorted(cls_dir.iterdir())
+                           if path.suffix.lower() in IMAGE_EXTENSIONS)
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_dir / 'images.npy.tmp'
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(samples), 3, img_size, img_size))
+
+    def write(i):
+        images[i] = _decode(samples[i][0], img_size)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(write, range(len(samples))))
+    images.flush()
+    del images
+    os.replace(tmp_path, out_dir / 'images.npy')
+
+    np.save(out_dir / 'labels.npy', np.array([label for _, label in samples], dtype=np.int64))
+    with open(out_dir / 'index.json', 'w') as f:
+        json.dump({'img_size': img_size, 'label2id': label2id, 'source_hash': source_hash,
+                   'paths': [path for path, _ in samples]}, f, indent=4)
+    return len(samples)
+
+class PackedDataset(Dataset):
+    """Serve packed uint8 images as zero-copy views of a memory-mapped array.
+
+    Only the cheap per-sample work runs on the fly: an optional random horizontal
+    flip and normalization with `mean`/`std`. With `raw=True` samples stay uint8 and
+    the work is left to a `BatchTransform` on whole batches.
+    """
+    def __init__(self, root, mean, std, random_flip: bool = False, raw: bool = False):
+        root = Path(root)
+        # Copy-on-write mapping gives writable views for torch without touching the file
+        self.images = np.load(root / 'images.npy', mmap_mode='c')
+        self.labels = np.load(root / 'labels.npy')
+        with open(root / 'index.json') as f:
+            index = json.load(f)
+        self.class_to_idx = index['label2id']
+        self.source_hash = index.get('source_hash')
+        # Same layout as ImageFolder.samples
+        self.samples = list(zip(index['paths'], self.labels.tolist()))
+        self.classes = list(self.class_to_idx)
+        self.targets = self.labels.tolist()
+        self.random_flip = random_flip
+        self.raw = raw
+        self.scale = 1.0 / (255.0 * torch.tensor(std, dtype=torch.float32).view(3, 1, 1))
+        self.shift = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1) / torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(self.images[idx])
+        if self.raw:
+            return image, int(self.labels[idx])
+        if self.random_flip and torch.rand(1).item() < 0.5:
+            image = image.flip(-1)
+        image = image.to(torch.float32).mul_(self.scale).sub_(self.shift)
+        return image, int(self.labels[idx])
+
+class BatchTransform:
+    """Random horizontal flip and normalization of a whole (N, 3, H, W) uint8 batch in one vectorized pass."""
+    def __init__(self, mean, std, random_flip: bool = False):
+        self.random_flip = random_flip
+        self.scale = 1.0 / (255.0 * torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1))
+        self.shift = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1) / torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+    def __call__(self, batch):
+        if self.random_flip:
+            flip = torch.rand(batch.size(0), 1, 1, 1, device=batch.device) < 0.5
+            batch = torch.where(flip, batch.flip(-1), batch)
+        return batch.to(torch.float32).mul_(self.scale.to(batch.device)).sub_(self.shift.to(batch.device))
@@ -1,3 +1,8 @@
 from .trainer import Trainer
 from .resnet import create_resnet
-from .mobilenet import create_mobilenet
\ No newline at end of file
+from .mobilenet import create_mobilenet
+from .export import EXPORTERS, EXPORT_FILES, EXPORT_ARTIFACT_DIR
+from .feature_cache import FeatureCache, split_head, feature_cache_key
+from .optimizations import enable_compile_cache, autocast_context, grad_disabled_context, to_memory_format
+from .checkpoint import CheckpointManager, MetricLogger, clone_state
+from .distillation import DistillationLoss, DistillationDataset, measure_cpu_latency
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import time
+import queue
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from mlflow.entities import Metric
+from mlflow.tracking import MlflowClient
+
+from utils.logger import Logger
+
+LOGGER = Logger(__file__)
+
+# Upper bound of metrics per MlflowClient.log_batch request
+MAX_METRICS_PER_BATCH = 1000
+
+def clone_state(state):
+    """Detached CPU copy of a (nested) state dict, safe to keep while training keeps updating the live tensors."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: clone_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(clone_state(value) for value in state)
+    return state
+
+class CheckpointManager:
+    """Snapshots of the training state under `<root>/<name>.pt`.
+
+    `snapshot` copies the state on the calling thread so the trainer can move on, the
+    `torch.save` to disk runs on a single background thread and is replaced atomically,
+    so an interrupted write never corrupts the previous checkpoint.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.pending = None
+
+    def path(self, name: str):
+        return self.root / f'{name}.pt'
+
+    def save(self, name: str, state):
+        state = clone_state(state)
+        # Wait for the previous write, at most one snapshot is held besides the live weights
+        self.wait()
+        self.pending = self.writer.submit(self._write, self.path(name), state)
+
+    def _write(self, path, state):
+        tmp_path = path.with_suffix('.pt.tmp')
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def load(self, name: str):
+        path = self.path(name)
+        if not path.exists():
+            return None
+        LOGGER.log.info(f'Resuming from checkpoint {path}')
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+    def remove(self, name: str):
+        self.wait()
+        self.path(name).unlink(missing_ok=True)
+
+    def close(self):
+        self.wait()
+        self.writer.shutdown()
+
+class MetricLogger:
+    """Queue metrics on the training thread and send them with `log_batch` from a background thread."""
+    def __init__(self, run_id: str, flush_interval: float = 5.0):
+        self.run_id = run_id
+        self.flush_interval = flush_interval
+        self.client = MlflowClient()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='metric-logger', daemon=True)
+        self.thread.start()
+
+    def log(self, metrics: dict, step: int = 0):
+        timestamp = int(time.time() * 1000)
+        for key, value in metrics.items():
+            self.queue.put(Metric(key=key, value=float(value), timestamp=timestamp, step=step))
+
+    def _run(self):
+        closed = False
+        while not closed:
+            metrics = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(metrics) < MAX_METRICS_PER_BATCH:
+                try:
+                    metric = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if metric is None:
+                    closed = True
+                    break
+                metrics.append(metric)
+            if metrics:
+                try:
+                    self.client.log_batch(self.run_id, metrics=metrics)
+                except Exception as e:
+                    LOGGER.log.error(f'Logging {len(metrics)} metrics failed: {e}')
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,61 @@
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+class DistillationLoss(nn.Module):
+    """Temperature-scaled knowledge distillation loss (Hinton et al.).
+
+    `alpha` weights the KL divergence to the teacher's softened distribution, the rest
+    goes to cross-entropy on the hard labels. The soft term is scaled by T^2 so its
+    gradients keep the same magnitude whatever the temperature.
+    """
+    def __init__(self, temperature: float = 4.0, alpha: float = 0.9):
+        super().__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+        self.cross_entropy = nn.CrossEntropyLoss()
+
+    def forward(self, outputs, labels, teacher_logits):
+        outputs = outputs.float()
+        soft_loss = F.kl_div(
+            F.log_softmax(outputs / self.temperature, dim=1),
+            F.softmax(teacher_logits.float() / self.temperature, dim=1),
+            reduction='batchmean'
+        ) * self.temperature ** 2
+        return self.alpha * soft_loss + (1 - self.alpha) * self.cross_entropy(outputs, labels)
+
+class DistillationDataset(Dataset):
+    """Pair every sample of `data` with the teacher logits cached for it, yields (inputs, label, logits).
+
+    Pairing is by index, the logits must come from a FeatureCache of the same split so the
+    samples are checked to match.
+    """
+    def __init__(self, data, teacher_logits):
+        if len(data) != len(teacher_logits):
+            raise ValueError(f'{len(teacher_logits)} teacher logits for {len(data)} samples')
+        self.data = data
+        self.teacher_logits = teacher_logits
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        inputs, label = self.data[idx]
+        return inputs, label, self.teacher_logits[idx]
+
+def measure_cpu_latency(model, img_size: int, batch_size: int = 1, iterations: int = 50, warmup: int = 5):
+    """Median milliseconds per forward pass of a `batch_size` batch on CPU."""
+    model = copy.deepcopy(model).to('cpu').eval()
+    inputs = torch.randn(batch_size, 3, img_size, img_size)
+    timings = []
+    with torch.inference_mode():
+        for i in range(warmup + iterations):
+            start_time = time.perf_counter()
+            model(inputs)
+            if i >= warmup:
+                timings.append(time.perf_counter() - start_time)
+    return 1000 * sorted(timings)[len(timings) // 2]
@@ -0,0 +1,75 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+EXPORT_ARTIFACT_DIR = 'export'
+EXPORT_FILES = {
+    'torchscript': 'model.torchscript.pt',
+    'onnx': 'model.onnx',
+    'quantized_dynamic': 'model.quantized_dynamic.pt',
+    'quantized_static': 'model.quantized_static.pt',
+}
+
+def _example_input(img_size: int, batch_size: int = 1):
+    return torch.randn(batch_size, 3, img_size, img_size)
+
+def export_torchscript(model: nn.Module, img_size: int, path: str):
+    model = copy.deepcopy(model).cpu().eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, _example_input(img_size))
+        frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path)
+    return path
+
+def export_onnx(model: nn.Module, img_size: int, path: str, opset_version: int = 17):
+    model = copy.deepcopy(model).cpu().eval()
+    torch.onnx.export(
+        model,
+        _example_input(img_size),
+        path,
+        input_names=['input'],
+        output_names=['output'],
+        dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+        opset_version=opset_version
+    )
+    return path
+
+def export_quantized_dynamic(model: nn.Module, img_size: int, path: str):
+    # Dynamic quantization only covers nn.Linear, i.e. the fc/classifier heads
+    model = copy.deepcopy(model).cpu().eval()
+    quantized = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, _example_input(img_size))
+    torch.jit.save(traced, path)
+    return path
+
+def export_quantized_static(model: nn.Module, img_size: int, path: str, calibration_loader=None, num_calibration_batches: int = 8):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = copy.deepcopy(model).cpu().eval()
+    example_input = _example_input(img_size)
+    prepared = prepare_fx(model, get_default_qconfig_mapping('x86'), example_inputs=(example_input,))
+
+    with torch.no_grad():
+        if calibration_loader is None:
+            prepared(_example_input(img_size, batch_size=16))
+        else:
+            for i, (inputs, _) in enumerate(calibration_loader):
+                if i >= num_calibration_batches:
+                    break
+                prepared(inputs)
+
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example_input)
+    torch.jit.save(traced, path)
+    return path
+
+EXPORTERS = {
+    'torchscript': export_torchscript,
+    'onnx': export_onnx,
+    'quantized_dynamic': export_quantized_dynamic,
+    'quantized_static': export_quantized_static,
+}
@@ -0,0 +1,75 @@
+import copy
+import hashlib
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from utils.logger import Logger
+
+LOGGER = Logger(__file__)
+
+def split_head(model: nn.Module):
+    """Split a model built by create_resnet/create_mobilenet into (frozen backbone, trainable head).
+
+    The head is returned by reference, so training it updates `model` in place.
+    """
+    backbone = copy.deepcopy(model)
+    if hasattr(model, 'fc'):
+        head = model.fc
+        backbone.fc = nn.Identity()
+    elif hasattr(model, 'classifier'):
+        # create_mobilenet only freezes features/avgpool, the whole classifier stays trainable
+        head = model.classifier
+        backbone.classifier = nn.Identity()
+    else:
+        raise ValueError(f'Unsupported model for feature caching: {model.__class__.__name__}')
+
+    for param in backbone.parameters():
+        param.requires_grad = False
+    return backbone.eval(), head
+
+def feature_cache_key(model_name: str, data_version: str, data_format: str, transform, content_hash: str) -> str:
+    """`content_hash` is the hash of the images of the data version, a rebuilt version gets a new key."""
+    return hashlib.sha256(f'{model_name}|{data_version}|{content_hash}|{data_format}|{transform}'.encode()).hexdigest()[:16]
+
+def sample_paths(data):
+    """Image paths of an ImageFolder/PackedDataset in sample order, None for other datasets."""
+    samples = getattr(data, 'samples', None)
+    return [str(path) for path, _ in samples] if samples is not None else None
+
+class FeatureCache:
+    """Pooled backbone embeddings of each split, stored as `<root>/<key>/<split>.pt`.
+
+    The sample paths are stored alongside, a cached split whose images or image order differ
+    from `data` is extracted again, since callers pair the cached rows with samples by index.
+    """
+    def __init__(self, root, key: str):
+        self.dir = Path(root) / key
+        self.key = key
+
+    def load_or_extract(self, split: str, backbone: nn.Module, data, batch_size: int = 64, device: str = 'cpu', num_workers: int = 0):
+        path = self.dir / f'{split}.pt'
+        paths = sample_paths(data)
+        if path.exists():
+            cached = torch.load(path)
+            if paths is None or cached.get('paths') == paths:
+                LOGGER.log.info(f'Feature cache hit: {path}')
+                return TensorDataset(cached['features'], cached['labels'])
+            LOGGER.log.info(f'Feature cache {path} was built from other samples, extracting again')
+
+        LOGGER.log.info(f'Extracting {split} features to {path}')
+        backbone = backbone.to(device)
+        features, labels = [], []
+        with torch.no_grad():
+            for inputs, targets in DataLoader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers):
+                features.append(backbone(inputs.to(device)).cpu())
+                labels.append(targets)
+        features, labels = torch.cat(features), torch.cat(labels)
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        torch.save({'features': features, 'labels': labels, 'paths': paths}, tmp_path)
+        tmp_path.replace(path)
+        return TensorDataset(features, labels)
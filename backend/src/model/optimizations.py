@@ -0,0 +1,24 @@
+import os
+import contextlib
+
+import torch
+
+def enable_compile_cache(cache_dir):
+    # Inductor reuses compiled graphs from this directory across runs
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(cache_dir))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+def autocast_context(device: str, enabled: bool):
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.split(':')[0], dtype=torch.bfloat16)
+
+def grad_disabled_context(inference_mode: bool):
+    return torch.inference_mode() if inference_mode else torch.no_grad()
+
+def to_memory_format(inputs, channels_last: bool):
+    # Cached features are 2D, only image batches can be channels_last
+    if channels_last and inputs.dim() == 4:
+        return inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
@@ -1,4 +1,5 @@
 import os
+import time
 import mlflow
 
 import torch
@@ -6,6 +7,9 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 
 from utils.logger import Logger
+from utils.app_path import AppPath
+from .optimizations import enable_compile_cache, autocast_context, grad_disabled_context, to_memory_format
+from .checkpoint import CheckpointManager, MetricLogger, clone_state
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -39,6 +43,20 @@ class Trainer:
         device: str,
         best_model_metric: str,
         verbose=False,
+        num_workers: int = 0,
+        persistent_workers: bool = False,
+        prefetch_factor: int = 2,
+        pin_memory: bool = False,
+        train_batch_transform=None,
+        eval_batch_transform=None,
+        logged_model=None,
+        autocast_bf16: bool = False,
+        channels_last: bool = False,
+        compile: bool = False,
+        inference_mode: bool = False,
+        checkpoint_dir=None,
+        resume: bool = False,
+        distillation_loss=None,
     ) -> None:
         self.model = model.to(device)
         self.num_epochs = num_epochs
@@ -52,82 +70,214 @@ class Trainer:
         self.device = device
         self.best_model_metric = best_model_metric
         self.verbose = verbose
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers and num_workers > 0
+        self.prefetch_factor = prefetch_factor
+        self.pin_memory = pin_memory
+        self.train_batch_transform = train_batch_transform
+        self.eval_batch_transform = eval_batch_transform
+        # Model logged to MLflow, e.g. the full network when only its head is trained on cached features
+        self.logged_model = logged_model if logged_model is not None else self.model
+        self.autocast_bf16 = autocast_bf16
+        self.channels_last = channels_last
+        self.compile = compile
+        self.inference_mode = inference_mode
+        # Latest epoch state is written to disk in the background so an interrupted run can resume
+        self.checkpoints = CheckpointManager(checkpoint_dir) if checkpoint_dir is not None else None
+        self.resume = resume
+        self.metric_logger = None
+        # Training batches then carry teacher logits, validation stays plain cross-entropy
+        self.distillation_loss = distillation_loss
+        
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        # Forward passes go through the compiled wrapper, weights and state_dict stay on self.model
+        self.forward_model = self.model
+        if self.compile:
+            enable_compile_cache(AppPath.COMPILE_CACHE_DIR)
+            self.forward_model = torch.compile(self.model)
+    
+    def create_loader(self, data, shuffle: bool):
+        loader_kwargs = {}
+        if self.num_workers > 0:
+            loader_kwargs['persistent_workers'] = self.persistent_workers
+            loader_kwargs['prefetch_factor'] = self.prefetch_factor
+        return DataLoader(
+            data,
+            batch_size=self.batch_size,
+            shuffle=shuffle,
+            num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            **loader_kwargs
+        )
+    
+    def to_device(self, inputs, labels, batch_transform):
+        inputs = inputs.to(self.device, non_blocking=self.pin_memory)
+        labels = labels.to(self.device, non_blocking=self.pin_memory)
+        if batch_transform is not None:
+            inputs = batch_transform(inputs)
+        return to_memory_format(inputs, self.channels_last), labels
+        
+    def log_metrics(self, metrics: dict, step: int = 0):
+        if self.metric_logger is not None:
+            self.metric_logger.log(metrics, step=step)
+        else:
+            mlflow.log_metrics(metrics, step=step)
         
     def train(self):
-        optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate, weight_decay=self.weight_decay)
+        if self.best_model_metric not in ('val_loss', 'val_acc'):
+            raise ValueError(f"Invalid best_model_metric: {self.best_model_metric}")
+        
+        trainable_params = [param for param in self.model.parameters() if param.requires_grad]
+        optimizer = torch.optim.Adam(trainable_params, lr=self.learning_rate, weight_decay=self.weight_decay)
         self.criterion = nn.CrossEntropyLoss()
         
-        train_loader = DataLoader(self.train_data, batch_size=self.batch_size, shuffle=True)
-        val_loader = DataLoader(self.val_data, batch_size=self.batch_size, shuffle=False)
+        train_loader = self.create_loader(self.train_data, shuffle=True)
+        val_loader = self.create_loader(self.val_data, shuffle=False)
         
         run_name = f"{self.mlflow_log_params['model_name']} - {self.mlflow_log_tags['data_version']}"
         
-        with mlflow.start_run(run_name=run_name) as run:
-            mlflow.set_tags(self.mlflow_log_tags)
-            
-            mlflow.log_params({
-                'optimizer': optimizer.__class__.__name__,
-                'criterion': self.criterion.__class__.__name__
-            })
-            mlflow.log_params(self.mlflow_log_params)
-            
-            best_val_loss = float('inf')
-            best_val_acc = float('-inf')
-            best_val_loss_state_dict = None
-            best_val_acc_state_dict = None
+        best_val_loss = float('inf')
+        best_val_acc = float('-inf')
+        best_model_state_dict = None
+        start_epoch = 0
+        
+        checkpoint = self.checkpoints.load('last') if self.checkpoints is not None and self.resume else None
+        if checkpoint is not None and checkpoint.get('params') != self.mlflow_log_params:
+            raise ValueError(f"Checkpoint of run {checkpoint['run_id']} was saved with params {checkpoint.get('params')}, "
+                             f"not {self.mlflow_log_params}, start a new run without --resume")
+        if checkpoint is not None:
+            self.model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            start_epoch = checkpoint['epoch'] + 1
+            best_val_loss = checkpoint['best_val_loss']
+            best_val_acc = checkpoint['best_val_acc']
+            best_model_state_dict = checkpoint['best_model_state_dict']
+            LOGGER.log.info(f"Resuming run {checkpoint['run_id']} at epoch {start_epoch+1}/{self.num_epochs}")
+        
+        # A resumed run keeps logging to the MLflow run it started in
+        with mlflow.start_run(run_id=checkpoint['run_id'] if checkpoint is not None else None,
+                              run_name=None if checkpoint is not None else run_name) as run:
+            if checkpoint is None:
+                mlflow.set_tags(self.mlflow_log_tags)
+                
+                mlflow.log_params({
+                    'optimizer': optimizer.__class__.__name__,
+                    'criterion': (self.distillation_loss or self.criterion).__class__.__name__
+                })
+                mlflow.log_params(self.mlflow_log_params)
+                mlflow.log_params({
+                    'num_workers': self.num_workers,
+                    'persistent_workers': self.persistent_workers,
+                    'prefetch_factor': self.prefetch_factor,
+                    'pin_memory': self.pin_memory,
+                    'batched_transform': self.train_batch_transform is not None,
+                    'autocast_bf16': self.autocast_bf16,
+                    'channels_last': self.channels_last,
+                    'compile': self.compile,
+                    'inference_mode': self.inference_mode
+                })
             
-            for epoch in range(self.num_epochs):
-                self.model.train()
-                running_loss = 0.0 
-                running_corrects = 0
-                running_total = 0
-                for inputs, labels in train_loader:
-                    inputs, labels = inputs.to(self.device), labels.to(self.device)
+            # Metrics are sent with log_batch from a background thread, epochs never wait on the tracking server
+            self.metric_logger = MetricLogger(run.info.run_id)
+            try:
+                for epoch in range(start_epoch, self.num_epochs):
+                    self.model.train()
+                    running_loss = 0.0 
+                    running_corrects = 0
+                    running_total = 0
+                    data_time = 0.0
+                    compute_time = 0.0
                     
-                    optimizer.zero_grad()
-                    outputs = self.model(inputs)
-                    loss = self.criterion(outputs, labels)
-                    loss.backward()
-                    optimizer.step()
+                    epoch_start = time.perf_counter()
+                    batch_start = epoch_start
+                    for batch in train_loader:
+                        compute_start = time.perf_counter()
+                        data_time += compute_start - batch_start
+                        
+                        inputs, labels = self.to_device(batch[0], batch[1], self.train_batch_transform)
+                        
+                        optimizer.zero_grad()
+                        with autocast_context(self.device, self.autocast_bf16):
+                            outputs = self.forward_model(inputs)
+                            if self.distillation_loss is not None:
+                                teacher_logits = batch[2].to(self.device, non_blocking=self.pin_memory)
+                                loss = self.distillation_loss(outputs, labels, teacher_logits)
+                            else:
+                                loss = self.criterion(outputs, labels)
+                        loss.backward()
+                        optimizer.step()
+                        
+                        running_loss += loss.item()
+                        _, predicted = torch.max(outputs.data, dim=1)
+                        running_corrects += (predicted == labels).sum().item()
+                        running_total += labels.size(0)
+                        
+                        batch_start = time.perf_counter()
+                        compute_time += batch_start - compute_start
                     
-                    running_loss += loss.item()
-                    _, predicted = torch.max(outputs.data, dim=1)
-                    running_corrects += (predicted == labels).sum().item()
-                    running_total += labels.size(0)
+                    epoch_time = time.perf_counter() - epoch_start
+                    epoch_loss = running_loss / len(train_loader)
+                    epoch_acc = running_corrects / running_total
                     
-                epoch_loss = running_loss / len(train_loader)
-                epoch_acc = running_corrects / running_total
-
-                mlflow.log_metric('training_loss', f'{epoch_loss:.4f}', step=epoch)
-                mlflow.log_metric('training_acc', f'{epoch_acc:.4f}', step=epoch)
-                
-                val_loss, val_acc = self.evaluate(val_loader, epoch=epoch)
-                
-                if best_val_loss > val_loss:
-                    best_val_loss = val_loss
-                    best_val_loss_state_dict = self.model.state_dict()
-                
-                if best_val_acc < val_acc:
-                    best_val_acc = val_acc
-                    best_val_acc_state_dict = self.model.state_dict()
-                
-                if self.verbose:
-                    LOGGER.log.info(f"Epoch {epoch+1}/{self.num_epochs} Loss: {epoch_loss:.4f} - Acc: {epoch_acc:.4f} - Val Loss: {val_loss:.4f} - Val Acc: {val_acc:.4f}")
+                    self.log_metrics({
+                        'training_loss': epoch_loss,
+                        'training_acc': epoch_acc,
+                        'images_per_sec': running_total / epoch_time,
+                        'data_wait_sec': data_time,
+                        'compute_sec': compute_time,
+                        'data_wait_ratio': data_time / epoch_time,
+                    }, step=epoch)
+                    if self.verbose:
+                        LOGGER.log.info(f"Epoch {epoch+1} throughput: {running_total / epoch_time:.1f} images/sec - Data wait: {data_time:.2f}s - Compute: {compute_time:.2f}s")
+                    
+                    val_loss, val_acc = self.evaluate(val_loader, epoch=epoch)
+                    
+                    # state_dict() returns the live tensors, the best weights need their own copy
+                    if best_val_loss > val_loss:
+                        best_val_loss = val_loss
+                        if self.best_model_metric == "val_loss":
+                            best_model_state_dict = clone_state(self.model.state_dict())
+                    
+                    if best_val_acc < val_acc:
+                        best_val_acc = val_acc
+                        if self.best_model_metric == "val_acc":
+                            best_model_state_dict = clone_state(self.model.state_dict())
+                    
+                    if self.checkpoints is not None:
+                        self.checkpoints.save('last', {
+                            'run_id': run.info.run_id,
+                            'params': self.mlflow_log_params,
+                            'epoch': epoch,
+                            'model': self.model.state_dict(),
+                            'optimizer': optimizer.state_dict(),
+                            'best_val_loss': best_val_loss,
+                            'best_val_acc': best_val_acc,
+                            'best_model_state_dict': best_model_state_dict,
+                        })
                     
-            mlflow.log_metric("best_val_loss", best_val_loss)
-            mlflow.log_metric("best_val_acc", best_val_acc)
+                    if self.verbose:
+                        LOGGER.log.info(f"Epoch {epoch+1}/{self.num_epochs} Loss: {epoch_loss:.4f} - Acc: {epoch_acc:.4f} - Val Loss: {val_loss:.4f} - Val Acc: {val_acc:.4f}")
+                
+                self.log_metrics({'best_val_loss': best_val_loss, 'best_val_acc': best_val_acc})
+            finally:
+                self.metric_logger.close()
+                self.metric_logger = None
             
             if self.best_model_metric == "val_loss":
-                best_model_state_dict = best_val_loss_state_dict
                 LOGGER.log.info(f"Best model metric: {self.best_model_metric} - Best val loss: {best_val_loss:.4f}")
-            elif self.best_model_metric == "val_acc":
-                best_model_state_dict = best_val_acc_state_dict
-                LOGGER.log.info(f"Best model metric: {self.best_model_metric} - Best val acc: {best_val_acc:.4f}")
             else:
-                raise ValueError(f"Invalid best_model_metric: {self.best_model_metric}")
+                LOGGER.log.info(f"Best model metric: {self.best_model_metric} - Best val acc: {best_val_acc:.4f}")
             
             self.model.load_state_dict(best_model_state_dict)
-            mlflow.pytorch.log_model(self.model, "model")
+            mlflow.pytorch.log_model(self.logged_model, "model")
+        
+        if self.checkpoints is not None:
+            # The run is complete, a later --resume starts a new one
+            self.checkpoints.remove('last')
+            self.checkpoints.close()
+        
+        return {'run_id': run.info.run_id, 'best_val_loss': best_val_loss, 'best_val_acc': best_val_acc}
         
     def evaluate(self, val_loader, epoch):
         self.model.eval()
@@ -135,13 +285,13 @@ class Trainer:
         running_corrects = 0
         running_total = 0
         
-        with torch.no_grad():
+        with grad_disabled_context(self.inference_mode), autocast_context(self.device, self.autocast_bf16):
             for inputs, labels in val_loader:
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
+                inputs, labels = self.to_device(inputs, labels, self.eval_batch_transform)
                 
-                outputs = self.model(inputs)
+                outputs = self.forward_model(inputs)
                 
-                loss = self.criterion(outputs, labels)
+                loss = self.criterion(outputs.float(), labels)
                 running_loss += loss.item()
                 
                 _, predicted = torch.max(outputs.data, dim=1)
@@ -151,13 +301,12 @@ class Trainer:
         val_loss = running_loss / len(val_loader)
         val_acc = running_corrects / running_total
         
-        mlflow.log_metric("val_loss", f"{val_loss:.4f}", step=epoch)
-        mlflow.log_metric("val_acc", f"{val_acc:.4f}", step=epoch)
+        self.log_metrics({'val_loss': val_loss, 'val_acc': val_acc}, step=epoch)
         
         return val_loss, val_acc
             
     def test(self, test_data):
-        test_loader = DataLoader(test_data, batch_size=self.batch_size, shuffle=False)
+        test_loader = self.create_loader(test_data, shuffle=False)
         return self.evaluate(test_loader, epoch=0)
     
     def predict(self, image, transform, class_names):
@@ -1,13 +1,19 @@
 import os
 import json
 import argparse
+import tempfile
 from dataclasses import asdict
 
+import torchvision
+from torch.utils.data import DataLoader
+
 import mlflow
 from mlflow.tracking import MlflowClient
 
 from utils import Logger, AppPath
 from config.serve_config import BaseServeConfig
+from config.data_config import CatDogData
+from model import EXPORTERS, EXPORT_FILES, EXPORT_ARTIFACT_DIR
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -15,17 +21,46 @@ load_dotenv()
 LOGGER = Logger(__file__)
 LOGGER.log.info('Starting Model Registry')
 
+def export_model(client, run, export_formats):
+    run_id = run.info.run_id
+    model = mlflow.pytorch.load_model(f'runs:/{run_id}/model', map_location='cpu')
+    img_size = int(run.data.params['image_size'])
+    
+    calibration_loader = None
+    data_path = AppPath.TRAIN_DATA_DIR / run.data.tags.get('data_version', '') / 'val'
+    if 'quantized_static' in export_formats and data_path.exists():
+        calibration_data = torchvision.datasets.ImageFolder(root=data_path, transform=CatDogData.test_transform)
+        calibration_loader = DataLoader(calibration_data, batch_size=16, shuffle=False)
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for export_format in export_formats:
+            path = os.path.join(tmp_dir, EXPORT_FILES[export_format])
+            try:
+                if export_format == 'quantized_static':
+                    EXPORTERS[export_format](model, img_size, path, calibration_loader=calibration_loader)
+                else:
+                    EXPORTERS[export_format](model, img_size, path)
+                client.log_artifact(run_id, path, artifact_path=EXPORT_ARTIFACT_DIR)
+                LOGGER.log.info(f'Exported {export_format} to {EXPORT_ARTIFACT_DIR}/{EXPORT_FILES[export_format]}')
+            except Exception as e:
+                LOGGER.log.error(f'Export {export_format} failed: {e}')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_name', type=str, default='raw_data',
                         help='Name of the config file')
     parser.add_argument('--filter_string', type=str, default="",
                         help='Filter string or searching runs in MLflow Tracking Server')
+    parser.add_argument('--sweep_id', type=str, default=None,
+                        help='Only select among the trials of this model_sweep.py run')
     parser.add_argument('--best_metric', type=str, default='best_val_loss',
                         choices=['best_val_loss', 'best_val_acc'],
                         help='Metric for selecting the best model')
     parser.add_argument('--model_alias', type=str, default='Production',
                         help='Alias tag of the model. Help to identify the model in the model registry.')
+    parser.add_argument('--export_formats', type=str, nargs='*', default=list(EXPORTERS.keys()),
+                        choices=list(EXPORTERS.keys()),
+                        help='Optimized inference artifacts to export and log next to the model')
     args = parser.parse_args()
     
     MLFLOW_TRACKING_URI = os.getenv('MLFLOW_TRACKING_URI')
@@ -37,10 +72,19 @@ if __name__ == '__main__':
     
     client = MlflowClient()
     
+    # Only training runs log the metric, sweep parents, benchmark and calibration runs share the
+    # experiment but have no model to register and would otherwise sort last
+    filters = [f'metrics.{args.best_metric} > -1']
+    if args.filter_string:
+        filters.append(args.filter_string)
+    if args.sweep_id:
+        filters.append(f"tags.sweep_id = '{args.sweep_id}'")
+    filter_string = ' and '.join(filters)
+    
     try:
         best_run = client.search_runs(
             experiment_ids,
-            filter_string=args.filter_string,
+            filter_string=filter_string,
             order_by=[f'metrics.{args.best_metric} desc']
         )[-1]
     except:
@@ -58,6 +102,8 @@ if __name__ == '__main__':
     
     run_id = best_run.info.run_id
     model_uri = f'runs:/{run_id}/model'
+    export_model(client, best_run, args.export_formats)
+    
     mv = client.create_model_version(name=model_name, source=model_uri, run_id=run_id)
     LOGGER.log.info(f'Registered Model: {model_name}, version: {mv.version}')
     
@@ -0,0 +1,275 @@
+import os
+import math
+import uuid
+import random
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+import mlflow
+
+from utils import Logger, AppPath, seed_everything
+from config.data_config import CatDogData
+
+from dotenv import load_dotenv
+load_dotenv()
+
+LOGGER = Logger(__file__)
+LOGGER.log.info('Starting Model Sweep')
+
+def grid_configs(search_space):
+    keys = list(search_space)
+    return [dict(zip(keys, values)) for values in itertools.product(*search_space.values())]
+
+def random_configs(search_space, n_trials: int, seed: int):
+    # Sample from the grid without replacement, a duplicate config would waste a trial
+    grid = grid_configs(search_space)
+    if n_trials >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, n_trials)
+
+def init_trial_worker(num_threads: int):
+    # Every trial process gets its own slice of the cores instead of all of them contending for every core
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+def prepare_feature_caches(model_names, data_version: str, data_format: str, batch_size: int = 64, device: str = 'cpu'):
+    """Extract the backbone features of every model family once, returns {model_name: feature cache key}.
+
+    Runs in the sweep process before any trial starts, so trials only ever hit the cache and
+    concurrent trials of one family never extract (and write) the same features.
+    """
+    from model import FeatureCache, split_head, feature_cache_key
+    from model_training import load_datasets, create_model
+    from data_processing import version_hash
+
+    data_hash = version_hash(AppPath.TRAIN_DATA_DIR / data_version)
+    splits = dict(zip(['train', 'val'], load_datasets(data_version, data_format, random_flip=False)))
+    cache_keys = {}
+    for model_name in sorted(set(model_names)):
+        # Same key as model_training.py --feature_cache, the two share their caches
+        cache_keys[model_name] = feature_cache_key(model_name, data_version, data_format, CatDogData.test_transform, data_hash)
+        feature_cache = FeatureCache(AppPath.FEATURE_CACHE_DIR, cache_keys[model_name])
+        backbone, _ = split_head(create_model(model_name, load_pretrained=True))
+        for split, data in splits.items():
+            feature_cache.load_or_extract(split, backbone, data, batch_size=batch_size, device=device)
+    return cache_keys
+
+def run_trial(trial):
+    from model import Trainer, FeatureCache, split_head
+    from model_training import load_datasets, create_model
+
+    seed_everything(trial['seed'])
+    config = trial['config']
+    cache_key = trial['feature_cache_key']
+    # Cached features are extracted once, so random augmentation is off in that mode
+    train_data, val_data, _ = load_datasets(trial['data_version'], trial['data_format'], random_flip=cache_key is None)
+    model = create_model(config['model_name'], load_pretrained=trial['load_pretrained'])
+    full_model = None
+    if cache_key is not None:
+        feature_cache = FeatureCache(AppPath.FEATURE_CACHE_DIR, cache_key)
+        backbone, head = split_head(model)
+        train_data, val_data = [feature_cache.load_or_extract(split, backbone, data, batch_size=config['batch_size'],
+                                                              device=trial['device'])
+                                for split, data in [('train', train_data), ('val', val_data)]]
+        # Train the head alone on cached features, the full model (sharing the head) is what gets logged
+        full_model, model = model, head
+
+    mlflow_log_tags = {
+        'data_version': trial['data_version'],
+        'id2label': CatDogData.id2label,
+        'label2id': CatDogData.label2id,
+        # Nests the trial under the sweep run in the MLflow UI
+        'mlflow.parentRunId': trial['parent_run_id'],
+        'sweep_id': trial['sweep_id'],
+        'sweep_trial': trial['trial_id'],
+        'sweep_rung': trial['rung'],
+    }
+    if cache_key is not None:
+        mlflow_log_tags['feature_cache_key'] = cache_key
+    mlflow_log_params = {
+        'model': (full_model or model).__class__.__name__,
+        'model_name': config['model_name'],
+        'n_epochs': trial['epochs'],
+        'batch_size': config['batch_size'],
+        'lr': config['lr'],
+        'weight_decay': config['weight_decay'],
+        'best_model_metric': 'val_loss',
+        'device': trial['device'],
+        'seed': trial['seed'],
+        'data_format': trial['data_format'],
+        'feature_cache': cache_key is not None,
+        'n_classes': CatDogData.n_classes,
+        'image_size': CatDogData.img_size,
+        'image_mean': CatDogData.mean,
+        'image_std': CatDogData.std,
+        'num_threads': torch.get_num_threads(),
+    }
+
+    trainer = Trainer(
+        model=model,
+        num_epochs=trial['epochs'],
+        learning_rate=config['lr'],
+        weight_decay=config['weight_decay'],
+        train_data=train_data,
+        val_data=val_data,
+        batch_size=config['batch_size'],
+        mlflow_log_tags=mlflow_log_tags,
+        mlflow_log_params=mlflow_log_params,
+        device=trial['device'],
+        best_model_metric='val_loss',
+        logged_model=full_model,
+    )
+    return trainer.train()
+
+def run_rung(pool, trials):
+    results = {}
+    futures = {pool.submit(run_trial, trial): trial for trial in trials}
+    for future in as_completed(futures):
+        trial = futures[future]
+        try:
+            results[trial['trial_id']] = future.result()
+        except Exception as e:
+            # A failed trial (e.g. out of memory) is dropped from the sweep instead of aborting it
+            LOGGER.log.error(f"Trial {trial['trial_id']} {trial['config']} failed: {e}")
+            results[trial['trial_id']] = {'run_id': None, 'best_val_loss': float('inf'), 'best_val_acc': 0.0}
+            continue
+        LOGGER.log.info(f"Rung {trial['rung']} trial {trial['trial_id']} {trial['config']} "
+                        f"epochs: {trial['epochs']} best val loss: {results[trial['trial_id']]['best_val_loss']:.4f}")
+    return results
+
+def sweep(configs, data_version: str, min_epochs: int, max_epochs: int, eta: int = 3, max_parallel: int = 2,
+          device: str = 'cpu', data_format: str = 'imagefolder', load_pretrained: bool = False, seed: int = 42,
+          feature_cache: bool = False):
+    """Successive halving over `configs`.
+
+    Every rung trains the surviving configs for the rung's epoch budget in a process pool, then
+    keeps the best 1/eta of them by val_loss and multiplies the budget by eta, until `max_epochs`.
+    With min_epochs == max_epochs this is a plain grid/random search. With `feature_cache` the
+    backbone features of each model family are extracted once and every trial only trains the head.
+    """
+    sweep_id = uuid.uuid4().hex[:8]
+    cache_keys = {}
+    if feature_cache:
+        cache_keys = prepare_feature_caches([config['model_name'] for config in configs], data_version, data_format,
+                                            device=device)
+    num_threads = max(1, (os.cpu_count() or 1) // max_parallel)
+    LOGGER.log.info(f'Sweep {sweep_id}: {len(configs)} configs, {max_parallel} parallel trials with {num_threads} threads each')
+
+    # Spawned workers start clean instead of inheriting the parent's torch thread pools
+    pool = ProcessPoolExecutor(max_workers=max_parallel, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_trial_worker, initargs=(num_threads,))
+    with pool, mlflow.start_run(run_name=f'sweep {sweep_id} - {data_version}') as parent_run:
+        mlflow.set_tags({'sweep_parent': sweep_id, 'data_version': data_version})
+        mlflow.log_params({
+            'n_configs': len(configs),
+            'min_epochs': min_epochs,
+            'max_epochs': max_epochs,
+            'eta': eta,
+            'max_parallel': max_parallel,
+            'num_threads': num_threads,
+            'feature_cache': feature_cache,
+        })
+
+        survivors = list(enumerate(configs))
+        epochs, rung = min_epochs, 0
+        best = None
+        while survivors:
+            trials = [{
+                'trial_id': trial_id,
+                'config': config,
+                'rung': rung,
+                'epochs': epochs,
+                'sweep_id': sweep_id,
+                'parent_run_id': parent_run.info.run_id,
+                'data_version': data_version,
+                'data_format': data_format,
+                'load_pretrained': load_pretrained,
+                'device': device,
+                'seed': seed,
+                'feature_cache_key': cache_keys.get(config['model_name']),
+            } for trial_id, config in survivors]
+            results = run_rung(pool, trials)
+
+            ranked = sorted(survivors, key=lambda survivor: results[survivor[0]]['best_val_loss'])
+            best = (ranked[0][1], results[ranked[0][0]])
+            mlflow.log_metric('rung_best_val_loss', best[1]['best_val_loss'], step=rung)
+            if epochs >= max_epochs:
+                break
+            survivors = [survivor for survivor in ranked[:max(1, math.ceil(len(ranked) / eta))]
+                         if math.isfinite(results[survivor[0]]['best_val_loss'])]
+            epochs, rung = min(epochs * eta, max_epochs), rung + 1
+
+        if best is not None and best[1]['run_id'] is not None:
+            mlflow.set_tag('best_run_id', best[1]['run_id'])
+            mlflow.log_params({f'best_{key}': value for key, value in best[0].items()})
+            LOGGER.log.info(f"Sweep {sweep_id} best: {best[0]} val loss: {best[1]['best_val_loss']:.4f} run: {best[1]['run_id']}")
+    LOGGER.log.info(f'Register the best trial with: python model_registry.py --sweep_id {sweep_id}')
+    return sweep_id, best
+
+if __name__ == '__main__':
+    from model_training import MODEL_NAMES
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_version', type=str, required=True,
+                        help='Version/directory to be used for training')
+    parser.add_argument('--model_names', type=str, nargs='+', default=MODEL_NAMES,
+                        choices=MODEL_NAMES,
+                        help='Model families to search over')
+    parser.add_argument('--lr', type=float, nargs='+', default=[1e-4, 3e-4, 1e-3],
+                        help='Learning rates to search over')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[32],
+                        help='Batch sizes to search over')
+    parser.add_argument('--weight_decay', type=float, nargs='+', default=[0.0, 1e-5, 1e-4],
+                        help='Weight decays to search over')
+    parser.add_argument('--strategy', type=str, default='grid',
+                        choices=['grid', 'random'],
+                        help='Try every combination or sample --n_trials of them')
+    parser.add_argument('--n_trials', type=int, default=10,
+                        help='Number of sampled configs for random search')
+    parser.add_argument('--min_epochs', type=int, default=1,
+                        help='Epoch budget of the first successive-halving rung')
+    parser.add_argument('--max_epochs', type=int, default=9,
+                        help='Epoch budget of the last rung, equal to --min_epochs disables early stopping')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='Keep the best 1/eta trials and multiply the budget by eta at every rung')
+    parser.add_argument('--max_parallel', type=int, default=2,
+                        help='Number of trials trained concurrently, CPU cores are split evenly between them')
+    parser.add_argument('--data_format', type=str, default='imagefolder',
+                        choices=['imagefolder', 'packed'],
+                        help='Read raw JPEGs with ImageFolder or the pre-decoded memory-mapped format')
+    parser.add_argument('--device', type=str, default='cpu',
+                        choices=['cuda', 'cpu'],
+                        help='Device to be used for training')
+    parser.add_argument('--load_pretrained', action='store_true',
+                        help='Using pretrained model for training')
+    parser.add_argument('--feature_cache', action='store_true',
+                        help='Extract the frozen pretrained backbone features once per model and train only the heads on them')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for reproducibility')
+    args = parser.parse_args()
+
+    if args.min_epochs > args.max_epochs or args.eta < 2:
+        parser.error('--min_epochs must not exceed --max_epochs and --eta must be at least 2')
+    if args.feature_cache and not args.load_pretrained:
+        parser.error('--feature_cache requires --load_pretrained')
+
+    mlflow.set_tracking_uri(os.getenv('MLFLOW_TRACKING_URI'))
+    mlflow.set_experiment(os.getenv('MLFLOW_EXPERIMENT_NAME'))
+
+    search_space = {
+        'model_name': args.model_names,
+        'lr': args.lr,
+        'batch_size': args.batch_size,
+        'weight_decay': args.weight_decay,
+    }
+    if args.strategy == 'grid':
+        configs = grid_configs(search_space)
+    else:
+        configs = random_configs(search_space, args.n_trials, args.seed)
+
+    sweep(configs, args.data_version, args.min_epochs, args.max_epochs, eta=args.eta, max_parallel=args.max_parallel,
+          device=args.device, data_format=args.data_format, load_pretrained=args.load_pretrained, seed=args.seed,
+          feature_cache=args.feature_cache)
@@ -1,20 +1,89 @@
+import json
+import hashlib
 import argparse
 
 import torchvision
+import mlflow
+from mlflow.tracking import MlflowClient
 
 from utils import Logger, AppPath, seed_everything
 from config.data_config import CatDogData
-from model import create_resnet, create_mobilenet, Trainer
+from model import create_resnet, create_mobilenet, Trainer, FeatureCache, split_head, feature_cache_key
+from model import DistillationLoss, DistillationDataset, measure_cpu_latency
+from dataset import PackedDataset, BatchTransform
+from data_packing import packed_data_dir, packing_training_data, stale_splits
+from data_processing import version_hash
 
 LOGGER = Logger(__file__)
 LOGGER.log.info('Starting Model Training')
 
+MODEL_NAMES = ['resnet_18', 'resnet_34', 'mobilenet_v2', 'mobilenet_v3_small']
+# DataLoader settings don't change what is trained, a run can resume with other values
+RESUME_IGNORED_ARGS = {'resume', 'num_workers', 'persistent_workers', 'prefetch_factor', 'pin_memory'}
+
+def load_datasets(data_version: str, data_format: str = 'imagefolder', random_flip: bool = True, raw: bool = False):
+    try:
+        data_path = AppPath.TRAIN_DATA_DIR / data_version
+        assert data_path.exists()
+    except AssertionError:
+        LOGGER.log.info(f'Data version: {data_version} not found.')
+        raise FileNotFoundError(f'Data version: {data_version} not found.')
+
+    if data_format == 'packed':
+        packed_dir = packed_data_dir(data_version)
+        # Repack the splits whose images changed since they were packed
+        stale = stale_splits(data_version)
+        if stale:
+            LOGGER.log.info(f'Packed data of {stale} missing or out of date, packing {data_version} to {packed_dir}')
+            packing_training_data(data_version, splits=stale)
+        
+        train_data = PackedDataset(packed_dir/'train', mean=CatDogData.mean, std=CatDogData.std,
+                                   random_flip=random_flip, raw=raw)
+        val_data = PackedDataset(packed_dir/'val', mean=CatDogData.mean, std=CatDogData.std, raw=raw)
+        test_data = PackedDataset(packed_dir/'test', mean=CatDogData.mean, std=CatDogData.std, raw=raw)
+    else:
+        train_data = torchvision.datasets.ImageFolder(
+            root=AppPath.TRAIN_DATA_DIR/data_version/'train',
+            transform=CatDogData.train_transform if random_flip else CatDogData.test_transform
+        )
+        
+        val_data = torchvision.datasets.ImageFolder(
+            root=AppPath.TRAIN_DATA_DIR/data_version/'val',
+            transform=CatDogData.test_transform
+        )
+        
+        test_data = torchvision.datasets.ImageFolder(
+            root=AppPath.TRAIN_DATA_DIR/data_version/'test',
+            transform=CatDogData.test_transform
+        )
+    return train_data, val_data, test_data
+
+def create_model(model_name: str, load_pretrained: bool = False):
+    model_prefix = model_name.split('_')[0]
+    if model_prefix == 'resnet':
+        return create_resnet(n_classes=CatDogData.n_classes, model_name=model_name, load_pretrained=load_pretrained)
+    elif model_prefix == 'mobilenet':
+        return create_mobilenet(n_classes=CatDogData.n_classes, model_name=model_name, load_pretrained=load_pretrained)
+    raise ValueError(f'Invalid model_name: {model_name}')
+
+def load_teacher(teacher_model: str):
+    """Load the registered 'name:alias' model, returns (model, version)."""
+    name, _, alias = teacher_model.partition(':')
+    model_version = MlflowClient().get_model_version_by_alias(name=name, alias=alias or 'Production')
+    teacher = mlflow.pytorch.load_model(f'models:/{name}/{model_version.version}', map_location='cpu')
+    return teacher.eval(), str(model_version.version)
+
+def run_key(args, **extra):
+    """Hash of the arguments (and `extra`, e.g. the data hash) that decide what a training run produces."""
+    params = {key: value for key, value in vars(args).items() if key not in RESUME_IGNORED_ARGS}
+    return hashlib.sha256(json.dumps({**params, **extra}, sort_keys=True).encode()).hexdigest()[:8]
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_version', type=str, required=True, 
                         help='Version/directory to be used for training')
     parser.add_argument('--model_name', type=str, default='resnet_18',
-                        choices=['resnet_18', 'resnet_34', 'mobilenet_v2', 'mobilenet_v3_small'],
+                        choices=MODEL_NAMES,
                         help='Model to be used for training')
     parser.add_argument('--epochs', type=int, default=5,
                         help='Number of epochs for training')
@@ -34,46 +103,79 @@ if __name__ == '__main__':
                         help='Seed for reproducibility')
     parser.add_argument('--load_pretrained', action='store_true',
                         help='Using pretrained model for training')
+    parser.add_argument('--data_format', type=str, default='imagefolder',
+                        choices=['imagefolder', 'packed'],
+                        help='Read raw JPEGs with ImageFolder or the pre-decoded memory-mapped format')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of DataLoader worker processes')
+    parser.add_argument('--persistent_workers', action='store_true',
+                        help='Keep DataLoader workers alive across epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='Number of batches prefetched by each DataLoader worker')
+    parser.add_argument('--pin_memory', action='store_true',
+                        help='Use pinned host memory for faster host-to-device copies')
+    parser.add_argument('--batched_transform', action='store_true',
+                        help='Apply flip/normalization to whole uint8 batches instead of per image (packed data only)')
+    parser.add_argument('--autocast_bf16', action='store_true',
+                        help='Run forward passes under bfloat16 autocast')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='Use channels_last memory format for the model and image batches')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the model with torch.compile, compiled graphs are cached across runs')
+    parser.add_argument('--inference_mode', action='store_true',
+                        help='Use torch.inference_mode instead of torch.no_grad for evaluation')
+    parser.add_argument('--feature_cache', action='store_true',
+                        help='Run the frozen pretrained backbone once, cache pooled features and train only the head on them')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the last interrupted run with the same arguments and data from its checkpoint')
+    parser.add_argument('--teacher_model', type=str, default=None,
+                        help='Registered name:alias model to distill from, e.g. resnet_34:Production')
+    parser.add_argument('--distill_temperature', type=float, default=4.0,
+                        help='Softmax temperature of the distillation loss')
+    parser.add_argument('--distill_alpha', type=float, default=0.9,
+                        help='Weight of the distillation term, the rest goes to cross-entropy on the labels')
     args = parser.parse_args()
     seed_everything(args.seed)
     
-    try:
-        data_path = AppPath.TRAIN_DATA_DIR / args.data_version
-        assert data_path.exists()
-    except AssertionError:
-        LOGGER.log.info(f'Data version: {args.data_version} not found.')
-        raise FileNotFoundError(f'Data version: {args.data_version} not found.')
-
-    train_data = torchvision.datasets.ImageFolder(
-        root=AppPath.TRAIN_DATA_DIR/args.data_version/'train',
-        transform=CatDogData.train_transform
-    )
-    
-    val_data = torchvision.datasets.ImageFolder(
-        root=AppPath.TRAIN_DATA_DIR/args.data_version/'val',
-        transform=CatDogData.test_transform
-    )
+    if args.batched_transform and args.data_format != 'packed':
+        parser.error('--batched_transform requires --data_format packed')
+    if args.feature_cache and (not args.load_pretrained or args.batched_transform):
+        parser.error('--feature_cache requires --load_pretrained and does not support --batched_transform')
     
-    test_data = torchvision.datasets.ImageFolder(
-        root=AppPath.TRAIN_DATA_DIR/args.data_version/'test',
-        transform=CatDogData.test_transform
-    )
-    
-    model_prefix = args.model_name.split('_')[0]
-    if model_prefix == 'resnet':
-        model = create_resnet(n_classes=CatDogData.n_classes, model_name=args.model_name, load_pretrained=args.load_pretrained)
-    elif model_prefix == 'mobilenet':
-        model = create_mobilenet(n_classes=CatDogData.n_classes, model_name=args.model_name, load_pretrained=args.load_pretrained)
+    # Cached features are extracted once, so random augmentation is off in that mode
+    train_data, val_data, test_data = load_datasets(args.data_version, args.data_format,
+                                                    random_flip=not args.feature_cache,
+                                                    raw=args.batched_transform)
+    model = create_model(args.model_name, load_pretrained=args.load_pretrained)
     
     mlflow_log_tags = {
         'data_version': args.data_version,
         'id2label': CatDogData.id2label,
         'label2id': CatDogData.label2id
     }
+    
+    # Cached features and logits are only reused for the exact images they were computed from
+    data_hash = version_hash(AppPath.TRAIN_DATA_DIR / args.data_version)
+    mlflow_log_tags['data_hash'] = data_hash
+    
+    full_model = None
+    if args.feature_cache:
+        cache_key = feature_cache_key(args.model_name, args.data_version, args.data_format, CatDogData.test_transform,
+                                      data_hash)
+        feature_cache = FeatureCache(AppPath.FEATURE_CACHE_DIR, cache_key)
+        backbone, head = split_head(model)
+        train_data, val_data, test_data = [
+            feature_cache.load_or_extract(split, backbone, data, batch_size=args.batch_size,
+                                          device=args.device, num_workers=args.num_workers)
+            for split, data in [('train', train_data), ('val', val_data), ('test', test_data)]
+        ]
+        # Train the head alone on cached features, the full model (sharing the head) is what gets logged
+        full_model, model = model, head
+        mlflow_log_tags['feature_cache_key'] = cache_key
     LOGGER.log.info(f'Model training tags: {mlflow_log_tags}')
     
     mlflow_log_params = {
-        'model': model.__class__.__name__,
+        'model': (full_model or model).__class__.__name__,
         'model_name': args.model_name,
         'n_epochs': args.epochs,
         'batch_size': args.batch_size,
@@ -82,13 +184,44 @@ if __name__ == '__main__':
         'best_model_metric': args.best_model_metric,
         'device': args.device,
         'seed': args.seed,
+        'data_format': args.data_format,
+        'feature_cache': args.feature_cache,
         'n_classes': CatDogData.n_classes,
         'image_size': CatDogData.img_size,
         'image_mean': CatDogData.mean,
         'image_std': CatDogData.std,
     }
+    
+    teacher, distillation_loss = None, None
+    if args.teacher_model:
+        teacher, teacher_version = load_teacher(args.teacher_model)
+        # Teacher logits of the un-augmented images, computed once per teacher version and data content
+        teacher_key = feature_cache_key(f'teacher-{args.teacher_model}-{teacher_version}', args.data_version,
+                                        args.data_format, CatDogData.test_transform, data_hash)
+        teacher_cache = FeatureCache(AppPath.FEATURE_CACHE_DIR, teacher_key)
+        teacher_train_data, teacher_val_data, _ = load_datasets(args.data_version, args.data_format, random_flip=False)
+        train_logits = teacher_cache.load_or_extract('train', teacher, teacher_train_data, batch_size=args.batch_size,
+                                                     device=args.device, num_workers=args.num_workers).tensors[0]
+        val_logits, val_labels = teacher_cache.load_or_extract('val', teacher, teacher_val_data, batch_size=args.batch_size,
+                                                               device=args.device, num_workers=args.num_workers).tensors
+        teacher = teacher.to('cpu')
+        teacher_val_acc = (val_logits.argmax(dim=1) == val_labels).float().mean().item()
+        
+        train_data = DistillationDataset(train_data, train_logits)
+        distillation_loss = DistillationLoss(temperature=args.distill_temperature, alpha=args.distill_alpha)
+        mlflow_log_tags.update({'teacher_model': args.teacher_model, 'teacher_version': teacher_version,
+                                'teacher_cache_key': teacher_key})
+        mlflow_log_params.update({'distill_temperature': args.distill_temperature, 'distill_alpha': args.distill_alpha})
     LOGGER.log.info(f'Model training params: {mlflow_log_params}')
     
+    # Only an interrupted run with the same arguments, data and teacher version resumes from this checkpoint
+    checkpoint_key = run_key(args, data_hash=data_hash, teacher_version=teacher_version if teacher is not None else None)
+    
+    train_batch_transform, eval_batch_transform = None, None
+    if args.batched_transform:
+        train_batch_transform = BatchTransform(mean=CatDogData.mean, std=CatDogData.std, random_flip=True)
+        eval_batch_transform = BatchTransform(mean=CatDogData.mean, std=CatDogData.std)
+    
     trainer = Trainer(
         model=model,
         num_epochs=args.epochs,
@@ -101,8 +234,36 @@ if __name__ == '__main__':
         mlflow_log_params=mlflow_log_params,
         device=args.device,
         best_model_metric=args.best_model_metric,
-        verbose=True
+        verbose=True,
+        num_workers=args.num_workers,
+        persistent_workers=args.persistent_workers,
+        prefetch_factor=args.prefetch_factor,
+        pin_memory=args.pin_memory,
+        train_batch_transform=train_batch_transform,
+        eval_batch_transform=eval_batch_transform,
+        logged_model=full_model,
+        autocast_bf16=args.autocast_bf16,
+        channels_last=args.channels_last,
+        compile=args.compile,
+        inference_mode=args.inference_mode,
+        checkpoint_dir=AppPath.CHECKPOINT_DIR / f'{args.model_name}-{args.data_version}-{checkpoint_key}',
+        resume=args.resume,
+        distillation_loss=distillation_loss
     )
     
-    trainer.train()
+    result = trainer.train()
+    
+    if teacher is not None:
+        # Batch size 1 CPU latency, as a serving request sees it
+        student_latency = measure_cpu_latency(full_model or model, CatDogData.img_size)
+        teacher_latency = measure_cpu_latency(teacher, CatDogData.img_size)
+        with mlflow.start_run(run_id=result['run_id']):
+            mlflow.log_metrics({
+                'cpu_latency_ms': student_latency,
+                'teacher_cpu_latency_ms': teacher_latency,
+                'cpu_speedup_vs_teacher': teacher_latency / student_latency,
+                'teacher_val_acc': teacher_val_acc,
+            })
+        LOGGER.log.info(f'Student {args.model_name}: val acc {result["best_val_acc"]:.4f} - {student_latency:.2f} ms | '
+                        f'Teacher {args.teacher_model}: val acc {teacher_val_acc:.4f} - {teacher_latency:.2f} ms')
     LOGGER.log.info(f'Model Training Completed. Model: {args.model_name}, Data: {args.data_version}')
\ No newline at end of file
@@ -0,0 +1,100 @@
+import os
+import time
+import argparse
+
+import torch
+import torchvision
+import mlflow
+from torch.utils.data import DataLoader
+
+from utils import Logger, AppPath, seed_everything
+from config.data_config import CatDogData
+from model import enable_compile_cache, autocast_context, grad_disabled_context, to_memory_format
+
+from dotenv import load_dotenv
+load_dotenv()
+
+LOGGER = Logger(__file__)
+LOGGER.log.info('Starting Optimization Benchmark')
+
+OPTIONS = {
+    'baseline': {},
+    'inference_mode': {'inference_mode': True},
+    'channels_last': {'channels_last': True},
+    'autocast_bf16': {'autocast_bf16': True},
+    'compile': {'compile': True},
+}
+
+def evaluate(model, loader, device, autocast_bf16=False, channels_last=False, compile=False, inference_mode=False, warmup_batches=2):
+    model = model.to(device).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    forward_model = torch.compile(model) if compile else model
+
+    corrects, total, elapsed = 0, 0, 0.0
+    with grad_disabled_context(inference_mode), autocast_context(device, autocast_bf16):
+        for i, (inputs, labels) in enumerate(loader):
+            inputs = to_memory_format(inputs.to(device), channels_last)
+            start_time = time.perf_counter()
+            outputs = forward_model(inputs)
+            # Warmup batches (compilation, allocator) don't count towards throughput
+            if i >= warmup_batches:
+                elapsed += time.perf_counter() - start_time
+            corrects += (outputs.float().argmax(dim=1).cpu() == labels).sum().item()
+            total += labels.size(0)
+
+    timed = total - min(warmup_batches, len(loader)) * loader.batch_size
+    return {'acc': corrects / total, 'images_per_sec': max(timed, 0) / elapsed if elapsed > 0 else 0.0}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='resnet_18',
+                        help='Registered model to benchmark')
+    parser.add_argument('--model_alias', type=str, default='Production',
+                        help='Alias of the registered model')
+    parser.add_argument('--data_version', type=str, required=True,
+                        help='Version/directory whose test split is used')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Batch size for benchmarking')
+    parser.add_argument('--device', type=str, default='cpu',
+                        choices=['cuda', 'cpu'],
+                        help='Device to be used for benchmarking')
+    parser.add_argument('--options', type=str, nargs='+', default=list(OPTIONS.keys()),
+                        choices=list(OPTIONS.keys()),
+                        help='Options to compare against the baseline')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for reproducibility')
+    args = parser.parse_args()
+    seed_everything(args.seed)
+
+    mlflow.set_tracking_uri(os.getenv('MLFLOW_TRACKING_URI'))
+    mlflow.set_experiment(os.getenv('MLFLOW_EXPERIMENT_NAME'))
+    enable_compile_cache(AppPath.COMPILE_CACHE_DIR)
+
+    test_data = torchvision.datasets.ImageFolder(
+        root=AppPath.TRAIN_DATA_DIR/args.data_version/'test',
+        transform=CatDogData.test_transform
+    )
+    loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=False)
+
+    options = ['baseline'] + [option for option in args.options if option != 'baseline']
+    results = {}
+    for option in options:
+        model = mlflow.pytorch.load_model(f'models:/{args.model_name}@{args.model_alias}', map_location=args.device)
+        results[option] = evaluate(model, loader, args.device, **OPTIONS[option])
+        LOGGER.log.info(f'{option}: {results[option]}')
+
+    baseline = results['baseline']
+    with mlflow.start_run(run_name=f'optimization_benchmark - {args.model_name}@{args.model_alias}'):
+        mlflow.set_tags({'benchmark': 'optimization', 'data_version': args.data_version})
+        mlflow.log_params({'model_name': args.model_name, 'model_alias': args.model_alias,
+                           'batch_size': args.batch_size, 'device': args.device})
+        for option, result in results.items():
+            speedup = result['images_per_sec'] / baseline['images_per_sec'] if baseline['images_per_sec'] else 0.0
+            mlflow.log_metrics({
+                f'{option}_acc': result['acc'],
+                f'{option}_images_per_sec': result['images_per_sec'],
+                f'{option}_speedup': speedup,
+                f'{option}_acc_delta': result['acc'] - baseline['acc'],
+            })
+            LOGGER.log.info(f'{option}: speedup {speedup:.2f}x - acc delta {result["acc"] - baseline["acc"]:+.4f}')
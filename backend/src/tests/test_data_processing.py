@@ -0,0 +1,120 @@
+import os
+import pytest
+
+import data_processing
+from data_processing import assign_splits, creating_training_data, materialized_paths, read_manifest, split_hash, version_hash
+
+RATIO = [0.6, 0.2]
+
+def write_image(path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'raw'
+    for cls in ('cat', 'dog'):
+        for i in range(10):
+            write_image(source / cls / f'{cls}_{i}.jpg', f'{cls} {i}'.encode())
+    return source
+
+def build(source_dirs, dest_dir, version='v1', **kwargs):
+    return creating_training_data(version, [str(path) for path in source_dirs], str(dest_dir), RATIO,
+                                  materialize_mode='copy', num_workers=2, **kwargs)
+
+def split_files(version_dir, split, cls):
+    return sorted(os.listdir(version_dir / split / cls))
+
+def test_assign_splits_exact_ratio():
+    rows = [{'sha256': f'{i:04d}', 'split': ''} for i in range(10)]
+    assign_splits(rows, RATIO)
+    assert [row['split'] for row in rows].count('train') == 6
+    assert [row['split'] for row in rows].count('val') == 2
+    assert [row['split'] for row in rows].count('test') == 2
+
+def test_assign_splits_keeps_existing():
+    rows = [{'sha256': f'{i:04d}', 'split': 'test' if i < 3 else ''} for i in range(10)]
+    assign_splits(rows, RATIO)
+    assert all(row['split'] == 'test' for row in rows[:3])
+    # New rows only fill what train/val are short of
+    assert [row['split'] for row in rows].count('train') == 6
+    assert [row['split'] for row in rows].count('val') == 1
+
+def test_build_layout(source, tmp_path):
+    rows = build([source], tmp_path / 'train_data')
+    version_dir = tmp_path / 'train_data' / 'v1'
+    manifest = read_manifest(version_dir / 'manifest.csv')
+    assert len(rows) == len(manifest) == 20
+    for cls in ('cat', 'dog'):
+        assert len(split_files(version_dir, 'train', cls)) == 6
+        assert len(split_files(version_dir, 'val', cls)) == 2
+        assert len(split_files(version_dir, 'test', cls)) == 2
+
+def test_rebuild_only_hashes_changes(source, tmp_path, monkeypatch):
+    build([source], tmp_path / 'train_data')
+    hashed = []
+    hash_file = data_processing.hash_file
+    monkeypatch.setattr(data_processing, 'hash_file', lambda path: hashed.append(path) or hash_file(path))
+
+    build([source], tmp_path / 'train_data')
+    assert hashed == []
+
+    changed = source / 'cat' / 'cat_0.jpg'
+    changed.write_bytes(b'a different cat')
+    build([source], tmp_path / 'train_data')
+    assert hashed == [str(changed)]
+
+def test_changed_file_is_relinked(source, tmp_path):
+    dest_dir = tmp_path / 'train_data'
+    build([source], dest_dir)
+    version_dir = dest_dir / 'v1'
+    before = read_manifest(version_dir / 'manifest.csv')
+    hashes = {split: split_hash(version_dir, split) for split in data_processing.SPLITS}
+
+    changed = source / 'dog' / 'dog_3.jpg'
+    changed.write_bytes(b'a different dog')
+    build([source], dest_dir)
+    after = read_manifest(version_dir / 'manifest.csv')
+
+    assert after[str(changed)]['sha256'] != before[str(changed)]['sha256']
+    dst = materialized_paths(after.values(), str(version_dir))[str(changed)]
+    assert open(dst, 'rb').read() == b'a different dog'
+    # Unchanged files keep their split, only the split holding the changed file gets a new hash
+    assert all(after[path]['split'] == row['split'] for path, row in before.items() if path != str(changed))
+    changed_split = after[str(changed)]['split']
+    assert {split for split in data_processing.SPLITS if split_hash(version_dir, split) != hashes[split]} == {changed_split}
+
+def test_removed_file_is_unlinked(source, tmp_path):
+    dest_dir = tmp_path / 'train_data'
+    build([source], dest_dir)
+    version_dir = dest_dir / 'v1'
+    version = version_hash(version_dir)
+
+    removed = source / 'cat' / 'cat_5.jpg'
+    removed.unlink()
+    rows = build([source], dest_dir)
+    assert str(removed) not in {row['path'] for row in rows}
+    assert sum(len(split_files(version_dir, split, 'cat')) for split in data_processing.SPLITS) == 9
+    assert version_hash(version_dir) != version
+
+def test_basename_collisions(source, tmp_path):
+    collected = tmp_path / 'collected'
+    # Same name as a raw file, different content
+    write_image(collected / 'cat' / 'cat_0.jpg', b'a collected cat')
+    rows = build([source, collected], tmp_path / 'train_data')
+    version_dir = tmp_path / 'train_data' / 'v1'
+
+    dsts = materialized_paths(rows, str(version_dir))
+    assert len(set(dsts.values())) == len(rows) == 21
+    assert sum(len(split_files(version_dir, split, 'cat')) for split in data_processing.SPLITS) == 11
+    for path, dst in dsts.items():
+        assert open(dst, 'rb').read() == open(path, 'rb').read()
+
+def test_base_version_reuses_splits(source, tmp_path):
+    dest_dir = tmp_path / 'train_data'
+    build([source], dest_dir, version='v1')
+    rows = build([source], dest_dir, version='v2', base_version='v1')
+    base = read_manifest(dest_dir / 'v1' / 'manifest.csv')
+    assert all(row['split'] == base[row['path']]['split'] for row in rows)
+    assert version_hash(dest_dir / 'v1') == version_hash(dest_dir / 'v2')
@@ -13,6 +13,10 @@ class AppPath:
     CATDOG_RAW_DIR = DATA_DIR / 'catdog_raw'
     COLLECTED_DATA_DIR = DATA_DIR / 'collected'
     TRAIN_DATA_DIR = DATA_DIR / 'train_data'
+    FEATURE_CACHE_DIR = DATA_DIR / 'feature_cache'
+    COMPILE_CACHE_DIR = DATA_DIR / 'compile_cache'
+    CHECKPOINT_DIR = DATA_DIR / 'checkpoints'
     
 AppPath.COLLECTED_DATA_DIR.mkdir(parents=True, exist_ok=True)
-AppPath.TRAIN_DATA_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+AppPath.TRAIN_DATA_DIR.mkdir(parents=True, exist_ok=True)
+AppPath.FEATURE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
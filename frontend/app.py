@@ -1,9 +1,8 @@
 import os
-import io
 import argparse
-import requests
 import gradio as gr
-from PIL import Image
+
+from catdog_client import CatDogClient, CatDogAPIError
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -15,27 +14,17 @@ FRONTEND_PORT = int(os.getenv('FRONTEND_PORT'))
 num_classes = 2
 id2class = {0: 'cat', 1: 'dog'}
 
+# One client for the whole app, Gradio requests reuse its keep-alive connections
+client = CatDogClient(API_URL, batch_size=1)
+
 
 def predict_api(image_path):
-    image = Image.open(image_path)
-    image_name = image_path.split('/')[-1]
-    img_byte_arr = io.BytesIO()
-    
-    image.save(img_byte_arr, format='JPEG')
-    img_byte_arr = img_byte_arr.getvalue()
-    
-    url = f'{API_URL}/v1/catdog_classification/predict'
-    files = {'file_upload': (image_name, img_byte_arr, 'image/jpeg')}
-    headers = {'accept': 'application/json'}
-    
-    response = requests.post(url, headers=headers, files=files)
-    
-    if response.status_code == 200:
-        json_results = response.json()
-        confidences = {id2class[i]: json_results['probs'][i] for i in range(num_classes)}
-        return confidences, json_results
-    else:
-        return "Error: API request failed."
+    try:
+        json_results = client.predict(image_path)
+    except CatDogAPIError as e:
+        raise gr.Error(f"API request failed: {e.detail}")
+    confidences = {id2class[i]: json_results['probs'][i] for i in range(num_classes)}
+    return confidences, json_results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -0,0 +1,3 @@
+from .client import CatDogClient, AsyncCatDogClient, CatDogAPIError, load_image
+
+__all__ = ['CatDogClient', 'AsyncCatDogClient', 'CatDogAPIError', 'load_image']
@@ -0,0 +1,246 @@
+import os
+import time
+import random
+import asyncio
+import mimetypes
+from uuid import uuid4
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+API_PREFIX = '/v1/catdog_classification'
+# Retried with backoff, the server answers 503 when its in-flight limit is reached
+RETRY_STATUS_CODES = (502, 503, 504)
+
+class CatDogAPIError(Exception):
+    def __init__(self, status_code: int, detail):
+        super().__init__(f'API request failed with status {status_code}: {detail}')
+        self.status_code = status_code
+        self.detail = detail
+
+def load_image(image):
+    """Normalize an image argument to (bytes, name): a path, raw bytes or a (bytes, name) tuple."""
+    if isinstance(image, (str, Path)):
+        path = Path(image)
+        return path.read_bytes(), path.name
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image), f'{uuid4().hex}.jpg'
+    return image
+
+def image_file(image, name):
+    return (name, image, mimetypes.guess_type(name)[0] or 'application/octet-stream')
+
+class _BaseClient:
+    """Request building, retry policy and batch grouping shared by the sync and asyncio clients.
+
+    One client keeps a pool of keep-alive HTTP/1.1 connections, at most `max_inflight`
+    requests run at once. `predict_many` groups images into `/predict_batch` calls of
+    `batch_size` images, and falls back to one `/predict` call per image when the server
+    has no batch endpoint. 502/503/504 and connection errors are retried `max_retries`
+    times with exponential backoff (or the server's Retry-After).
+    """
+    def __init__(self, base_url: str = None, model: str = None, max_inflight: int = 8, batch_size: int = 16,
+                 timeout: float = 30.0, max_retries: int = 3, backoff: float = 0.5, max_backoff: float = 10.0):
+        self.base_url = (base_url or os.getenv('API_URL', 'http://127.0.0.1:5000')).rstrip('/')
+        self.model = model
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # None until the first batch call tells whether the server has /predict_batch
+        self.batch_supported = None if batch_size > 1 else False
+
+    @property
+    def limits(self):
+        return httpx.Limits(max_connections=self.max_inflight, max_keepalive_connections=self.max_inflight)
+
+    @property
+    def params(self):
+        return {'model': self.model} if self.model else {}
+
+    def retry_delay(self, attempt: int, response=None):
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        # Full jitter, so clients turned away together don't come back together
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    def should_retry(self, attempt: int, response=None):
+        if attempt >= self.max_retries:
+            return False
+        return response is None or response.status_code in RETRY_STATUS_CODES
+
+    @staticmethod
+    def parse(response):
+        if response.status_code != 200:
+            try:
+                detail = response.json().get('detail')
+            except ValueError:
+                detail = response.text
+            raise CatDogAPIError(response.status_code, detail)
+        return response.json()
+
+    def chunks(self, images):
+        chunk_size = self.batch_size if self.batch_supported is not False else 1
+        chunk = []
+        for image in images:
+            chunk.append(image)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def is_batch_missing(self, response):
+        return response.status_code in (404, 405)
+
+class CatDogClient(_BaseClient):
+    """Blocking client, safe to share between threads."""
+    def __init__(self, base_url: str = None, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.http = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self.limits,
+                                 headers={'accept': 'application/json'})
+        self.executor = ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix='catdog-client')
+
+    def post(self, path: str, params: dict = None, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                response = self.http.post(API_PREFIX + path, params={**self.params, **(params or {})}, **kwargs)
+            except httpx.TransportError:
+                if not self.should_retry(attempt):
+                    raise
+                response = None
+            if response is not None and not self.should_retry(attempt, response):
+                return response
+            time.sleep(self.retry_delay(attempt, response))
+            attempt += 1
+
+    def predict(self, image, image_name: str = None):
+        image, name = load_image(image)
+        return self.parse(self.post('/predict', files={'file_upload': image_file(image, image_name or name)}))
+
+    def predict_batch(self, images):
+        images = [load_image(image) for image in images]
+        response = self.post('/predict_batch', params={'stream': 'false'},
+                             files=[('files', image_file(image, name)) for image, name in images])
+        if self.is_batch_missing(response):
+            self.batch_supported = False
+            return [self.predict(image, name) for image, name in images]
+        self.batch_supported = True
+        return self.parse(response)
+
+    def _predict_chunk(self, chunk, return_exceptions):
+        try:
+            if len(chunk) > 1 and self.batch_supported is not False:
+                return self.predict_batch(chunk)
+            return [self.predict(image) for image in chunk]
+        except Exception as e:
+            if not return_exceptions or len(chunk) == 1:
+                if return_exceptions:
+                    return [e]
+                raise
+            # Score the images one by one so one bad image doesn't fail its whole batch
+            return [self._predict_chunk([image], return_exceptions)[0] for image in chunk]
+
+    def predict_many(self, images, return_exceptions: bool = False):
+        """Yield one result per image, in input order, with up to `max_inflight` requests at once.
+
+        Images are only read when their request is sent, so a generator of paths scores
+        a whole directory without holding it in memory.
+        """
+        pending = deque()
+        for chunk in self.chunks(images):
+            if len(pending) >= self.max_inflight:
+                yield from pending.popleft().result()
+            pending.append(self.executor.submit(self._predict_chunk, chunk, return_exceptions))
+        while pending:
+            yield from pending.popleft().result()
+
+    def close(self):
+        self.executor.shutdown()
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class AsyncCatDogClient(_BaseClient):
+    """asyncio client, for use inside one event loop."""
+    def __init__(self, base_url: str = None, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.http = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits,
+                                      headers={'accept': 'application/json'})
+        self.semaphore = asyncio.Semaphore(self.max_inflight)
+
+    async def post(self, path: str, params: dict = None, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    response = await self.http.post(API_PREFIX + path, params={**self.params, **(params or {})}, **kwargs)
+            except httpx.TransportError:
+                if not self.should_retry(attempt):
+                    raise
+                response = None
+            if response is not None and not self.should_retry(attempt, response):
+                return response
+            await asyncio.sleep(self.retry_delay(attempt, response))
+            attempt += 1
+
+    async def predict(self, image, image_name: str = None):
+        image, name = await asyncio.to_thread(load_image, image)
+        return self.parse(await self.post('/predict', files={'file_upload': image_file(image, image_name or name)}))
+
+    async def predict_batch(self, images):
+        images = await asyncio.to_thread(lambda: [load_image(image) for image in images])
+        response = await self.post('/predict_batch', params={'stream': 'false'},
+                                   files=[('files', image_file(image, name)) for image, name in images])
+        if self.is_batch_missing(response):
+            self.batch_supported = False
+            return await asyncio.gather(*(self.predict(image, name) for image, name in images))
+        self.batch_supported = True
+        return self.parse(response)
+
+    async def _predict_chunk(self, chunk, return_exceptions):
+        try:
+            if len(chunk) > 1 and self.batch_supported is not False:
+                return await self.predict_batch(chunk)
+            return await asyncio.gather(*(self.predict(image) for image in chunk))
+        except Exception as e:
+            if not return_exceptions or len(chunk) == 1:
+                if return_exceptions:
+                    return [e]
+                raise
+            return await asyncio.gather(*(self.predict(image) for image in chunk), return_exceptions=True)
+
+    async def predict_many(self, images, return_exceptions: bool = False):
+        """Async generator of one result per image, in input order, see `CatDogClient.predict_many`."""
+        pending = deque()
+        try:
+            for chunk in self.chunks(images):
+                if len(pending) >= self.max_inflight:
+                    for result in await pending.popleft():
+                        yield result
+                pending.append(asyncio.ensure_future(self._predict_chunk(chunk, return_exceptions)))
+            while pending:
+                for result in await pending.popleft():
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
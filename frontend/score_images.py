@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+from catdog_client import CatDogClient, AsyncCatDogClient, CatDogAPIError
+
+from dotenv import load_dotenv
+load_dotenv()
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+def find_images(image_dir: Path):
+    for path in sorted(image_dir.rglob('*')):
+        if path.suffix.lower() in IMAGE_EXTENSIONS:
+            yield path
+
+def to_record(path, result):
+    if isinstance(result, CatDogAPIError):
+        return {'image': str(path), 'error': str(result.detail), 'status_code': result.status_code}
+    if isinstance(result, Exception):
+        return {'image': str(path), 'error': str(result)}
+    return {'image': str(path), **result}
+
+async def score_async(paths, output, **client_args):
+    count = 0
+    async with AsyncCatDogClient(**client_args) as client:
+        results = client.predict_many(paths, return_exceptions=True)
+        async for path, result in _zip_async(paths, results):
+            output.write(json.dumps(to_record(path, result)) + '\n')
+            count += 1
+    return count
+
+async def _zip_async(items, results):
+    iterator = iter(items)
+    async for result in results:
+        yield next(iterator), result
+
+def score(paths, output, **client_args):
+    count = 0
+    with CatDogClient(**client_args) as client:
+        for path, result in zip(paths, client.predict_many(paths, return_exceptions=True)):
+            output.write(json.dumps(to_record(path, result)) + '\n')
+            count += 1
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score every image under a directory, one JSON line per image')
+    parser.add_argument('--image_dir', type=str, required=True)
+    parser.add_argument('--output', type=str, default=None, help='JSON lines file, stdout if not set')
+    parser.add_argument('--api_url', type=str, default=os.getenv('API_URL'))
+    parser.add_argument('--model', type=str, default=None, help='name:alias of the serving model, the default route if not set')
+    parser.add_argument('--max_inflight', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=16, help='Images per /predict_batch call, 1 sends one /predict call per image')
+    parser.add_argument('--max_retries', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--use_async', action='store_true')
+    args = parser.parse_args()
+
+    paths = list(find_images(Path(args.image_dir)))
+    client_args = dict(base_url=args.api_url, model=args.model, max_inflight=args.max_inflight,
+                       batch_size=args.batch_size, max_retries=args.max_retries, timeout=args.timeout)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    start_time = time.perf_counter()
+    try:
+        if args.use_async:
+            count = asyncio.run(score_async(paths, output, **client_args))
+        else:
+            count = score(paths, output, **client_args)
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - start_time
+    print(f'Scored {count} images in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.1f} images/s)', file=sys.stderr)